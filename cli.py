@@ -61,6 +61,7 @@ commands = {
     'cancel': by_id_helper(em.cancel_tasks_by_id),
     'resume': by_id_helper(em.resume_tasks_by_id),
     'export_csv': em.export_csv,
+    'export_parquet': em.export_parquet,
     'export_yaml': em.export_yaml
 }
 symbols = [
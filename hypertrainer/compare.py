@@ -0,0 +1,90 @@
+from typing import Dict, Tuple
+
+import numpy as np
+
+quantiles = (0.25, 0.5, 0.75)
+
+
+def last_value_per_epoch(line: np.ndarray) -> np.ndarray:
+    """Sort the (epoch, value) rows of a line by epoch, keeping only the last value logged at each epoch (e.g. when an
+    epoch was logged again after a resume)"""
+
+    reversed_epochs = line[::-1, 0]
+    _, idx = np.unique(reversed_epochs, return_index=True)  # First occurrence in reverse: the last one logged
+    return line[len(line) - 1 - idx]
+
+
+def align_on_epochs(lines: Dict[int, np.ndarray], max_epochs: int = 1000) -> Tuple[np.ndarray, np.ndarray]:
+    """Align the values of several lines on their epochs.
+
+    `lines` is a dict {task_id: array} where each row of an array is (epoch, value). Returns a tuple (epochs, values)
+    where epochs is the sorted union of the epochs of all lines, and values is an array of shape
+    (len(lines), len(epochs)) containing NaN where a line has no value. A line with several values at the same epoch
+    keeps the last one (see last_value_per_epoch).
+    If there are more than max_epochs epochs, the lines are instead aligned on max_epochs bins evenly spaced between the
+    first and the last epoch: each line gets the mean of its values in each bin, and the epochs returned are the centers
+    of the bins (the empty bins are left out).
+    """
+
+    arrays = [last_value_per_epoch(a) for a in lines.values()]
+    if sum(len(a) for a in arrays) == 0:
+        return np.empty(0), np.empty((len(arrays), 0))
+    points = np.concatenate(arrays)
+    line_idx = np.repeat(np.arange(len(arrays)), [len(a) for a in arrays])
+    epochs, epoch_idx = np.unique(points[:, 0], return_inverse=True)
+    if len(epochs) <= max_epochs:
+        values = np.full((len(arrays), len(epochs)), np.nan)
+        values[line_idx, epoch_idx] = points[:, 1]
+        return epochs, values
+
+    edges = np.linspace(epochs[0], epochs[-1], max_epochs + 1)
+    bin_idx = np.clip(np.searchsorted(edges, points[:, 0], side='right') - 1, 0, max_epochs - 1)
+    sums = np.zeros((len(arrays), max_epochs))
+    counts = np.zeros((len(arrays), max_epochs))
+    np.add.at(sums, (line_idx, bin_idx), points[:, 1])
+    np.add.at(counts, (line_idx, bin_idx), 1)
+    with np.errstate(invalid='ignore'):
+        values = sums / counts  # NaN where a line has no value
+    non_empty = counts.any(axis=0)
+    return ((edges[:-1] + edges[1:]) / 2)[non_empty], values[:, non_empty]
+
+
+def compare_lines(lines: Dict[int, np.ndarray], mode='min', max_epochs: int = 1000) -> dict:
+    """Compute the per-epoch statistics of several lines, and the final and best value of each line.
+
+    mode is 'min' or 'max': whether the best value is the lowest or the highest. The per-epoch statistics are computed
+    on at most max_epochs epochs (see align_on_epochs); the final and best values, on all the points. Returns a dict
+    like:
+        {
+            'epochs': array, 'mean': array, 'min': array, 'max': array, 'count': array,
+            'quantiles': {0.25: array, 0.5: array, 0.75: array},
+            'final': {task_id: value}, 'best': {task_id: value}, 'best_epoch': {task_id: epoch}
+        }
+    Lines without any value are left out of 'final' and 'best'.
+    """
+
+    assert mode in ('min', 'max')
+    lines = {task_id: last_value_per_epoch(a) for task_id, a in lines.items() if len(a) > 0}
+    task_ids = list(lines.keys())
+    epochs, values = align_on_epochs(lines, max_epochs)
+    present = ~np.isnan(values)
+
+    stats = {'epochs': epochs, 'count': present.sum(axis=0)}
+    if len(task_ids) == 0:
+        empty = np.empty(0)
+        stats.update(mean=empty, min=empty, max=empty, quantiles={q: empty for q in quantiles},
+                     final={}, best={}, best_epoch={})
+        return stats
+
+    # Each epoch has at least one value, so there are no all-NaN columns
+    stats['mean'] = np.nanmean(values, axis=0)
+    stats['min'] = np.nanmin(values, axis=0)
+    stats['max'] = np.nanmax(values, axis=0)
+    stats['quantiles'] = dict(zip(quantiles, np.nanquantile(values, quantiles, axis=0)))
+
+    arg_best = np.nanargmin if mode == 'min' else np.nanargmax
+    best_rows = {task_id: a[arg_best(a[:, 1])] for task_id, a in lines.items()}
+    stats['final'] = {task_id: float(a[-1, 1]) for task_id, a in lines.items()}
+    stats['best'] = {task_id: float(row[1]) for task_id, row in best_rows.items()}
+    stats['best_epoch'] = {task_id: float(row[0]) for task_id, row in best_rows.items()}
+    return stats
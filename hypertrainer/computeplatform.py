@@ -1,10 +1,11 @@
 from abc import ABC, abstractmethod
+from typing import List
 
 
 class ComputePlatform(ABC):
     @abstractmethod
     def submit(self, task, resume=False) -> str:
-        """Setup and submit a task and return the plaform specific task id.
+        """Setup and submit a task and return the platform specific task id.
 
         If task.output_path is not already set, this method must set it (and
         make sure the dir is created).
@@ -12,6 +13,14 @@ class ComputePlatform(ABC):
         """
         pass
 
+    def submit_many(self, tasks, resume=False) -> List[str]:
+        """Submit several tasks and return their platform specific ids, in the same order.
+
+        The id of a task whose submission failed is an empty string. Does not save the tasks. Platforms where a
+        round-trip is costly should override this to submit all the tasks at once.
+        """
+        return [self.submit(t, resume=resume) for t in tasks]
+
     @abstractmethod
     def fetch_logs(self, task, keys=None):
         """Return a dict of logs.
@@ -21,9 +30,21 @@ class ComputePlatform(ABC):
             'err': '...',
             'metric_loss': '...'
         }
+
+        Implementations should only transfer the data appended since the last call, and stitch it onto the logs kept
+        in a LogCache (see hypertrainer.logtail). Returns None if the logs could not be fetched (e.g. the worker could
+        not be reached): a dict must only be returned if it holds all the logs of the task.
         """
         pass
 
+    def fetch_logs_many(self, tasks):
+        """Return a dict {task.id: logs} where logs is what fetch_logs(task) would return, or None if the logs of the
+        task could not be fetched (e.g. its worker did not answer in time).
+
+        Platforms where a round-trip is costly should override this to fetch the logs of several tasks at once.
+        """
+        return {t.id: self.fetch_logs(t) for t in tasks}
+
     @abstractmethod
     def cancel(self, task):
         """Cancel a task.
@@ -32,6 +53,13 @@ class ComputePlatform(ABC):
         """
         pass
 
+    def set_priority(self, task, priority: int) -> bool:
+        """Change the priority of a task that is waiting to start. The tasks with a higher priority start first.
+
+        Returns False if the task is not waiting anymore (or if the platform does not queue the tasks).
+        """
+        return False
+
     @abstractmethod
     def update_tasks(self, tasks):
         """Request the platform to update the specified tasks.
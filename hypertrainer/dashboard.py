@@ -1,23 +1,42 @@
 import datetime
+import json
 
 from flask import (
-    Blueprint, render_template, request, flash, redirect, url_for, jsonify, session
+    Blueprint, render_template, request, flash, redirect, url_for, jsonify, session, abort, Response
 )
 
 from hypertrainer import viz
 from hypertrainer.computeplatformtype import ComputePlatformType
-from hypertrainer.task import Task
+from hypertrainer.downsample import lttb
+from hypertrainer.task import Task, TaskSummary
 from hypertrainer.experimentmanager import experiment_manager as em
+from hypertrainer.metricstore import load_metrics, load_metric_range, list_metrics
+from hypertrainer.taskfeed import TaskFeed
 from hypertrainer.utils import get_item_at_path
 
 bp = Blueprint('dashboard', __name__)
 
 
+page_size = 100  # Rows of the task table
+
+
 @bp.route('/')
 def index():
     show_archived = 'show_archived' in session
+    search = request.args.get('q', '')
+    sort = request.args.get('sort', 'id')
+    if sort not in em.task_sort_columns:
+        abort(400)
+    descending = request.args.get('order', 'desc') == 'desc'
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(1000, max(1, request.args.get('per_page', page_size, type=int)))
+    # Only the visible rows are refreshed, through /events
+    tasks, num_tasks = em.get_task_page(proj=session.get('project'), archived=show_archived, search=search, sort=sort,
+                                        descending=descending, page=page, page_size=per_page)
+    num_pages = max(1, -(-num_tasks // per_page))
     return render_template('index.html',
-                           tasks=em.get_tasks(proj=session.get('project'), archived=show_archived),
+                           tasks=tasks, num_tasks=num_tasks, page=page, num_pages=num_pages, per_page=per_page,
+                           search=search, sort=sort, descending=descending,
                            platforms=em.list_platforms(as_str=True), projects=em.list_projects(),
                            cur_proj=session.get('project'),
                            show_archived=show_archived)
@@ -46,6 +65,12 @@ def perform_action():
         elif a == 'Resume':
             em.resume_tasks(em.get_tasks_by_id(task_ids))
             flash('Resubmitted task(s) {}.'.format(', '.join(task_ids)))
+        elif a == 'Priority':
+            priority = request.form.get('priority', 0, type=int)
+            changed_ids = em.set_tasks_priority(task_ids, priority)
+            flash('Set the priority of task(s) {} to {}.'.format(', '.join(map(str, changed_ids)) or 'none', priority))
+            if len(changed_ids) < len(task_ids):
+                flash('Only the priority of waiting tasks can be changed.', 'warning')
         else:
             raise NotImplementedError
     elif action == 'chooseproject':
@@ -65,17 +90,77 @@ def perform_action():
 @bp.route('/monitor/<task_id>')
 def monitor(task_id):
     task = Task.get(Task.id == task_id)
-    em.monitor(task)
+    em.monitor_many([task])  # The plots are shown from the metric store even if the logs could not be fetched
     selected_log = 'out' if 'out' in task.logs else 'yaml'
 
     viz_scripts, viz_divs = None, None
-    if len(task.metrics) > 0:
-        viz_scripts, viz_divs = viz.generate_plots(task.metrics)
+    metrics = load_metrics([task.id])[task.id]
+    if len(metrics) > 0:
+        max_points = request.args.get('max_points', viz.default_max_points, type=int)
+        viz_scripts, viz_divs = viz.generate_plots(metrics, max_points,
+                                                   zoom_url=url_for('dashboard.metric_points', task_id=task.id))
 
     return render_template('monitor.html', task=task, selected_log=selected_log,
                            viz_scripts=viz_scripts, viz_divs=viz_divs)
 
 
+@bp.route('/metric_points/<int:task_id>')
+def metric_points(task_id):
+    """The points of one line of a metric in the range [x_start, x_end], at full resolution (up to max_points)"""
+
+    data = load_metric_range(task_id, request.args['metric'], request.args.get('label', ''),
+                             request.args.get('x_start', float('-inf'), type=float),
+                             request.args.get('x_end', float('inf'), type=float))
+    data = lttb(data, request.args.get('max_points', viz.default_max_points, type=int))
+    return jsonify(x=data[:, 0].tolist(), y=data[:, 1].tolist())
+
+
+@bp.route('/compare')
+def compare():
+    """Compare a metric across the tasks ?ids=1,2,3 (by default, the first metric stored for them)"""
+
+    task_ids, metric, label, mode = _get_comparison_args()
+    metrics = list_metrics(task_ids)
+    if metric is None and len(metrics) > 0:
+        metric, label = metrics[0]
+
+    viz_script, viz_div, rows = None, None, []
+    if metric is not None:
+        lines, stats = em.compare_metric(task_ids, metric, label, mode)
+        title = metric if label == '' else f'{metric} ({label})'
+        viz_script, viz_div = viz.generate_comparison_plot(title, lines, stats)
+        names = dict(Task.select(Task.id, Task.name).where(Task.id.in_(task_ids)).tuples())
+        rows = [dict(id=i, name=names.get(i, ''), final=stats['final'][i], best=stats['best'][i],
+                     best_epoch=stats['best_epoch'][i])
+                for i in stats['best']]
+        rows.sort(key=lambda r: r['best'], reverse=(mode == 'max'))
+
+    return render_template('compare.html', task_ids=task_ids, metrics=metrics, metric=metric, label=label, mode=mode,
+                           viz_script=viz_script, viz_div=viz_div, rows=rows)
+
+
+@bp.route('/compare/data')
+def compare_data():
+    """The per-epoch statistics and the final and best values of a metric across the tasks ?ids=1,2,3"""
+
+    task_ids, metric, label, mode = _get_comparison_args()
+    if metric is None:
+        abort(400)
+    _, stats = em.compare_metric(task_ids, metric, label, mode)
+    return jsonify(epochs=stats['epochs'].tolist(), count=stats['count'].tolist(), mean=stats['mean'].tolist(),
+                   min=stats['min'].tolist(), max=stats['max'].tolist(),
+                   quantiles={str(q): v.tolist() for q, v in stats['quantiles'].items()},
+                   final=stats['final'], best=stats['best'], best_epoch=stats['best_epoch'])
+
+
+def _get_comparison_args():
+    task_ids = _get_task_ids_arg() or []
+    mode = request.args.get('mode', 'min')
+    if mode not in ('min', 'max'):
+        abort(400)
+    return task_ids, request.args.get('metric'), request.args.get('label', ''), mode
+
+
 @bp.route('/enum')
 def enum_platforms():
     return jsonify(em.list_platforms(as_str=True))
@@ -83,31 +168,73 @@ def enum_platforms():
 
 @bp.route('/update/<platform>')
 def update(platform):
+    snapshot = em.get_task_snapshot(ComputePlatformType(platform), proj=session.get('project'),
+                                    task_ids=_get_task_ids_arg())
+    return jsonify({t.id: _format_row(t) for t in snapshot.value})
+
+
+def _refresh_rows(task_ids):
+    return {t.id: (t.project, _format_row(t)) for t in em.get_task_snapshot(task_ids=task_ids).value}
+
+
+task_feed = TaskFeed(_refresh_rows)
+
+
+@bp.route('/events')
+def events():
+    """Server-sent events: the rows of the task table that changed, as {task_id: row}. See TaskFeed.
+
+    Only the tasks ?ids=1,2,3 are refreshed, if specified.
+    """
+
+    subscription = task_feed.subscribe(project=session.get('project'), task_ids=_get_task_ids_arg())
+
+    def stream():
+        try:
+            while True:
+                rows = subscription.pop(timeout=TaskFeed.keepalive_secs)
+                if len(rows) > 0:
+                    yield f'data: {json.dumps(rows)}\n\n'
+                else:
+                    yield ': keepalive\n\n'  # Writing fails once the client is gone
+        finally:
+            task_feed.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _get_task_ids_arg():
+    if 'ids' not in request.args:
+        return None
+    return [int(i) for i in request.args['ids'].split(',') if i != '']
+
+
+def _format_row(t: TaskSummary) -> dict:
     def format_time_delta(seconds):
         if seconds is None:
             return ''
         else:
             return str(datetime.timedelta(seconds=int(seconds)))
 
-    tasks = em.get_tasks(ComputePlatformType(platform), proj=session.get('project'))
-    data = {}
-    for t in tasks:
-        data[t.id] = {
-            'status': t.status.value,
-            'epoch': t.cur_epoch,
-            'total_epochs': get_item_at_path(t.config, 'training.num_epochs', default=None),
-            'iter': f'{t.cur_phase} {t.cur_iter + 1} / {t.iter_per_epoch}',
-            'ep_time_remain': format_time_delta(t.ep_time_remain),
-            'total_time_remain': format_time_delta(t.total_time_remain)
-        }
-    return jsonify(data)
+    phase = '' if t.cur_phase is None else t.cur_phase + ' '
+    return {
+        'status': t.status.value,
+        'epoch': t.cur_epoch,
+        'total_epochs': get_item_at_path(t.config, 'training.num_epochs', default=None),
+        'iter': f'{phase}{t.cur_iter + 1} / {t.iter_per_epoch}',
+        'ep_time_remain': format_time_delta(t.ep_time_remain),
+        'total_time_remain': format_time_delta(t.total_time_remain),
+        'stale': t.is_stale
+    }
 
 
 def submit():
     platform = request.form['platform']
     config_file = request.form['config']
     project = request.form['project']
-    em.create_tasks(platform, config_file, project=project)
+    priority = request.form.get('priority', 0, type=int)
+    em.create_tasks(platform, config_file, project=project, priority=priority)
     flash('Submitted "{}" on {}.'.format(config_file, platform), 'success')
     return redirect(url_for('index'))
 
@@ -1,24 +1,36 @@
 from pathlib import Path
 
-from peewee import SqliteDatabase, Model, Field
+from peewee import SqliteDatabase, Model, Field, FieldAccessor
+from playhouse.migrate import SqliteMigrator, migrate
 import click
 from flask import g, current_app
 from flask.cli import with_appcontext
 
-from hypertrainer.utils import yaml, yaml_to_str, hypertrainer_home, TestState
+from hypertrainer.utils import yaml_to_str, hypertrainer_home, TestState, load_yaml
 
 
+# WAL lets the dashboard read while the monitoring writes. With WAL, synchronous=NORMAL is still safe from corruption
+# (a power loss can only roll back the last transactions).
+pragmas = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -32 * 1024,  # In KiB
+    'mmap_size': 256 * 1024 ** 2,
+    'temp_store': 'memory',
+}
+
 if TestState.test_mode:
     db_file = Path('/tmp/dummy_ht_db.sqlite')
-    try:
-        db_file.unlink()
-    except IOError:
-        pass
+    for f in (db_file, Path(str(db_file) + '-wal'), Path(str(db_file) + '-shm')):
+        try:
+            f.unlink()
+        except IOError:
+            pass
 
-    database = SqliteDatabase(str(db_file))
+    database = SqliteDatabase(str(db_file), pragmas=pragmas)
 else:
     db_file = hypertrainer_home / 'db.sqlite'
-    database = SqliteDatabase(str(db_file))
+    database = SqliteDatabase(str(db_file), pragmas=pragmas)
 
 
 def init_app(app):
@@ -66,18 +78,112 @@ class EnumField(Field):
         return self.enum_type(value)
 
 
+class YamlText(str):
+    """The yaml text of a YamlField, as loaded from the db, not parsed yet"""
+    pass
+
+
+class YamlFieldAccessor(FieldAccessor):
+    """Parses the yaml text of a YamlField on first access"""
+
+    def __get__(self, instance, instance_type=None):
+        value = super().__get__(instance, instance_type)
+        if isinstance(value, YamlText):
+            value = load_yaml(value)
+            instance.__data__[self.name] = value  # Not a modification: do not mark as dirty
+        return value
+
+
 class YamlField(Field):
+    """Stores a yaml object (e.g. a config) as text.
+
+    The text is parsed lazily, when the attribute is accessed on a model instance. This is because parsing is slow,
+    and most queries do not need it. Note that queries returning dicts or tuples give the unparsed YamlText.
+    """
+
+    accessor_class = YamlFieldAccessor
+
     def db_value(self, value):
+        if isinstance(value, YamlText):
+            return str(value)  # Never parsed, thus never modified
         return yaml_to_str(value)
 
     def python_value(self, value):
-        return yaml.load(value)
+        return YamlText(value)
 
 
-def init_db():
-    from hypertrainer.task import Task
+def _add_task_indexes(db, migrator):
+    # Indexes matching the queries of ExperimentManager.get_tasks() and update_tasks()
+    migrate(
+        migrator.add_index('task', ('is_archived', 'platform_type', 'project')),
+        migrator.add_index('task', ('platform_type', 'status')),
+        migrator.add_index('task', ('project',)),
+    )
+    db.execute_sql('ANALYZE')
+
+
+def _add_config_blobs(db, migrator):
+    # Configs shared by several tasks; existing tasks keep their whole config in task.config
+    db.execute_sql('CREATE TABLE "configblob" ("hash" VARCHAR(255) NOT NULL PRIMARY KEY, "text" TEXT NOT NULL)')
+    db.execute_sql('ALTER TABLE "task" ADD COLUMN "config_base_id" VARCHAR(255) REFERENCES "configblob" ("hash")')
+    migrate(migrator.add_index('task', ('config_base_id',)))
+
 
-    database.create_tables([Task])
+def _add_metric_points(db, migrator):
+    db.execute_sql('CREATE TABLE "metricpoint" ("id" INTEGER NOT NULL PRIMARY KEY, "task_id" INTEGER NOT NULL, '
+                   '"metric" VARCHAR(255) NOT NULL, "label" VARCHAR(255) NOT NULL, "epoch" REAL NOT NULL, '
+                   '"value" REAL NOT NULL)')
+    migrate(migrator.add_index('metricpoint', ('task_id', 'metric')))
+
+
+def _add_task_search(db, migrator):
+    db.execute_sql('CREATE VIRTUAL TABLE "tasksearch" USING fts5 ("name", "project", "config")')
+    db.execute_sql('INSERT INTO "tasksearch" ("rowid", "name", "project", "config") '
+                   'SELECT t."id", t."name", t."project", t."config" || char(10) || coalesce(b."text", \'\') '
+                   'FROM "task" AS t LEFT JOIN "configblob" AS b ON b."hash" = t."config_base_id"')
+    migrate(
+        migrator.add_index('task', ('is_archived', 'name')),
+        migrator.add_index('task', ('is_archived', 'status')),
+    )
+    db.execute_sql('ANALYZE')
+
+
+def _add_task_priority(db, migrator):
+    db.execute_sql('ALTER TABLE "task" ADD COLUMN "priority" INTEGER NOT NULL DEFAULT 0')
+
+
+# Each migration upgrades the schema from version i to version i + 1. The version of a db file is stored in its
+# user_version pragma. Never modify a migration that was released: append a new one instead.
+migrations = [
+    _add_task_indexes,
+    _add_config_blobs,
+    _add_metric_points,
+    _add_task_search,
+    _add_task_priority,
+]
+
+
+def migrate_db(db=database):
+    """Upgrade the schema of an existing db to the latest version"""
+
+    migrator = SqliteMigrator(db)
+    version = db.user_version
+    for i in range(version, len(migrations)):
+        with db.atomic():
+            migrations[i](db, migrator)
+            db.user_version = i + 1
+
+
+def init_db():
+    from hypertrainer.task import Task, ConfigBlob, TaskSearch
+    from hypertrainer.metricstore import MetricPoint
+
+    if database.table_exists(Task._meta.table_name):
+        migrate_db(database)
+    else:
+        with database.atomic():
+            database.create_tables([ConfigBlob, Task, TaskSearch, MetricPoint])  # Creates the latest schema directly
+            database.user_version = len(migrations)
 
 
 @click.command('init-db')
@@ -0,0 +1,30 @@
+import numpy as np
+
+
+def lttb(data: np.ndarray, num_out: int) -> np.ndarray:
+    """Downsample a line with the Largest-Triangle-Three-Buckets algorithm, which preserves its visual shape.
+
+    `data` is an array of (x, y) rows, sorted by x. The first and last points are kept, and the others are split in
+    num_out - 2 buckets. In each bucket, the point kept is the one forming the largest triangle with the point kept in
+    the previous bucket and the mean of the next bucket.
+    """
+
+    n = len(data)
+    if num_out >= n or num_out < 3:
+        return data
+
+    edges = np.linspace(1, n - 1, num_out - 1).astype(int)  # The buckets are data[edges[i]:edges[i + 1]]
+    bucket_means = np.add.reduceat(data[1:-1], edges[:-1] - 1) / np.diff(edges)[:, None]
+    next_means = np.concatenate([bucket_means[1:], data[-1:]])
+
+    out = np.empty((num_out, 2))
+    out[0], out[-1] = data[0], data[-1]
+    a = data[0]
+    for i in range(num_out - 2):
+        bucket = data[edges[i]:edges[i + 1]]
+        c = next_means[i]
+        # Twice the areas of the triangles (a, b, c) for each point b of the bucket
+        areas = np.abs((a[0] - c[0]) * (bucket[:, 1] - a[1]) - (a[0] - bucket[:, 0]) * (c[1] - a[1]))
+        a = bucket[np.argmax(areas)]
+        out[i + 1] = a
+    return out
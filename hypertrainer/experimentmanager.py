@@ -1,18 +1,28 @@
-import csv
+import threading
 import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from enum import Enum
 from pathlib import Path
-from typing import Iterable, Optional, List
+from typing import Iterable, Optional, List, Tuple
+from uuid import UUID
 
 from tabulate import tabulate
 from termcolor import colored
 
 from hypertrainer.computeplatform import ComputePlatform
 from hypertrainer.computeplatformtype import ComputePlatformType
-from hypertrainer.db import init_db
+from hypertrainer.db import init_db, database
+from hypertrainer.export import task_columns, flatten, summarize_metrics, ColumnTypes, CsvTableWriter, \
+    ParquetTableWriter
 from hypertrainer.hpsearch import generate as generate_hpsearch
 from hypertrainer.htplatform import HtPlatform, ConnectionError
 from hypertrainer.localplatform import LocalPlatform
-from hypertrainer.task import Task
+from hypertrainer.logparser import LogInterpreter
+from hypertrainer.snapshotcache import SnapshotCache, Snapshot
+from hypertrainer.compare import compare_lines
+from hypertrainer.metricstore import save_new_points, load_metric_summaries, delete_metrics, load_metric_lines
+from hypertrainer.task import Task, TaskSummary, ConfigBlob, TaskSearch, load_shared_config
 from hypertrainer.utils import yaml, print_yaml, TaskStatus, TestState
 
 
@@ -21,6 +31,14 @@ class ExperimentManager:
 
     platform_instances = None
 
+    monitor_deadline_secs = 5  # Tasks whose logs could not be fetched in time are marked as stale
+    max_monitor_threads = 16
+    export_batch_size = 1000  # Number of tasks read and written at once by the exports
+    snapshot_ttl_secs = 2  # The task snapshots are refreshed at most this often, however many callers ask for them
+    max_snapshots = 64  # Task snapshots kept (e.g. one per page of the task list); the least recently used are dropped
+    task_sort_columns = {'id': Task.id, 'name': Task.name, 'platform': Task.platform_type, 'host': Task.hostname,
+                         'status': Task.status, 'epoch': Task.cur_epoch, 'priority': Task.priority}
+
     def __init__(self):
         if ExperimentManager._instantiated:
             raise Exception('ExperimentManager should not be instantiated manually. Use experiment_manager.')
@@ -38,10 +56,18 @@ class ExperimentManager:
             except ConnectionError:
                 print('WARNING: Could not instantiate HtPlatform. Is redis-server running?')
 
+        self._monitor_executor = ThreadPoolExecutor(max_workers=self.max_monitor_threads,
+                                                    thread_name_prefix='monitor')
+        self._groups_in_flight = {}  # {(platform, hostname): [(future logs, ids of the tasks being fetched)]}
+        self._groups_lock = threading.Lock()
+        self._snapshots = SnapshotCache(self._load_task_snapshot, ttl_secs=self.snapshot_ttl_secs,
+                                        max_entries=self.max_snapshots)
+
     def get_tasks(self, platform: Optional[ComputePlatformType] = None,
                   proj: Optional[str] = None,
                   archived=False,
                   descending_order=True,
+                  monitor_deadline_secs: Optional[float] = None
                   ) -> List[Task]:
         # TODO rename this function? Maybe get_filtered_tasks?
 
@@ -50,6 +76,96 @@ class ExperimentManager:
         self.update_tasks(platforms=p_list)  # TODO return tasks to avoid other db query?
 
         # Get the records
+        tasks = list(self._select_tasks(platform, proj, archived, descending_order))
+
+        # Get the logs
+        self.monitor_many(tasks, deadline_secs=monitor_deadline_secs)
+        return tasks
+
+    def get_task_summaries(self, platform: Optional[ComputePlatformType] = None,
+                           proj: Optional[str] = None,
+                           archived=False,
+                           descending_order=True,
+                           refresh=True,
+                           monitor_deadline_secs: Optional[float] = None,
+                           task_ids: Optional[Iterable[int]] = None
+                           ) -> List[TaskSummary]:
+        """Like get_tasks(), but return lightweight TaskSummary records, for listing tasks.
+
+        If refresh=True, the status of the active tasks is updated, and they are monitored (but not the inactive ones).
+        If task_ids is specified, only these tasks are selected (and refreshed).
+        """
+
+        updated_tasks = []
+        if refresh:
+            p_list = [platform] if platform is not None else None
+            updated_tasks = self.update_tasks(platforms=p_list, task_ids=task_ids)
+
+        query = self._select_tasks(platform, proj, archived, descending_order)
+        if task_ids is not None:
+            query = query.where(Task.id.in_(list(task_ids)))
+        summaries = TaskSummary.from_query(query)
+
+        if refresh:
+            summaries_by_id = {s.id: s for s in summaries}
+            tasks = [t for t in updated_tasks if t.id in summaries_by_id]
+            self.monitor_many(tasks, deadline_secs=monitor_deadline_secs)
+            for t in tasks:
+                summaries_by_id[t.id].update_from_task(t)
+        return summaries
+
+    def get_task_snapshot(self, platform: Optional[ComputePlatformType] = None,
+                          proj: Optional[str] = None,
+                          archived=False,
+                          task_ids: Optional[Iterable[int]] = None,
+                          max_age_secs: Optional[float] = None,
+                          wait=True
+                          ) -> Optional[Snapshot]:
+        """Return a snapshot of the refreshed task summaries (as in get_task_summaries()), with its age.
+
+        The snapshots are shared by all the callers, and cached per platform, project, archived flag and task ids. If
+        the snapshot is older than max_age_secs (by default, snapshot_ttl_secs), it is refreshed; callers asking at the
+        same time wait for the same refresh. If wait=False, the latest snapshot is returned right away (None if there is
+        none yet), and refreshed in the background if it is older than snapshot_ttl_secs.
+        The summaries in `snapshot.value` must not be modified.
+        """
+
+        key = (platform, proj, archived, None if task_ids is None else frozenset(task_ids))
+        if wait:
+            return self._snapshots.get(key, max_age_secs)
+        else:
+            return self._snapshots.get_latest(key)
+
+    def _load_task_snapshot(self, key) -> List[TaskSummary]:
+        platform, proj, archived, task_ids = key
+        return self.get_task_summaries(platform, proj, archived, task_ids=task_ids)
+
+    def get_task_page(self, proj: Optional[str] = None,
+                      archived=False,
+                      search='',
+                      sort='id',
+                      descending=True,
+                      page=1,
+                      page_size=100
+                      ) -> Tuple[List[TaskSummary], int]:
+        """Return one page of the task summaries, and the number of tasks matching (on all the pages).
+
+        The tasks are searched by name, project and config (see TaskSearch.make_query), and sorted by one of the
+        task_sort_columns. The summaries are not refreshed; see get_task_snapshot(task_ids=...).
+        """
+
+        query = self._select_tasks(None, proj, archived, descending_order=False)
+        match = TaskSearch.make_query(search)
+        if match is not None:
+            query = query.where(Task.id.in_(TaskSearch.select(TaskSearch.rowid).where(TaskSearch.match(match))))
+        total = query.count()
+        order = [self.task_sort_columns[sort], Task.id] if sort != 'id' else [Task.id]
+        query = query.order_by(*[c.desc() if descending else c.asc() for c in order]).paginate(page, page_size)
+        return TaskSummary.from_query(query), total
+
+    @staticmethod
+    def _select_tasks(platform: Optional[ComputePlatformType], proj: Optional[str], archived: bool,
+                      descending_order: bool):
         if platform is None:
             q = Task.select().where(Task.is_archived == archived)
         else:
@@ -58,30 +174,35 @@ class ExperimentManager:
             q = q.where(Task.project == proj)
         if descending_order:
             q = q.order_by(Task.id.desc())
-        tasks = list(q)
+        return q
 
-        # Get the logs
-        for t in tasks:
-            try:
-                self.monitor(t)
-            except TimeoutError:
-                t.logs = {'err': 'Timed out'}
-        return tasks
+    def update_tasks(self, platforms: list = None, task_ids: Optional[Iterable[int]] = None) -> List[Task]:
+        """Update the active tasks of the platforms (e.g. status). Returns the tasks that were active.
+
+        If task_ids is specified, only these tasks are updated.
+        """
 
-    def update_tasks(self, platforms: list = None):
         if platforms is None:
             platforms = self.list_platforms()
+        updated_tasks = []
         for ptype in platforms:
             platform = self.platform_instances[ptype]
-            tasks = list(Task.select().where((Task.platform_type == ptype)
-                                             & (Task.status.in_(TaskStatus.active_states()))))
+            query = Task.select().where((Task.platform_type == ptype) & (Task.status.in_(TaskStatus.active_states())))
+            if task_ids is not None:
+                query = query.where(Task.id.in_(list(task_ids)))
+            tasks = list(query)
             if len(tasks) == 0:
                 continue
             platform.update_tasks(tasks)
-            Task.bulk_update(tasks, Task.get_fields())  # FIXME updating all records everytime is heavy
+            Task.bulk_save_changes(tasks)  # Only the modified fields of the modified tasks
+            updated_tasks += tasks
+        return updated_tasks
 
-    def create_tasks(self, platform: str, config_file: str, project: str = ''):
-        """Create and submit tasks to the specified platform according to the config yaml file"""
+    def create_tasks(self, platform: str, config_file: str, project: str = '', priority: int = 0):
+        """Create and submit tasks to the specified platform according to the config yaml file.
+
+        The tasks with a higher priority start first, on the platforms that queue them.
+        """
 
         # Load yaml config
         config_file_path = Path(config_file)
@@ -96,24 +217,46 @@ class ExperimentManager:
         # Make tasks
         tasks = []
         ptype = ComputePlatformType(platform)
-        for name, config in configs.items():
-            t = Task(uuid=uuid.uuid4(),
-                     project_path=str(config_file_path.parent.absolute()),
-                     config=config,
-                     name=name,
-                     platform_type=ptype,
-                     project=project,
-                     status=TaskStatus.Waiting)
-            t.save()  # insert in database
-            tasks.append(t)
+        with database.atomic():
+            # The config file is stored once; each task only stores how its config differs
+            config_base = ConfigBlob.store(yaml_config)
+            for name, config in configs.items():
+                t = Task(uuid=uuid.uuid4(),
+                         project_path=str(config_file_path.parent.absolute()),
+                         config=config,
+                         config_base=config_base,
+                         name=name,
+                         platform_type=ptype,
+                         project=project,
+                         priority=priority,
+                         status=TaskStatus.Waiting)
+                tasks.append(t)
+            Task.bulk_insert(tasks)  # The tasks need an id before being submitted
         # Submit tasks
-        for t in tasks:
-            self._submit_task(t)  # TODO submit in batch to server!
+        self._submit_tasks(tasks)
+        Task.bulk_save_changes(tasks)
+        TaskSearch.index_tasks([t.id for t in tasks])  # Once the output path is in the config
+        self._snapshots.invalidate()
         return tasks
 
-    def _submit_task(self, task: Task):
-        task.job_id = self.get_platform(task).submit(task)
-        task.post_submit()
+    def _submit_tasks(self, tasks: List[Task], resume=False) -> List[Task]:
+        """Submit the tasks in one batch per platform. The tasks are not saved.
+
+        The tasks that could not be submitted get the status RunFailed, and are returned.
+        """
+
+        failed = []
+        tasks_by_platform = defaultdict(list)
+        for t in tasks:
+            tasks_by_platform[t.platform_type].append(t)
+        for platform_tasks in tasks_by_platform.values():
+            job_ids = self.get_platform(platform_tasks[0]).submit_many(platform_tasks, resume=resume)
+            for t, job_id in zip(platform_tasks, job_ids):
+                t.job_id = job_id
+                if job_id == '':
+                    t.status = TaskStatus.RunFailed
+                    failed.append(t)
+        return failed
 
     def get_tasks_by_id(self, task_ids: List[int]):
         """Get the tasks records from the db"""
@@ -125,10 +268,14 @@ class ExperimentManager:
 
         Resume the tasks from where they left off, if possible.
         """
+        tasks = [t for t in tasks if not t.status.is_active]
+        failed = self._submit_tasks(tasks, resume=True)
         for t in tasks:
-            if not t.status.is_active:
-                t.job_id = self.get_platform(t).submit(t, resume=True)  # TODO one bulk ssh command
-                t.post_resume()
+            if t not in failed:
+                t.status = TaskStatus.Unknown
+        Task.bulk_save_changes(tasks)
+        TaskSearch.index_tasks([t.id for t in tasks])
+        self._snapshots.invalidate()
 
     def resume_tasks_by_id(self, task_ids: List[int]):
         """Resume the non-active tasks.
@@ -146,6 +293,7 @@ class ExperimentManager:
             if t.status.is_active:
                 self.get_platform(t).cancel(t)  # TODO one bulk ssh command
                 t.post_cancel()
+        self._snapshots.invalidate()
 
     def cancel_tasks_by_id(self, task_ids: List[int]):
         """Cancel the tasks
@@ -154,10 +302,89 @@ class ExperimentManager:
         """
         self.cancel_tasks(self.get_tasks_by_id(task_ids))
 
+    def set_tasks_priority(self, task_ids: List[int], priority: int) -> List[int]:
+        """Change the priority of the tasks that are still waiting to start. Returns the ids of these tasks."""
+
+        tasks = [t for t in self.get_tasks_by_id(task_ids) if t.status == TaskStatus.Waiting]
+        changed = [t for t in tasks if self.get_platform(t).set_priority(t, priority)]
+        for t in changed:
+            t.priority = priority
+        Task.bulk_save_changes(changed)
+        self._snapshots.invalidate()
+        return [t.id for t in changed]
+
     def monitor(self, t: Task):
         # TODO rename this method 'update' or something?
-        t.logs = self.get_platform(t).fetch_logs(t)
+        logs = self.get_platform(t).fetch_logs(t)
+        if logs is None:
+            t.is_stale = True  # The logs could not be fetched; the state of their interpreter is kept
+            return
+        t.logs = logs
         t.interpret_logs()
+        save_new_points([t.id])
+
+    def monitor_many(self, tasks: List[Task], deadline_secs: Optional[float] = None):
+        """Monitor several tasks concurrently.
+
+        The tasks are grouped by platform and worker hostname. The groups are fetched in parallel, each with one call to
+        `ComputePlatform.fetch_logs_many()`, so that a slow worker only delays its own tasks. The requests already in
+        flight for a worker (e.g. made by another caller) are joined, and its other tasks are fetched after them. The
+        tasks whose logs could not be fetched (the worker did not answer in time, or not before `deadline_secs`) are
+        marked as stale (`task.is_stale`), keep empty logs, and are not interpreted.
+        The new metric points are appended to the metric store.
+        """
+
+        if deadline_secs is None:
+            deadline_secs = self.monitor_deadline_secs
+
+        groups = defaultdict(list)
+        for t in tasks:
+            groups[(t.platform_type, t.hostname)].append(t)
+
+        def fetch_group(group_key, group, task_ids, previous):
+            if previous is not None:
+                wait([previous])  # One request at a time per worker
+            try:
+                return self.get_platform(group[0]).fetch_logs_many(group)
+            except TimeoutError:
+                return {t.id: None for t in group}
+            finally:
+                with self._groups_lock:
+                    in_flight = self._groups_in_flight[group_key]
+                    in_flight[:] = [(f, ids) for f, ids in in_flight if ids is not task_ids]
+                    if not in_flight:
+                        del self._groups_in_flight[group_key]
+
+        futures = []
+        with self._groups_lock:
+            for group_key, group in groups.items():
+                # Join the requests already in flight for the worker (do not pile up requests on a slow worker), then
+                # fetch the remaining tasks after them
+                in_flight = self._groups_in_flight.setdefault(group_key, [])
+                for future, task_ids in in_flight:
+                    if any(t.id in task_ids for t in group):
+                        futures.append(future)
+                        group = [t for t in group if t.id not in task_ids]
+                if not group:
+                    continue
+                task_ids = {t.id for t in group}
+                previous = in_flight[-1][0] if in_flight else None
+                future = self._monitor_executor.submit(fetch_group, group_key, group, task_ids, previous)
+                in_flight.append((future, task_ids))
+                futures.append(future)
+        done, _ = wait(futures, timeout=deadline_secs)
+        fetched_logs = {}
+        for f in done:
+            fetched_logs.update(f.result())  # Raise the exception, if any
+
+        for t in tasks:
+            logs = fetched_logs.get(t.id)
+            if logs is None:
+                t.is_stale = True
+            else:
+                t.logs = logs
+                t.interpret_logs()
+        save_new_points([t.id for t in tasks if not t.is_stale])
 
     def archive_tasks_by_id(self, task_ids: List[int]):
         """Archive the tasks
@@ -166,6 +393,7 @@ class ExperimentManager:
         """
 
         Task.update(is_archived=True).where(Task.id.in_(task_ids)).execute()
+        self._snapshots.invalidate()
 
     def unarchive_tasks_by_id(self, task_ids: List[int]):
         """Unarchive the tasks
@@ -174,6 +402,7 @@ class ExperimentManager:
         """
 
         Task.update(is_archived=False).where(Task.id.in_(task_ids)).execute()
+        self._snapshots.invalidate()
 
     def delete_tasks_by_id(self, task_ids: List[int]):
         """Delete all traces of the tasks
@@ -187,9 +416,26 @@ class ExperimentManager:
         # Ask the platform to delete each task (on the corresponding worker)
         for t in Task.select().where(Task.id.in_(task_ids)):
             self.get_platform(t).delete(t)
+            LogInterpreter.forget_task(t.id)
 
         # Delete the task from the server database
-        Task.delete().where(Task.id.in_(task_ids)).execute()
+        with database.atomic():
+            Task.delete().where(Task.id.in_(task_ids)).execute()
+            ConfigBlob.delete_orphans()
+            TaskSearch.unindex_tasks(task_ids)
+            delete_metrics(task_ids)
+        self._snapshots.invalidate()
+
+    def compare_metric(self, task_ids: List[int], metric: str, label: str = '', mode='min'):
+        """Compare a metric across several tasks (e.g. the trials of an hpsearch).
+
+        The values are only read from the metric store, which is kept up to date by the monitoring of the tasks: the
+        logs are not fetched. Returns a tuple (lines, stats): lines is a dict {task_id: array of (epoch, value) rows},
+        and stats is computed by `compare.compare_lines()`.
+        """
+
+        lines = load_metric_lines(task_ids, metric, label)
+        return lines, compare_lines(lines, mode)
 
     def list_projects(self):
         return [t.project for t in Task.select(Task.project).where(Task.project != '').distinct()]
@@ -215,7 +461,7 @@ class ExperimentManager:
     def print_tasks(self, **kwargs):
         """Print a table of the non-archived tasks"""
 
-        tasks = self.get_tasks(descending_order=False, **kwargs)
+        tasks = self.get_task_snapshot(**kwargs).value[::-1]  # Oldest first
         table = [[t.id,
                   t.short_uuid,  # Only show the first part of the UUID
                   t.platform_type.abbrev,
@@ -252,23 +498,78 @@ class ExperimentManager:
         print(logs.get('err', '`err` log does not exist'))
         print(colored('--- End log `err` -----', attrs=['bold']))
 
-    def export_csv(self, filename):
-        """Export the Task database as csv"""
+    def export_csv(self, filename, with_metrics=True, refresh_metrics=False):
+        """Export the tasks as csv, with one column per config leaf and per metric summary (see export_table)"""
+        self.export_table(filename, CsvTableWriter, with_metrics, refresh_metrics)
+
+    def export_parquet(self, filename, with_metrics=True, refresh_metrics=False):
+        """Export the tasks as Parquet, with one typed column per config leaf and per metric summary (see export_table).
+
+        Requires pyarrow. The file can be loaded with `pandas.read_parquet(filename)`.
+        """
+        self.export_table(filename, ParquetTableWriter, with_metrics, refresh_metrics)
+
+    def export_table(self, filename, writer_class, with_metrics=True, refresh_metrics=False):
+        """Export the tasks as a table, with one row per task.
+
+        Each config leaf becomes a column (e.g. `config.training.lr`). If with_metrics=True, the final, min and max
+        values of each metric are added (e.g. `metric.loss.min`), as summarized by the metric store. The platforms are
+        not contacted, unless refresh_metrics=True: then the active tasks are monitored first.
+        The tasks are read and written in batches: a first pass infers the columns and their types, a second one
+        writes the rows.
+        """
 
         filepath = Path(filename)
         if filepath.exists():
             raise FileExistsError
 
-        with filepath.open('w', newline='') as csvfile:
-            csv_writer = csv.writer(csvfile)
-
-            # Write header
-            field_names = next(Task.select().dicts().iterator()).keys()
-            csv_writer.writerow(field_names)
-
-            # Write data
-            for task_tuple in Task.select().tuples().iterator():
-                csv_writer.writerow(task_tuple)
+        column_types = ColumnTypes()
+        metric_types = ColumnTypes()
+        metrics = {}  # The metric summaries are small, they are kept between the passes
+        for rows in self._iter_export_rows():
+            for row in rows:
+                column_types.update(row)
+            if with_metrics:
+                task_ids = [row['id'] for row in rows]
+                if refresh_metrics:
+                    self.monitor_many(list(Task.select().where(
+                        Task.id.in_(task_ids) & Task.status.in_(list(TaskStatus.active_states())))))
+                for task_id, summaries in load_metric_summaries(task_ids).items():
+                    metrics[task_id] = summarize_metrics(summaries)
+                    metric_types.update(metrics[task_id])
+        column_types.types.update(metric_types.types)  # The metric columns come last
+
+        writer = writer_class(filepath, column_types)
+        try:
+            for rows in self._iter_export_rows():
+                writer.write([{**row, **metrics.get(row['id'], {})} for row in rows])
+        finally:
+            writer.close()
+
+    def _iter_export_rows(self):
+        """Yield the tasks by batches of rows, with the flattened config"""
+
+        fields = [getattr(Task, c) for c in task_columns] + [Task.config_data, Task.config_base]
+        for batch in self._select_in_batches(Task.select(*fields)):
+            rows = []
+            for d in batch:
+                config = load_shared_config(d.pop('config_data'), d.pop('config_base'))
+                row = {k: v.value if isinstance(v, Enum) else str(v) if isinstance(v, UUID) else v
+                       for k, v in d.items()}
+                row.update(flatten(config or {}, 'config'))
+                rows.append(row)
+            yield rows
+
+    def _select_in_batches(self, query):
+        """Yield the rows of a Task query as batches of dicts, paginated by id"""
+
+        last_id = 0
+        while True:
+            batch = list(query.where(Task.id > last_id).order_by(Task.id).limit(self.export_batch_size).dicts())
+            if len(batch) == 0:
+                return
+            last_id = batch[-1]['id']
+            yield batch
 
     def export_yaml(self, filename):
         """Export the Task database as yaml"""
@@ -277,10 +578,16 @@ class ExperimentManager:
         if filepath.exists():
             raise FileExistsError
 
-        task_dicts = list(Task.select().dicts())  # TODO write on the fly instead?
-
         with filepath.open('w') as f:
-            yaml.dump(task_dicts, f)
+            num_tasks = 0
+            for task_dicts in self._select_in_batches(Task.select()):
+                for d in task_dicts:
+                    # Not parsed by dicts()
+                    d['config'] = Task.expand_config(d.pop('config_data'), d.pop('config_base'))
+                yaml.dump(task_dicts, f)  # The items of consecutive dumps form a single list
+                num_tasks += len(task_dicts)
+            if num_tasks == 0:
+                yaml.dump([], f)
 
 
 experiment_manager = ExperimentManager()
@@ -0,0 +1,125 @@
+import csv
+import json
+from typing import Dict, List, Optional, Tuple
+
+# The columns taken as-is from the task table
+task_columns = ('id', 'uuid', 'name', 'project', 'platform_type', 'status', 'hostname', 'job_id', 'project_path',
+                'cur_epoch', 'cur_iter', 'iter_per_epoch', 'epoch_duration', 'is_archived')
+
+
+def flatten(obj: dict, prefix: str) -> dict:
+    """Flatten a nested dict (e.g. a config) into {'prefix.a.b': value}. Lists are converted to json strings."""
+
+    flat = {}
+    for k, v in obj.items():
+        key = f'{prefix}.{k}'
+        if isinstance(v, dict):
+            flat.update(flatten(v, key))
+        elif isinstance(v, (list, tuple)):
+            flat[key] = json.dumps(v, default=str)
+        else:
+            flat[key] = v
+    return flat
+
+
+def summarize_metrics(summaries: Dict[Tuple[str, str], Tuple[float, float, float]]) -> dict:
+    """Return the final, min and max value of each metric line, as flat columns.
+
+    The summaries are as returned by `metricstore.load_metric_summaries()`: {(metric, label): (final, min, max)}.
+    Example: {'metric.loss.final': 0.2, 'metric.loss.min': 0.15, 'metric.loss.max': 2.3, 'metric.iou.0.final': ...}
+    """
+
+    summary = {}
+    for (name, label), (final, min_value, max_value) in summaries.items():
+        key = f'metric.{name}' if label == '' else f'metric.{name}.{label}'
+        summary[key + '.final'] = final
+        summary[key + '.min'] = min_value
+        summary[key + '.max'] = max_value
+    return summary
+
+
+def value_type(value) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return 'str'
+
+
+def merge_types(a: Optional[str], b: Optional[str]) -> Optional[str]:
+    """The type of a column containing values of types a and b"""
+
+    if a is None or a == b:
+        return b
+    if b is None:
+        return a
+    if {a, b} == {'int', 'float'}:
+        return 'float'
+    return 'str'
+
+
+def coerce(value, typ: str):
+    if value is None:
+        return None
+    if typ == 'float':
+        return float(value)
+    if typ == 'str' and not isinstance(value, str):
+        return str(value)
+    return value
+
+
+class ColumnTypes:
+    """Infers the type of each column from the rows seen so far. The columns are kept in order of appearance."""
+
+    def __init__(self):
+        self.types: Dict[str, Optional[str]] = {}
+
+    def update(self, row: dict):
+        for k, v in row.items():
+            self.types[k] = merge_types(self.types.get(k), value_type(v))
+
+    def coerce_row(self, row: dict) -> dict:
+        return {k: coerce(row.get(k), typ) for k, typ in self.types.items()}
+
+
+class CsvTableWriter:
+    def __init__(self, path, column_types: ColumnTypes):
+        self.column_types = column_types
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=list(column_types.types.keys()))
+        self._writer.writeheader()
+
+    def write(self, rows: List[dict]):
+        self._writer.writerows(self.column_types.coerce_row(r) for r in rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetTableWriter:
+    """Writes each batch of rows as a row group. Requires pyarrow."""
+
+    arrow_types = {'bool': 'bool_', 'int': 'int64', 'float': 'float64', 'str': 'string', None: 'null'}
+
+    def __init__(self, path, column_types: ColumnTypes):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Exporting to Parquet requires pyarrow. Please install it with `pip install pyarrow`.')
+        self._pa = pa
+        self.column_types = column_types
+        self.schema = pa.schema([(name, getattr(pa, self.arrow_types[typ])())
+                                 for name, typ in column_types.types.items()])
+        self._writer = pq.ParquetWriter(str(path), self.schema)
+
+    def write(self, rows: List[dict]):
+        batch = self._pa.RecordBatch.from_pylist([self.column_types.coerce_row(r) for r in rows], schema=self.schema)
+        self._writer.write_batch(batch)
+
+    def close(self):
+        self._writer.close()
@@ -0,0 +1,282 @@
+"""A fork server runs the scripts of the jobs in processes forked from a warm interpreter of their python env.
+
+The server imports the preloaded modules (e.g. torch) once; each job then starts without importing them again. The
+server is run by the interpreter of the env, where hypertrainer might not be installed: this file must only depend on
+the standard library.
+
+Usage: python forkserver.py SOCKET_PATH PARENT_PID [MODULE ...]
+
+The server exits when the process PARENT_PID (the job supervisor) does not exist anymore.
+"""
+
+import atexit
+import hashlib
+import importlib
+import json
+import os
+import runpy
+import select
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import List, Optional
+
+parent_check_secs = 5  # How often the server checks that its parent is alive
+
+
+class ForkServer:
+    """Client of the fork server of a python env. The server is started on the first job, and again if it died."""
+
+    start_timeout_secs = 120  # Importing the preloaded modules can be slow
+
+    def __init__(self, python_env_command: List[str], socket_dir: Path, preload: List[str]):
+        self.python_env_command = python_env_command
+        env_hash = hashlib.sha1(json.dumps(python_env_command).encode()).hexdigest()[:12]
+        # Several supervisors can run on the same machine (one per worker hostname): each has its own servers
+        self.socket_path = str(socket_dir / f'forkserver-{os.getpid()}-{env_hash}.sock')
+        self.preload = preload
+        self.process: Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+
+    def spawn(self, argv: List[str], cwd: str, env: dict, stdout_path: str, stderr_path: str) -> 'ForkedProcess':
+        """Run `python argv...` in a process forked from the server"""
+
+        with self._lock:
+            if self.process is None or self.process.poll() is not None:
+                self._start()
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self.socket_path)
+        request = dict(argv=argv, cwd=cwd, env=env, stdout_path=stdout_path, stderr_path=stderr_path)
+        conn.sendall(json.dumps(request).encode() + b'\n')
+        process = ForkedProcess(conn)
+        process.pid = int(process._read_line())
+        return process
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+    def _start(self):
+        for path in (self.socket_path, self.socket_path + '.tmp'):
+            if os.path.exists(path):
+                os.unlink(path)  # Left by a previous server
+        self.process = subprocess.Popen(self.python_env_command + [__file__, self.socket_path, str(os.getpid())]
+                                        + self.preload)
+        deadline = time.time() + self.start_timeout_secs
+        while not os.path.exists(self.socket_path):  # Bound once the modules are imported
+            if self.process.poll() is not None:
+                raise Exception(f'The fork server exited with code {self.process.returncode}')
+            if time.time() > deadline:
+                self.process.kill()
+                raise TimeoutError('The fork server did not start in time')
+            time.sleep(0.05)
+
+
+class ForkedProcess:
+    """A job forked by a fork server, with the interface of subprocess.Popen used by the job supervisor.
+
+    The server sends the exit code of the job through the connection when it exits.
+    """
+
+    def __init__(self, conn: socket.socket):
+        self.conn = conn
+        self.pid: Optional[int] = None
+        self.returncode: Optional[int] = None
+        self._buffer = b''
+
+    def poll(self) -> Optional[int]:
+        if self.returncode is None and (b'\n' in self._buffer or select.select([self.conn], [], [], 0)[0]):
+            self.wait()
+        return self.returncode
+
+    def wait(self) -> int:
+        if self.returncode is None:
+            line = self._read_line()
+            self.returncode = int(line) if line != '' else -1  # -1 if the server died
+            self.conn.close()
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def _read_line(self) -> str:
+        """Read the next line sent by the server ('' if the connection was closed)"""
+
+        while b'\n' not in self._buffer:
+            data = self.conn.recv(4096)
+            if not data:
+                return ''
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line.decode()
+
+
+def serve(socket_path: str, parent_pid: int, preload: List[str]):
+    """Fork a process for each job requested on the socket, and send its pid, then its exit code when it exits"""
+
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            print('WARNING: Could not preload', module, e)
+
+    # SIGCHLD wakes up the selector, to reap the jobs that exited
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_r, False)
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # Remove the socket when stopped
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path + '.tmp')
+    listener.listen()
+    os.rename(socket_path + '.tmp', socket_path)  # Clients wait for the socket to exist
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    selector.register(wake_r, selectors.EVENT_READ)
+    print('Fork server ready:', socket_path, flush=True)
+
+    try:
+        _serve_forever(listener, selector, wake_r, wake_w, parent_pid)
+    finally:
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+
+
+def _serve_forever(listener: socket.socket, selector: selectors.BaseSelector, wake_r: int, wake_w: int,
+                   parent_pid: int):
+    clients = {}  # {pid: connection}
+    while _pid_exists(parent_pid):
+        for key, _ in selector.select(timeout=parent_check_secs):
+            if key.fileobj is listener:
+                conn, _ = listener.accept()
+                try:
+                    request = _receive_request(conn)
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    pid = os.fork()
+                    if pid == 0:
+                        listener.close()
+                        for fd in (wake_r, wake_w):
+                            os.close(fd)
+                        for c in clients.values():
+                            c.close()
+                        conn.close()
+                        _run_job(request)  # Does not return
+                    clients[pid] = conn
+                    conn.sendall(f'{pid}\n'.encode())
+                except Exception as e:
+                    print('ERROR in fork server request:', e)
+                    conn.close()
+            else:
+                try:
+                    os.read(wake_r, 4096)
+                except BlockingIOError:
+                    pass
+                _reap(clients)
+
+
+def _pid_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _receive_request(conn: socket.socket) -> dict:
+    conn.settimeout(10)
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            raise ConnectionError('Incomplete request')
+        data += chunk
+    conn.settimeout(None)
+    return json.loads(data)
+
+
+def _reap(clients: dict):
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        exit_code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)  # Like Popen
+        conn = clients.pop(pid, None)
+        if conn is not None:
+            try:
+                conn.sendall(f'{exit_code}\n'.encode())
+            except OSError:
+                pass  # The supervisor is gone
+            conn.close()
+
+
+def _run_job(request: dict):
+    """Run the script in this forked process, as `python argv...` would, then exit"""
+
+    exit_code = 0
+    try:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.setpgrp()  # Like a new process, out of the process group of the server
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])  # Includes CUDA_VISIBLE_DEVICES, read when CUDA gets initialized
+        for fd, path, flags in ((0, os.devnull, os.O_RDONLY),
+                                (1, request['stdout_path'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC),
+                                (2, request['stderr_path'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC)):
+            file_fd = os.open(path, flags, 0o644)
+            os.dup2(file_fd, fd)
+            os.close(file_fd)
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', closefd=False)  # Buffered like the stdout of a new interpreter writing to a file
+        sys.stderr = open(2, 'w', buffering=1, closefd=False)
+        sys.argv = request['argv']
+        sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+        runpy.run_path(sys.argv[0], run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        try:
+            # Finalize like the interpreter does at exit, since os._exit() does not
+            try:
+                threading._shutdown()  # Wait for the non-daemon threads
+            except BaseException:
+                traceback.print_exc()
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1], int(sys.argv[2]), sys.argv[3:])
@@ -1,22 +1,34 @@
+import math
+import pickle
 import time
+import uuid
+from collections import defaultdict
 from pathlib import Path
-from typing import List, Iterable, Dict
+from typing import List, Dict, Optional
 
 import redis.exceptions
 from redis import Redis
 from rq import Queue
-from rq.job import Job, cancel_job as cancel_rq_job
+from rq.job import cancel_job as cancel_rq_job
 
+from hypertrainer import htplatform_worker
 from hypertrainer.computeplatform import ComputePlatform
 from hypertrainer.computeplatformtype import ComputePlatformType
-from hypertrainer.htplatform_worker import run, get_jobs_info, get_logs, ping, raise_exception, delete_job, \
-    cancel_job
+from hypertrainer.logtail import LogCache
+from hypertrainer.resources import job_requirements, publish_job, set_job_priority, unqueue_job
+from hypertrainer.htplatform_worker import run, get_jobs_info, get_logs, get_logs_batch, ping, raise_exception, \
+    delete_job, cancel_job, call_and_reply, job_info_key
 from hypertrainer.utils import TaskStatus, get_python_env_command, config_context
 
 
 ConnectionError = redis.exceptions.ConnectionError
 
 
+class WorkerError(Exception):
+    """Raised when a function called on a worker raised an exception"""
+    pass
+
+
 def check_connection(redis_conn):
     try:
         redis_conn.ping()
@@ -33,6 +45,9 @@ class HtPlatform(ComputePlatform):
     Each participating worker consumes jobs from a global queue. There can be several workers per machine.
     """
 
+    default_timeout_secs = 4  # How long to wait for the answer of a worker
+    heartbeat_timeout_secs = 60  # A running job whose heartbeat is older than this is considered Unknown
+
     def __init__(self, same_thread=False):
         with config_context() as config:
             self.worker_hostnames = config['ht_platform']['worker_hostnames']
@@ -44,29 +59,86 @@ class HtPlatform(ComputePlatform):
         self.jobs_queue = Queue(name='jobs', connection=redis_conn, is_async=not same_thread)
         self.worker_queues: Dict[str, Queue] = {h: Queue(name=h, connection=redis_conn, is_async=not same_thread)
                                                 for h in self.worker_hostnames}
+        self.log_cache = LogCache()
+
+        if same_thread:
+            # The jobs are executed in this process, which acts as the first worker
+            htplatform_worker.worker_hostname = self.worker_hostnames[0]
+            htplatform_worker.supervise_inline = True
 
     def submit(self, task, resume=False):
+        # At this point, we only know the rq job id. No pid since the job might have to wait.
+        return self.submit_many([task], resume)[0]
+
+    def submit_many(self, tasks, resume=False):
+        """Enqueue the jobs of all the tasks in one redis round-trip.
+
+        The project, priority and required resources of each job are published along with it: the workers claim the
+        jobs by priority, fairly between the projects, and only if they fit the free resources of their machine (see
+        resources.ResourceQueue).
+        """
+
+        job_datas = [Queue.prepare_data(run, timeout=-1, kwargs=self._prepare_run(t, resume)) for t in tasks]
+        with self.redis_conn.pipeline() as pipeline:  # Transaction: the jobs are published before any is seen
+            jobs = self.jobs_queue.enqueue_many(job_datas, pipeline=pipeline)
+            for job, t in zip(jobs, tasks):
+                publish_job(pipeline, self.jobs_queue, job.id, t.project, t.priority, job_requirements(t.config))
+            pipeline.execute()
+        return [job.id for job in jobs]
+
+    def set_priority(self, task, priority: int) -> bool:
+        return set_job_priority(self.redis_conn, task.job_id, priority)
+
+    def _prepare_run(self, task, resume) -> dict:
+        """Set the output path of the task, and return the kwargs of the worker function run()"""
+
+        self.log_cache.forget(task.id)  # The logs will be rewritten
         output_path = Path(task.output_root) / str(task.uuid)
         task.output_path = str(output_path)
         python_env_command = get_python_env_command(Path(task.project_path), ComputePlatformType.HT.value)
-        job = self.jobs_queue.enqueue(run, job_timeout=-1, kwargs=dict(
+        return dict(
             script_file=Path(task.script_file),
             output_path=output_path,
             python_env_command=python_env_command,
             config_dump=task.dump_config(),
-            resume=resume))
-        # At this point, we only know the rq job id. No pid since the job might have to wait.
-        return job.id
+            resume=resume)
 
-    def fetch_logs(self, task, keys=None):
+    def fetch_logs(self, task, keys=None, timeout: Optional[float] = None):
         if task.hostname == '':  # The job hasn't been consumed yet
             return {}
-        rq_job = self.worker_queues[task.hostname].enqueue(get_logs, args=(task.output_path,), ttl=2, result_ttl=2)
-        logs = wait_for_result(rq_job)
+        base_cursors = self.log_cache.get_cursors(task.id)
+        reply = self.call(task.hostname, get_logs, task.output_path, base_cursors, timeout=timeout)
+        deltas, cursors = wait_for_result(reply)
+        return self.log_cache.apply(task.id, deltas, cursors, base_cursors)
+
+    def fetch_logs_many(self, tasks, timeout: Optional[float] = None):
+        """Fetch the logs of several tasks, with one request per worker. The logs of the tasks whose worker did not
+        answer in time are None."""
+
+        tasks_by_hostname = defaultdict(list)
+        for t in tasks:
+            tasks_by_hostname[t.hostname].append(t)
+        logs = {t.id: {} for t in tasks_by_hostname.pop('', [])}  # The jobs that haven't been consumed yet
+
+        hostnames = list(tasks_by_hostname.keys())
+        base_cursors = {h: [self.log_cache.get_cursors(t.id) for t in tasks_by_hostname[h]] for h in hostnames}
+        replies = [self.call(h, get_logs_batch, [t.output_path for t in tasks_by_hostname[h]], base_cursors[h],
+                             timeout=timeout)
+                   for h in hostnames]
+        results = wait_for_results(replies, raise_exc=False)
+
+        for h, result in zip(hostnames, results):
+            for i, t in enumerate(tasks_by_hostname[h]):
+                if result is None:
+                    logs[t.id] = None  # The worker did not answer in time
+                else:
+                    deltas, cursors = result[i]
+                    logs[t.id] = self.log_cache.apply(t.id, deltas, cursors, base_cursors[h][i])
         return logs
 
     def cancel(self, task):
         cancel_rq_job(task.job_id, connection=self.redis_conn)  # This ensures the job will not start
+        unqueue_job(self.redis_conn, task.job_id)
 
         if task.hostname == '':
             print(f'Cannot send cancellation for {task.uuid}: no assigned worker hostname')
@@ -74,65 +146,119 @@ class HtPlatform(ComputePlatform):
             self.worker_queues[task.hostname].enqueue(cancel_job, args=(task.job_id,), ttl=4)
 
     def update_tasks(self, tasks):
-        # TODO only check requested ids
-
+        # The workers publish the info of their jobs to redis: get it for the requested jobs in one round trip
+        pipeline = self.redis_conn.pipeline(transaction=False)
         for t in tasks:
+            pipeline.hmget(job_info_key(t.job_id), 'status', 'hostname', 'heartbeat')
+        job_infos = pipeline.execute()
+
+        now = time.time()
+        for t, (status, hostname, heartbeat) in zip(tasks, job_infos):
             assert t.status.is_active
-            if t.status != TaskStatus.Waiting:  # Waiting will not be found until they are picked up
-                t.status = TaskStatus.Unknown  # State is unknown, unless we find the task in a worker db
-        job_id_to_task = {t.job_id: t for t in tasks}
-
-        info_dicts = self._get_info_dict_for_each_worker()
-        for hostname, local_db in zip(self.worker_hostnames, info_dicts):
-            if local_db is None:
-                continue  # Did not receive an answer from worker
-            for job_id in set(local_db.keys()).intersection(job_id_to_task.keys()):
-                # For each task in the intersection of (tasks to update) and (tasks in worker db)
-                t = job_id_to_task[job_id]
-                job_info = local_db[job_id]
-                t.status = TaskStatus(job_info['status'])
-                t.hostname = hostname
+            if status is None:
+                if t.status != TaskStatus.Waiting:  # Waiting will not be found until they are picked up
+                    t.status = TaskStatus.Unknown  # State is unknown, unless we find the job info
+                continue
+            t.status = TaskStatus(status.decode())
+            t.hostname = hostname.decode()
+            if t.status == TaskStatus.Running and heartbeat is not None \
+                    and now - float(heartbeat) > self.heartbeat_timeout_secs:
+                t.status = TaskStatus.Unknown  # The worker does not send news
 
     def delete(self, task):
+        self.log_cache.forget(task.id)
         if task.hostname == '':
             print(f'Cannot perform worker deletion for {task.uuid}: no assigned worker hostname')
         else:
             self.worker_queues[task.hostname].enqueue(delete_job, args=(task.job_id, task.output_path), ttl=4)
 
-    def _get_info_dict_for_each_worker(self):
-        rq_jobs = [q.enqueue(get_jobs_info, ttl=2, result_ttl=2) for q in self.worker_queues.values()]
-        results = wait_for_results(rq_jobs, raise_exc=False)
+    def _get_info_dict_for_each_worker(self, timeout: Optional[float] = None):
+        replies = [self.call(h, get_jobs_info, timeout=timeout) for h in self.worker_hostnames]
+        results = wait_for_results(replies, raise_exc=False)
         return results
 
-    def ping_workers(self):
-        rq_jobs = [q.enqueue(ping, ttl=2, result_ttl=2, args=(h,)) for h, q in self.worker_queues.items()]
-        results = wait_for_results(rq_jobs)
+    def ping_workers(self, timeout: Optional[float] = None):
+        replies = [self.call(h, ping, h, timeout=timeout) for h in self.worker_hostnames]
+        results = wait_for_results(replies)
         return results
 
     def raise_exception_in_worker(self, exc_type, queue_name):
         self.worker_queues[queue_name].enqueue(raise_exception, ttl=2, result_ttl=2, args=(exc_type,))
 
+    def call(self, hostname: str, func, *args, timeout: Optional[float] = None) -> 'Reply':
+        """Call func(*args) on the worker, without blocking. The result can be obtained with wait_for_result().
 
-def wait_for_result(rq_job: Job, interval_secs=1, tries=4, raise_exc=True):
-    for i in range(tries):
-        if rq_job.result is not None:
-            return rq_job.result
-        else:
-            time.sleep(interval_secs)
-    if raise_exc:
-        raise TimeoutError
-    return None
-
-
-def wait_for_results(rq_jobs: Iterable[Job], interval_secs=1, tries=4, raise_exc=True):
-    assert tries >= 1
-    for i in range(tries):
-        results = [j.result for j in rq_jobs]
-        if any(r is None for r in results):
-            time.sleep(interval_secs)
-        else:
-            return results
-    if raise_exc:
-        raise TimeoutError
-    # noinspection PyUnboundLocalVariable
+        `timeout` (in seconds) is how long the result will be waited for, including the time spent in the queue.
+        """
+
+        timeout = self.default_timeout_secs if timeout is None else timeout
+        reply = Reply(self.redis_conn, f'hypertrainer:reply:{uuid.uuid4()}', deadline=time.time() + timeout)
+        ttl = math.ceil(timeout)
+        self.worker_queues[hostname].enqueue(call_and_reply, ttl=ttl, result_ttl=0,
+                                             args=(reply.key, ttl, func) + args)
+        return reply
+
+
+class Reply:
+    """The future result of a function called with HtPlatform.call()
+
+    The worker pushes the result to a redis list, which is waited upon with a blocking pop: the result is received as
+    soon as it is available.
+    """
+
+    def __init__(self, redis_conn: Redis, key: str, deadline: float):
+        self.redis_conn = redis_conn
+        self.key = key
+        self.deadline = deadline
+
+    @staticmethod
+    def unpack(data: bytes):
+        ok, result = pickle.loads(data)
+        if not ok:
+            raise WorkerError(result)
+        return result
+
+
+def _blocking_pop(redis_conn: Redis, keys: List[str], deadline: float):
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        return None
+    # Whole seconds: redis-server < 6.0 does not accept fractional timeouts, and rounds those under 1 ms down to 0,
+    # which blocks forever. Rounding up overshoots the deadline by less than a second.
+    return redis_conn.blpop(keys, timeout=math.ceil(remaining))
+
+
+def wait_for_result(reply: Reply, raise_exc=True):
+    """Wait for the result of a worker call. Raises TimeoutError, or WorkerError if the call raised an exception."""
+
+    popped = _blocking_pop(reply.redis_conn, [reply.key], reply.deadline)
+    if popped is None:
+        if raise_exc:
+            raise TimeoutError
+        return None
+    return Reply.unpack(popped[1])
+
+
+def wait_for_results(replies: List[Reply], raise_exc=True):
+    """Wait for the results of several worker calls, in any order.
+
+    If raise_exc=False, the results that were not received in time, or whose call raised, are None.
+    """
+
+    results = [None] * len(replies)
+    pending = {r.key: i for i, r in enumerate(replies)}
+    while pending:
+        deadline = max(replies[i].deadline for i in pending.values())
+        popped = _blocking_pop(replies[0].redis_conn, list(pending.keys()), deadline)
+        if popped is None:
+            if raise_exc:
+                raise TimeoutError
+            break
+        key, data = popped
+        i = pending.pop(key.decode())
+        try:
+            results[i] = Reply.unpack(data)
+        except WorkerError:
+            if raise_exc:
+                raise
     return results
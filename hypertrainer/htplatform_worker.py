@@ -1,17 +1,23 @@
 import contextlib
-import os
 import pickle
 import shutil
-import subprocess
+import socket
+import sqlite3
+import threading
 from pathlib import Path
-from time import sleep
-from typing import List
+from time import time
+from typing import List, Optional
 
 from rq import get_current_job
 
-from hypertrainer.utils import yaml, hypertrainer_home, GpuLockManager, TaskStatus
+from hypertrainer.logtail import tail_logs
+from hypertrainer.utils import yaml, hypertrainer_home, TaskStatus
 
-local_db = hypertrainer_home / 'db.pkl'  # FIXME config
+local_db = hypertrainer_home / 'worker_db.sqlite'  # FIXME config
+worker_hostname = socket.gethostname()  # Set by worker.py to the name of the worker queue
+supervise_inline = False  # Set when the jobs are executed in the server process (see HtPlatform)
+_inline_supervisors = {}  # {hostname: Supervisor} of the jobs supervised in this process, reused by all of them
+_inline_supervisors_lock = threading.Lock()
 
 
 def run(
@@ -21,7 +27,15 @@ def run(
         python_env_command: List[str],
         resume: bool
         ):
-    gpu_lock = None
+    """Prepare the job, and hand it over to the supervisor of the machine (see jobsupervisor), which launches it.
+
+    If there is no supervisor (or if supervise_inline is set), the job is supervised in this process until it ends.
+    """
+
+    from hypertrainer import jobsupervisor
+    from hypertrainer.resources import release_job
+
+    job = get_current_job()
     try:
         # Prepare the job
         config_file = output_path / 'config.yaml'
@@ -29,89 +43,82 @@ def run(
         if not resume:
             # Setup task dir
             output_path.mkdir(parents=True, exist_ok=False)
-            config = yaml.load(config_dump)
             yaml.dump(config, config_file)
-        stdout_path = output_path / 'out.txt'  # FIXME this ignores task.stdout_path
-        stderr_path = output_path / 'err.txt'
-
-        # Manage GPU dependency
-        env_vars = os.environ
-        if 'num_gpus' in config:
-            num_required_gpus = config['num_gpus']
-            if num_required_gpus > 1:
-                raise NotImplementedError
-            gpu_lock = GpuLockManager().acquire_one_gpu()
-            env_vars = os.environ.copy()
-            env_vars['CUDA_VISIBLE_DEVICES'] = gpu_lock.gpu_id
-
-        # Start the subprocess
-        p = subprocess.Popen(python_env_command + [str(script_file), str(config_file)],
-                             stdout=stdout_path.open(mode='w'),
-                             stderr=stderr_path.open(mode='w'),
-                             cwd=str(output_path),
-                             universal_newlines=True,
-                             env=env_vars)
-
-        # Write into to local db
-        job_id = get_current_job().id
-        with local_db_context() as db:
-            assert job_id not in db, 'Job id already exists in worker db.'
-            db[job_id] = {'pid': p.pid, 'status': TaskStatus.Unknown.value}
-
-        # Monitor the job
-        monitor_interval = 2  # TODO config?
-        while True:
-            poll_result = p.poll()
-            if poll_result is None:
-                with local_db_context() as db:
-                    if db[job_id]['status'] == TaskStatus.Cancelled.value:
-                        break  # End the rq job, which will kill the subprocess
-                    else:
-                        db[job_id]['status'] = TaskStatus.Running.value
-            else:
-                if p.returncode == 0:
-                    print('Finished successfully')
-                    _set_job_status(job_id, TaskStatus.Finished.value)
-                else:
-                    print('Crashed!')
-                    _set_job_status(job_id, TaskStatus.Crashed.value)
-                break  # End the rq job
-            sleep(monitor_interval)
+        job_spec = dict(
+            job_id=job.id,
+            script_file=str(script_file),
+            config_file=str(config_file),
+            output_path=str(output_path),
+            stdout_path=str(output_path / 'out.txt'),  # FIXME this ignores task.stdout_path
+            stderr_path=str(output_path / 'err.txt'),
+            python_env_command=python_env_command,
+            num_gpus=config.get('num_gpus'))
+
+        if not supervise_inline:
+            try:
+                jobsupervisor.hand_over(worker_hostname, job_spec)
+                return
+            except ConnectionError:
+                print('WARNING: No job supervisor on this machine. Supervising the job in the rq worker.')
+        with _inline_supervisors_lock:
+            supervisor = _inline_supervisors.get(worker_hostname)
+            if supervisor is None:
+                supervisor = _inline_supervisors[worker_hostname] = jobsupervisor.Supervisor(job.connection,
+                                                                                             worker_hostname)
+        supervisor.launch(job_spec).done_event.wait()
 
     except Exception:
-        job_id = get_current_job().id
-        _set_job_status(job_id, TaskStatus.RunFailed.value)
+        _set_job_status(job.id, TaskStatus.RunFailed.value)
+        _publish_job_info(job.id, status=TaskStatus.RunFailed.value, end_time=time(), hostname=worker_hostname)
+        release_job(job.connection, worker_hostname, job.id)
         raise
+
+
+def call_and_reply(reply_key: str, reply_ttl: int, func, *args):
+    """Call func(*args) and push the result to the redis list `reply_key`, where the server waits for it.
+
+    The reply is a pickled tuple (True, result), or (False, error message) if func raised an exception.
+    """
+
+    try:
+        result = func(*args)
+        reply = (True, result)
+    except Exception as e:
+        reply = (False, f'{type(e).__name__}: {e}')
+        raise  # The rq job will be marked as failed
     finally:
-        # Release the GPU lock if needed
-        if gpu_lock is not None:
-            gpu_lock.release()
+        redis_conn = get_current_job().connection
+        redis_conn.pipeline().rpush(reply_key, pickle.dumps(reply)).expire(reply_key, reply_ttl).execute()
+    return result
+
 
+def get_logs(output_path: str, cursors: dict = None):
+    """Return the data appended to the logs since `cursors`, as a tuple (deltas, cursors). See `tail_logs()`."""
+    return tail_logs(output_path, cursors)
 
-def get_logs(output_path: str):
-    logs = {}
-    patterns = ('*.log', '*.txt')
-    for pattern in patterns:
-        for matched_file_path in Path(output_path).glob(pattern):
-            log_name = matched_file_path.stem
-            logs[log_name] = matched_file_path.read_text()
-    return logs
+
+def get_logs_batch(output_paths: List[str], cursors: List[dict]):
+    """Like get_logs(), for several jobs at once. Returns a list of (deltas, cursors) tuples."""
+    return [tail_logs(p, c) for p, c in zip(output_paths, cursors)]
 
 
 def delete_job(job_id: str, output_path: str):
     _delete_job(job_id)
+    get_current_job().connection.delete(job_info_key(job_id))
     print('Deleting', output_path)
     shutil.rmtree(output_path,
                   onerror=lambda function, path, excinfo: print('ERROR', function, path, excinfo))
 
 
 def cancel_job(job_id: str):
+    from hypertrainer import jobsupervisor
+
     assert isinstance(job_id, str)
-    # We communicate with the running job through the local db
-    with local_db_context() as db:
-        if job_id not in db:
-            raise Exception('Cannot cancel job that is not in worker db')
-        db[job_id]['status'] = TaskStatus.Cancelled.value
+    # The status in the local db tells the supervisor that the job was cancelled
+    if not _set_job_status(job_id, TaskStatus.Cancelled.value):
+        raise Exception('Cannot cancel job that is not in worker db')
+    _publish_job_info(job_id, status=TaskStatus.Cancelled.value, end_time=time())
+    jobsupervisor.cancel(worker_hostname, job_id)  # Kill it right away
 
 
 def ping(msg):
@@ -123,36 +130,77 @@ def raise_exception(exc_type):
 
 
 def get_jobs_info():
-    with local_db_context() as db:
-        jobs_info = db
-    return jobs_info
+    with local_db_connection() as conn:
+        rows = conn.execute('SELECT job_id, pid, status FROM jobs').fetchall()
+    return {job_id: {'pid': pid, 'status': status} for job_id, pid, status in rows}
 
 
-def _check_init_db():
-    if not local_db.exists():
-        with local_db.open('wb') as f:
-            pickle.dump({}, f)
+@contextlib.contextmanager
+def local_db_connection():
+    """Open the worker db, which is shared by all the worker processes of the machine.
 
+    The db is in WAL mode, so that readers do not block the writer. Each statement executed in the context is part of
+    a single transaction.
+    """
 
-@contextlib.contextmanager
-def local_db_context():
-    _check_init_db()  # FIXME avoid 2 opens
-    with local_db.open('r+b') as f:
-        db = pickle.load(f)
-        yield db
-        f.seek(0)
-        f.truncate()
-        pickle.dump(db, f)
+    conn = sqlite3.connect(str(local_db), timeout=30)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, pid INTEGER, status TEXT NOT NULL)')
+        with conn:  # Commits, or rolls back on exception
+            yield conn
+    finally:
+        conn.close()
+
+
+def _insert_job(job_id: str, pid: Optional[int], status_str: str):
+    with local_db_connection() as conn:
+        try:
+            conn.execute('INSERT INTO jobs (job_id, pid, status) VALUES (?, ?, ?)', (job_id, pid, status_str))
+        except sqlite3.IntegrityError:
+            raise Exception('Job id already exists in worker db.')
+
+
+def _set_job_pid(job_id: str, pid: int):
+    with local_db_connection() as conn:
+        conn.execute('UPDATE jobs SET pid = ? WHERE job_id = ?', (pid, job_id))
+
+
+def _set_job_status(job_id: str, status_str: str, unless: str = None) -> bool:
+    """Atomically set the status of a job, unless its current status is `unless`.
+
+    Returns False if the status was not set (job not found, or status was `unless`).
+    """
+
+    with local_db_connection() as conn:
+        if unless is None:
+            cursor = conn.execute('UPDATE jobs SET status = ? WHERE job_id = ?', (status_str, job_id))
+        else:
+            cursor = conn.execute('UPDATE jobs SET status = ? WHERE job_id = ? AND status != ?',
+                                  (status_str, job_id, unless))
+        return cursor.rowcount == 1
+
+
+def job_info_key(job_id: str):
+    """The redis hash where the info of a job is published"""
+    return f'hypertrainer:job:{job_id}'
+
+
+def _publish_job_info(job_id: str, connection=None, **info):
+    """Publish the info of a job (pid, status, start_time, end_time, heartbeat, hostname) to redis.
 
+    This way, the server gets the status of the jobs without having to send a request to each worker. The connection
+    (or pipeline) is the one of the current rq job by default.
+    """
 
-def _set_job_status(job_id: str, status_str: str):
-    with local_db_context() as db:
-        db[job_id]['status'] = status_str
+    connection = get_current_job().connection if connection is None else connection
+    connection.hset(job_info_key(job_id), mapping=info)
 
 
 def _delete_job(job_id: str):
-    with local_db_context() as db:
-        del db[job_id]
+    with local_db_connection() as conn:
+        conn.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
 
 
 def test_job(msg: str):
@@ -0,0 +1,269 @@
+import os
+import selectors
+import signal
+import subprocess
+import threading
+from multiprocessing.connection import Listener, Client
+from pathlib import Path
+from time import time, sleep
+from typing import Dict, Optional, List
+
+from redis import Redis
+
+from hypertrainer.forkserver import ForkServer
+from hypertrainer.htplatform_worker import _set_job_status, _insert_job, _set_job_pid, _publish_job_info
+from hypertrainer.resources import release_job
+from hypertrainer.utils import TaskStatus, GpuLockManager, hypertrainer_home
+
+
+def get_socket_path(hostname: str) -> Path:
+    """The unix socket of the supervisor of a worker hostname"""
+    return hypertrainer_home / f'supervisor-{hostname}.sock'
+
+
+def hand_over(hostname: str, job_spec: dict):
+    """Send a job to the supervisor of the machine, which launches it. Raises ConnectionError if there is none."""
+    _request(hostname, 'launch', job_spec)
+
+
+def cancel(hostname: str, job_id: str) -> bool:
+    """Ask the supervisor to kill a job right away. Returns False if it does not supervise the job."""
+
+    try:
+        return _request(hostname, 'cancel', job_id)
+    except ConnectionError:
+        return False
+
+
+def _request(hostname: str, command: str, arg):
+    try:
+        conn = Client(str(get_socket_path(hostname)), family='AF_UNIX')
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        raise ConnectionError(f'No job supervisor for {hostname}') from e
+    with conn:
+        conn.send((command, arg))
+        ok, result = conn.recv()
+    if not ok:
+        raise Exception(result)
+    return result
+
+
+class SupervisedJob:
+    __slots__ = ('job_id', 'spec', 'process', 'pidfd', 'gpu_lease', 'cancel_event', 'done_event')
+
+    def __init__(self, job_id: str, spec: dict):
+        self.job_id = job_id
+        self.spec = spec
+        self.process: Optional[subprocess.Popen] = None
+        self.pidfd: Optional[int] = None
+        self.gpu_lease = None
+        self.cancel_event = threading.Event()
+        self.done_event = threading.Event()
+
+
+class Supervisor:
+    """Launches the jobs of a worker machine, and tracks their processes until they end.
+
+    The rq workers hand the jobs over to the supervisor and return right away, so a few worker processes can start any
+    number of jobs. The ends of the processes are notified through pidfds (polled where pidfds are not available), and
+    cancellations kill the processes as soon as they are received. The heartbeats of all the running jobs are published
+    at once.
+
+    If `preload` is a list of modules (possibly empty), the jobs are forked from a warm interpreter of their python env,
+    where these modules are already imported (see forkserver). Otherwise each job starts a new interpreter.
+
+    A job spec is a dict with keys: job_id, script_file, config_file, output_path, stdout_path, stderr_path,
+    python_env_command and num_gpus (optional).
+    """
+
+    heartbeat_interval_secs = 10
+    kill_grace_secs = 10  # Cancelled jobs are killed if they did not exit this long after SIGTERM
+    poll_secs = 1  # Without pidfds
+
+    def __init__(self, redis_conn: Redis, hostname: str, preload: Optional[List[str]] = None):
+        self.redis_conn = redis_conn
+        self.hostname = hostname
+        self.preload = preload
+        self.fork_servers: Dict[tuple, ForkServer] = {}  # By python env command
+        self.jobs: Dict[str, SupervisedJob] = {}
+        self._lock = threading.Lock()
+        self._use_pidfd = hasattr(os, 'pidfd_open')  # Linux >= 5.3
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._to_watch = []  # Jobs just started, registered by the exit watcher thread
+        threading.Thread(target=self._watch_exits, name='exit-watcher', daemon=True).start()
+        threading.Thread(target=self._send_heartbeats, name='heartbeat', daemon=True).start()
+
+    def serve_forever(self):
+        """Handle the requests of the rq workers (see hand_over and cancel)"""
+
+        socket_path = get_socket_path(self.hostname)
+        if socket_path.exists():
+            socket_path.unlink()  # Left by a previous supervisor
+        with Listener(str(socket_path), family='AF_UNIX') as listener:
+            print('Supervising the jobs of', self.hostname)
+            while True:
+                with listener.accept() as conn:
+                    try:
+                        command, arg = conn.recv()
+                        if command == 'launch':
+                            result = self.launch(arg) is not None
+                        elif command == 'cancel':
+                            result = self.cancel(arg)
+                        else:
+                            raise NotImplementedError(command)
+                        conn.send((True, result))
+                    except Exception as e:
+                        print('ERROR in supervisor request:', e)
+                        conn.send((False, f'{type(e).__name__}: {e}'))
+
+    def launch(self, spec: dict) -> SupervisedJob:
+        """Start the job in the background. The job waits in this process for its GPUs, if needed."""
+
+        job = SupervisedJob(spec['job_id'], spec)
+        with self._lock:
+            self.jobs[job.job_id] = job
+        _insert_job(job.job_id, None, TaskStatus.Waiting.value)
+        _publish_job_info(job.job_id, self.redis_conn, status=TaskStatus.Waiting.value, hostname=self.hostname)
+        threading.Thread(target=self._start_job, args=(job,), name=f'job-{job.job_id}', daemon=True).start()
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancel_event.set()  # If it is waiting for its GPUs
+        if job.process is not None and job.process.poll() is None:
+            job.process.terminate()
+            threading.Timer(self.kill_grace_secs, self._kill, args=(job,)).start()
+        return True
+
+    def _get_fork_server(self, python_env_command: List[str]) -> ForkServer:
+        with self._lock:
+            key = tuple(python_env_command)
+            if key not in self.fork_servers:
+                self.fork_servers[key] = ForkServer(python_env_command, hypertrainer_home, self.preload)
+            return self.fork_servers[key]
+
+    @staticmethod
+    def _kill(job: SupervisedJob):
+        if job.process.poll() is None:
+            job.process.send_signal(signal.SIGKILL)
+
+    def _start_job(self, job: SupervisedJob):
+        spec = job.spec
+        try:
+            # Manage GPU dependency
+            env_vars = os.environ
+            num_gpus = spec.get('num_gpus')
+            if num_gpus is not None:
+                env_vars = os.environ.copy()
+                env_vars['CUDA_VISIBLE_DEVICES'] = ''
+                if num_gpus > 0:
+                    job.gpu_lease = GpuLockManager().acquire(num_gpus, cancel_event=job.cancel_event)
+                    env_vars['CUDA_VISIBLE_DEVICES'] = job.gpu_lease.gpu_id
+
+            if self.preload is not None:
+                try:
+                    job.process = self._get_fork_server(spec['python_env_command']).spawn(
+                        [spec['script_file'], spec['config_file']], cwd=spec['output_path'], env=dict(env_vars),
+                        stdout_path=spec['stdout_path'], stderr_path=spec['stderr_path'])
+                except Exception as e:
+                    print('WARNING: Could not fork job', job.job_id, 'from the fork server:', e)
+                    print('Starting it in a new interpreter.')
+            if job.process is None:
+                with open(spec['stdout_path'], 'w') as stdout, open(spec['stderr_path'], 'w') as stderr:
+                    job.process = subprocess.Popen(
+                        spec['python_env_command'] + [spec['script_file'], spec['config_file']],
+                        stdout=stdout, stderr=stderr, cwd=spec['output_path'], universal_newlines=True, env=env_vars)
+        except InterruptedError:
+            self._end_job(job)  # Cancelled while waiting for its GPUs
+            return
+        except Exception as e:
+            print('ERROR while starting job', job.job_id, e)
+            _set_job_status(job.job_id, TaskStatus.RunFailed.value, unless=TaskStatus.Cancelled.value)
+            _publish_job_info(job.job_id, self.redis_conn, status=TaskStatus.RunFailed.value, end_time=time())
+            self._end_job(job)
+            return
+
+        _set_job_pid(job.job_id, job.process.pid)
+        if _set_job_status(job.job_id, TaskStatus.Running.value, unless=TaskStatus.Cancelled.value):
+            _publish_job_info(job.job_id, self.redis_conn, pid=job.process.pid, status=TaskStatus.Running.value,
+                              start_time=time(), heartbeat=time())
+        if job.cancel_event.is_set():
+            self.cancel(job.job_id)  # Cancelled while starting
+        with self._lock:
+            self._to_watch.append(job)
+        os.write(self._wake_w, b'1')
+
+    def _watch_exits(self):
+        polled_jobs = []  # Without pidfds
+        while True:
+            events = self._selector.select(timeout=None if self._use_pidfd else self.poll_secs)
+            exited_jobs = [key.data for key, _ in events if key.data is not None]
+            if any(key.data is None for key, _ in events):
+                os.read(self._wake_r, 4096)
+                with self._lock:
+                    new_jobs, self._to_watch = self._to_watch, []
+                for job in new_jobs:
+                    if self._use_pidfd:
+                        try:
+                            job.pidfd = os.pidfd_open(job.process.pid)  # Readable once the process exited
+                        except ProcessLookupError:
+                            exited_jobs.append(job)  # Already reaped by Popen.poll()
+                            continue
+                        self._selector.register(job.pidfd, selectors.EVENT_READ, job)
+                    else:
+                        polled_jobs.append(job)
+            if not self._use_pidfd:
+                exited_jobs = [job for job in polled_jobs if job.process.poll() is not None]
+                polled_jobs = [job for job in polled_jobs if job not in exited_jobs]
+            for job in exited_jobs:
+                self._on_exit(job)
+
+    def _on_exit(self, job: SupervisedJob):
+        if job.pidfd is not None:
+            self._selector.unregister(job.pidfd)
+            os.close(job.pidfd)
+        status = TaskStatus.Finished.value if job.process.wait() == 0 else TaskStatus.Crashed.value
+        if _set_job_status(job.job_id, status, unless=TaskStatus.Cancelled.value):
+            _publish_job_info(job.job_id, self.redis_conn, status=status, end_time=time())
+            print('Finished successfully:' if status == TaskStatus.Finished.value else 'Crashed!', job.job_id)
+        else:
+            print('Cancelled:', job.job_id)
+        self._end_job(job)
+
+    def _end_job(self, job: SupervisedJob):
+        if job.gpu_lease is not None:
+            job.gpu_lease.release()
+        try:
+            release_job(self.redis_conn, self.hostname, job.job_id)  # Other jobs can now be claimed in its place
+        except Exception as e:
+            print('ERROR while releasing the resources of job', job.job_id, e)
+        with self._lock:
+            self.jobs.pop(job.job_id, None)
+        job.done_event.set()
+
+    def _send_heartbeats(self):
+        """The heartbeat tells the server that the worker is alive"""
+
+        while True:
+            with self._lock:
+                job_ids = [job_id for job_id, job in self.jobs.items() if job.process is not None]
+            if len(job_ids) > 0:
+                now = time()
+                pipeline = self.redis_conn.pipeline(transaction=False)
+                for job_id in job_ids:
+                    _publish_job_info(job_id, pipeline, heartbeat=now)
+                try:
+                    pipeline.execute()
+                except Exception as e:
+                    print('ERROR while sending heartbeats:', e)
+            sleep(self.heartbeat_interval_secs)
+
+
+def supervise(redis_conn: Redis, hostname: str, preload: Optional[List[str]] = None):
+    """Run the supervisor of a worker machine (see worker.py)"""
+    Supervisor(redis_conn, hostname, preload).serve_forever()
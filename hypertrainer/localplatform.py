@@ -5,14 +5,17 @@ import subprocess
 from pathlib import Path
 
 from hypertrainer.computeplatform import ComputePlatform
+from hypertrainer.logtail import LogCache, tail_logs
 from hypertrainer.utils import TaskStatus, get_python_env_command
 
 
 class LocalPlatform(ComputePlatform):
     def __init__(self):
         self.processes = {}
+        self.log_cache = LogCache()
 
     def submit(self, task, resume=False):
+        self.log_cache.forget(task.id)  # The logs will be rewritten
         job_path: Path = self._make_job_path(task)
         config_file: Path = job_path / 'config.yaml'
         if not resume:
@@ -37,13 +40,9 @@ class LocalPlatform(ComputePlatform):
 
     def fetch_logs(self, task, keys=None):
         job_path = self._make_job_path(task)
-        logs = {}
-        patterns = ('*.log', '*.txt')
-        for pattern in patterns:
-            for f in job_path.glob(pattern):
-                p = Path(f)
-                logs[p.stem] = p.read_text()
-        return logs
+        base_cursors = self.log_cache.get_cursors(task.id)
+        deltas, cursors = tail_logs(job_path, base_cursors)
+        return self.log_cache.apply(task.id, deltas, cursors, base_cursors)
 
     def cancel(self, task):
         os.kill(int(task.job_id), signal.SIGTERM)
@@ -68,6 +67,7 @@ class LocalPlatform(ComputePlatform):
                     t.status = TaskStatus.Crashed
 
     def delete(self, task):
+        self.log_cache.forget(task.id)
         print('Deleting', task.output_path)
         shutil.rmtree(task.output_path,
                       onerror=lambda function, path, excinfo: print('ERROR', function, path, excinfo))
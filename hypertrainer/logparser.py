@@ -0,0 +1,280 @@
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+
+class LineReader:
+    """Returns the complete lines that were appended to a log since the last call.
+
+    The reader is fed with the whole, up-to-date text of the log (as returned by `ComputePlatform.fetch_logs()`), but
+    only splits the new part. If the text does not continue what was read before (e.g. the file was truncated), the
+    reader starts over and reports a reset.
+    """
+
+    def __init__(self):
+        self.consumed = 0  # Number of characters read
+        self.last_line = ''  # Last line read, used to check that the text continues what was read before
+
+    def read(self, text: str) -> Tuple[List[str], bool]:
+        """Return a tuple (new_lines, reset)"""
+
+        reset = len(text) < self.consumed or not text.startswith(self.last_line, self.consumed - len(self.last_line))
+        if reset:
+            self.consumed = 0
+            self.last_line = ''
+
+        end = text.rfind('\n', self.consumed) + 1  # An incomplete last line is kept for the next call
+        if end <= self.consumed:
+            return [], reset
+        lines = text[self.consumed:end].split('\n')[:-1]
+        self.consumed = end
+        self.last_line = lines[-1] + '\n'
+        return lines, reset
+
+
+class GrowingArray:
+    """A 2D float array to which rows can be appended in amortized O(1)"""
+
+    def __init__(self, num_cols: int):
+        self._data = np.empty((64, num_cols), dtype=float)
+        self._len = 0
+
+    def append(self, row):
+        if self._len == len(self._data):
+            self._data = np.concatenate([self._data, np.empty_like(self._data)])
+        self._data[self._len] = row
+        self._len += 1
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._data[:self._len]
+
+
+class ColumnsParser:
+    """Base class for the parsers of the logs that are made of whitespace separated columns.
+
+    The first line of a log is considered a header, and skipped, if it does not start with a digit.
+    """
+
+    def __init__(self):
+        self.num_lines = 0
+
+    def feed(self, lines: List[str]):
+        for line in lines:
+            columns = line.split()
+            if not columns:
+                continue
+            self.num_lines += 1
+            if self.num_lines == 1 and not columns[0][0].isdigit():
+                continue  # Header
+            try:
+                self.parse(columns)
+            except (ValueError, IndexError):
+                print(f'ERROR while interpreting logs: cannot parse line "{line}"')
+
+    def parse(self, columns: List[str]):
+        raise NotImplementedError
+
+
+class ProgressParser(ColumnsParser):
+    # Columns = epoch_idx, phase, iter_idx, iter_per_epoch, unix_timestamp
+
+    def __init__(self):
+        super().__init__()
+        self.cur_phase = None
+        self.cur_epoch = None
+        self.cur_iter = None
+        self.iter_per_epoch = None
+        self.epoch_start_times: Dict[int, int] = {}  # The first timestamp of each epoch
+
+    def parse(self, columns: List[str]):
+        ep_idx, iter_idx, iter_per_epoch, timestamp = (int(float(columns[i])) for i in (0, 2, 3, 4))
+        self.cur_phase = columns[1]
+        self.cur_epoch = ep_idx
+        self.cur_iter = iter_idx
+        self.iter_per_epoch = iter_per_epoch
+        self.epoch_start_times[ep_idx] = min(timestamp, self.epoch_start_times.get(ep_idx, timestamp))
+
+    @property
+    def epoch_duration(self) -> Optional[float]:
+        """The mean duration of the epochs, or None if there is only one epoch so far"""
+
+        if len(self.epoch_start_times) < 2:
+            return None
+        # The mean of the differences between consecutive start times telescopes to this
+        first_epoch, last_epoch = min(self.epoch_start_times), max(self.epoch_start_times)
+        duration = self.epoch_start_times[last_epoch] - self.epoch_start_times[first_epoch]
+        return duration / (len(self.epoch_start_times) - 1)
+
+    def get_time_remaining(self, num_epochs: int, now: float) -> Tuple[Optional[float], Optional[float]]:
+        """Return the estimated time remaining for the current epoch, and for the whole task, in seconds"""
+
+        epoch_duration = self.epoch_duration
+        if epoch_duration is None:
+            return None, None
+        cur_ep_elapsed = now - self.epoch_start_times[max(self.epoch_start_times)]
+        ep_time_remain = epoch_duration - cur_ep_elapsed
+        if num_epochs < 0:
+            return max(ep_time_remain, 0), None  # Unknown number of epochs
+        total_time_remain = ep_time_remain + epoch_duration * (num_epochs - self.cur_epoch - 1)
+        return max(ep_time_remain, 0), max(total_time_remain, 0)
+
+
+class MetricParser(ColumnsParser):
+    # Columns: epoch_idx, value
+
+    def __init__(self):
+        super().__init__()
+        self.data = GrowingArray(2)
+
+    def parse(self, columns: List[str]):
+        self.data.append([float(columns[0]), float(columns[1])])
+
+    @property
+    def values(self):
+        return self.data.values
+
+    def get_points(self, start: int) -> List[Tuple[str, float, float]]:
+        """Return the (label, epoch, value) points parsed after the first `start` ones"""
+        return [('', epoch, value) for epoch, value in self.data.values[start:].tolist()]
+
+    @property
+    def num_points(self):
+        return len(self.data.values)
+
+
+class ClasswiseMetricParser(ColumnsParser):
+    # Columns: epoch_idx, class_idx, value
+
+    def __init__(self):
+        super().__init__()
+        self.data: Dict[str, GrowingArray] = {}
+        self.points: List[Tuple[str, float, float]] = []  # In order of appearance
+
+    def parse(self, columns: List[str]):
+        row = [float(columns[0]), float(columns[2])]
+        try:
+            label = str(int(float(columns[1])))
+        except ValueError:
+            label = columns[1]
+        if label not in self.data:
+            self.data[label] = GrowingArray(2)
+        self.data[label].append(row)
+        self.points.append((label, row[0], row[1]))
+
+    @property
+    def values(self):
+        return {label: a.values for label, a in self.data.items()}
+
+    def get_points(self, start: int) -> List[Tuple[str, float, float]]:
+        """Return the (label, epoch, value) points parsed after the first `start` ones"""
+        return self.points[start:]
+
+    @property
+    def num_points(self):
+        return len(self.points)
+
+
+class LogInterpreter:
+    """Keeps the state of the parsing of the logs of one task, so that each refresh only parses the new lines.
+
+    The interpreter of a task is shared by all the threads that monitor it: hold its `lock` while using it.
+    """
+
+    _instances: Dict[int, 'LogInterpreter'] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.readers: Dict[str, LineReader] = {}
+        self.parsers: Dict[str, ColumnsParser] = {}
+        # For pop_new_points()
+        self._num_popped: Dict[str, int] = {}
+        self._restarted_metrics: Set[str] = set()
+
+    @classmethod
+    def of_task(cls, task_id: int) -> 'LogInterpreter':
+        with cls._instances_lock:
+            if task_id not in cls._instances:
+                cls._instances[task_id] = LogInterpreter()
+            return cls._instances[task_id]
+
+    @classmethod
+    def forget_task(cls, task_id: int):
+        with cls._instances_lock:
+            cls._instances.pop(task_id, None)
+
+    @staticmethod
+    def is_interpreted(log_name: str):
+        return log_name == 'progress' or log_name.startswith('metric_')
+
+    def feed(self, logs: Optional[Dict[str, str]]):
+        """Parse the lines appended to the logs since the last call.
+
+        The logs must be the result of a successful fetch: the interpreted logs missing from it are forgotten (their
+        files were deleted). If the fetch failed, pass None: nothing changes.
+        """
+
+        if logs is None:
+            return
+        for name, log in logs.items():
+            if not self.is_interpreted(name):
+                continue
+            reader = self.readers.setdefault(name, LineReader())
+            lines, reset = reader.read(log)
+            if reset or name not in self.parsers:
+                self.parsers[name] = self._make_parser(name)
+                if name != 'progress':
+                    self._num_popped[name] = 0
+                    self._restarted_metrics.add(self.metric_name(name))
+            self.parsers[name].feed(lines)
+        for name in set(self.parsers.keys()) - set(logs.keys()):
+            # The log does not exist anymore
+            del self.parsers[name]
+            del self.readers[name]
+            self._num_popped.pop(name, None)
+
+    def pop_new_points(self) -> Tuple[Set[str], List[Tuple[str, str, float, float]]]:
+        """Return what changed in the metrics since the last call, for persisting them (see hypertrainer.metricstore).
+
+        Returns a tuple (restarted_metrics, new_points). The metrics in restarted_metrics were parsed again from the
+        start (e.g. the log was rewritten), so their previous points must be discarded. The new points are tuples
+        (metric, label, epoch, value).
+        """
+
+        restarted_metrics, self._restarted_metrics = self._restarted_metrics, set()
+        new_points = []
+        for name, num_popped in self._num_popped.items():
+            parser = self.parsers[name]
+            new_points.extend((self.metric_name(name),) + p for p in parser.get_points(num_popped))
+            self._num_popped[name] = parser.num_points
+        return restarted_metrics, new_points
+
+    @staticmethod
+    def metric_name(log_name: str) -> str:
+        m_name = log_name.partition('_')[2]  # Example: 'd_j_trump'.partition('_') -> ('d', '_', 'j_trump')
+        if log_name.startswith('metric_classwise_'):
+            m_name = m_name.partition('_')[2]
+        return m_name
+
+    @staticmethod
+    def _make_parser(name: str) -> ColumnsParser:
+        if name == 'progress':
+            return ProgressParser()
+        elif name.startswith('metric_classwise_'):
+            return ClasswiseMetricParser()
+        else:
+            return MetricParser()
+
+    @property
+    def progress(self) -> Optional[ProgressParser]:
+        return self.parsers.get('progress')
+
+    def get_metrics(self) -> dict:
+        metrics = {}
+        for name, parser in self.parsers.items():
+            if name == 'progress' or len(parser.values) == 0:
+                continue
+            metrics[self.metric_name(name)] = parser.values
+        return metrics
@@ -0,0 +1,102 @@
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+log_patterns = ('*.log', '*.txt')
+
+
+def tail_logs(output_path, cursors: Optional[Dict[str, dict]] = None) -> Tuple[Dict[str, dict], Dict[str, dict]]:
+    """Read the data appended to the log files of a task since the last call.
+
+    `cursors` is the dict returned by the previous call (or None for the first call). It maps each log name to a dict
+    {'offset': ..., 'inode': ..., 'size': ...}. Returns a tuple (deltas, cursors) where deltas is a dict like:
+        {
+            'out': {'data': 'new text', 'reset': False},
+            'err': {'data': 'whole text', 'reset': True}
+        }
+    A delta has reset=True when the file is new, has been replaced (different inode) or truncated; in that case its
+    data is the whole content of the file, and the previous content must be discarded.
+    Logs that no longer exist on disk are absent from the returned cursors.
+    """
+
+    cursors = {} if cursors is None else cursors
+    deltas = {}
+    new_cursors = {}
+    for pattern in log_patterns:
+        for log_file in Path(output_path).glob(pattern):
+            log_name = log_file.stem
+            try:
+                with log_file.open('rb') as f:
+                    stat = os.fstat(f.fileno())
+                    cursor = cursors.get(log_name)
+                    reset = cursor is None or cursor['inode'] != stat.st_ino or stat.st_size < cursor['offset']
+                    offset = 0 if reset else cursor['offset']
+                    f.seek(offset)
+                    raw = f.read(stat.st_size - offset)  # Ignore data appended after the stat
+            except FileNotFoundError:
+                continue  # Deleted in the meantime
+            text, num_bytes = decode_complete(raw)
+            deltas[log_name] = {'data': text, 'reset': reset}
+            new_cursors[log_name] = {'offset': offset + num_bytes, 'inode': stat.st_ino, 'size': stat.st_size}
+    return deltas, new_cursors
+
+
+def decode_complete(raw: bytes) -> Tuple[str, int]:
+    """Decode utf-8 bytes, leaving out an incomplete multi-byte character at the end.
+
+    Returns the text and the number of bytes that were consumed.
+    """
+
+    try:
+        return raw.decode('utf-8'), len(raw)
+    except UnicodeDecodeError as e:
+        if e.reason == 'unexpected end of data':
+            return raw[:e.start].decode('utf-8', errors='replace'), e.start
+        return raw.decode('utf-8', errors='replace'), len(raw)
+
+
+class LogCache:
+    """Server-side cache of the logs of each task, updated with the deltas returned by `tail_logs()`.
+
+    Thread-safe: the logs of several tasks can be fetched concurrently.
+    """
+
+    def __init__(self):
+        self._cursors: Dict[object, Dict[str, dict]] = {}
+        self._logs: Dict[object, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def get_cursors(self, key) -> Dict[str, dict]:
+        with self._lock:
+            return dict(self._cursors.get(key, {}))
+
+    def apply(self, key, deltas: Dict[str, dict], cursors: Dict[str, dict],
+              base_cursors: Dict[str, dict]) -> Dict[str, str]:
+        """Stitch the deltas onto the cached logs, and return a copy of the up-to-date logs.
+
+        `base_cursors` are the cursors that were used to fetch the deltas. If the cache has been updated in the
+        meantime (concurrent fetch), the deltas are discarded; the next fetch will start from the cached cursors.
+        """
+
+        with self._lock:
+            old_logs = self._logs.get(key, {})
+            if self._cursors.get(key, {}) != base_cursors:
+                return dict(old_logs)
+            logs = {}
+            for log_name in cursors.keys():
+                delta = deltas.get(log_name)
+                if delta is None:
+                    logs[log_name] = old_logs.get(log_name, '')
+                elif delta['reset']:
+                    logs[log_name] = delta['data']
+                else:
+                    logs[log_name] = old_logs.get(log_name, '') + delta['data']
+            self._logs[key] = logs
+            self._cursors[key] = cursors
+            return dict(logs)
+
+    def forget(self, key):
+        with self._lock:
+            self._logs.pop(key, None)
+            self._cursors.pop(key, None)
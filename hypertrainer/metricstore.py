@@ -0,0 +1,145 @@
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from peewee import IntegerField, CharField, FloatField, chunked, fn
+
+from hypertrainer.db import BaseModel, database
+from hypertrainer.logparser import LogInterpreter
+
+
+class MetricPoint(BaseModel):
+    """One value of a metric of a task, as parsed from its logs.
+
+    The points are kept on the server, so that the metrics can be shown without contacting the worker. The table is
+    append-only, except that the points of a metric are replaced when its log is parsed again from the start.
+    """
+
+    task_id = IntegerField()
+    metric = CharField()
+    label = CharField(default='')  # The class, for classwise metrics
+    epoch = FloatField()
+    value = FloatField()
+
+    class Meta:
+        # When changing the schema, also add a migration in db.py
+        indexes = (
+            (('task_id', 'metric'), False),
+        )
+
+
+_save_lock = threading.Lock()
+
+
+def save_new_points(task_ids: Iterable[int], batch_size=500):
+    """Append the points that were parsed since the last call, for the specified tasks, in one transaction.
+
+    The calls are serialized, and the points of a task are popped and written while holding the lock of its
+    interpreter: each point is written once, even if several threads monitor the task.
+    """
+
+    with _save_lock, database.atomic():
+        for task_id in task_ids:
+            interpreter = LogInterpreter.of_task(task_id)
+            with interpreter.lock:
+                restarted_metrics, new_points = interpreter.pop_new_points()
+                if restarted_metrics:
+                    MetricPoint.delete().where((MetricPoint.task_id == task_id)
+                                               & MetricPoint.metric.in_(list(restarted_metrics))).execute()
+                for batch in chunked(new_points, batch_size):
+                    MetricPoint.insert_many([(task_id,) + p for p in batch],
+                                            fields=[MetricPoint.task_id, MetricPoint.metric, MetricPoint.label,
+                                                    MetricPoint.epoch, MetricPoint.value]).execute()
+
+
+def load_metrics(task_ids: Iterable[int]) -> Dict[int, dict]:
+    """Return the stored metrics of the tasks, as a dict {task_id: metrics}.
+
+    The metrics are in the same format as Task.metrics: {metric: array} where each row of the array is (epoch, value),
+    or {metric: {label: array}} for classwise metrics.
+    """
+
+    task_ids = list(task_ids)
+    points = defaultdict(list)
+    query = (MetricPoint
+             .select(MetricPoint.task_id, MetricPoint.metric, MetricPoint.label, MetricPoint.epoch, MetricPoint.value)
+             .where(MetricPoint.task_id.in_(task_ids))
+             .order_by(MetricPoint.id)
+             .tuples())
+    for task_id, metric, label, epoch, value in query.iterator():
+        points[(task_id, metric, label)].append((epoch, value))
+
+    metrics = {task_id: {} for task_id in task_ids}
+    for (task_id, metric, label), values in points.items():
+        values = np.array(values, dtype=float)
+        if label == '':
+            metrics[task_id][metric] = values
+        else:
+            metrics[task_id].setdefault(metric, {})[label] = values
+    return metrics
+
+
+def load_metric_summaries(task_ids: Iterable[int]) -> Dict[int, Dict[Tuple[str, str], Tuple[float, float, float]]]:
+    """Return the final, min and max value of each stored metric line of the tasks, computed by the database, as a dict
+    {task_id: {(metric, label): (final, min, max)}}"""
+
+    task_ids = list(task_ids)
+    lines = (MetricPoint
+             .select(fn.MAX(MetricPoint.id).alias('last_id'), fn.MIN(MetricPoint.value).alias('min_value'),
+                     fn.MAX(MetricPoint.value).alias('max_value'))
+             .where(MetricPoint.task_id.in_(task_ids))
+             .group_by(MetricPoint.task_id, MetricPoint.metric, MetricPoint.label))
+    query = (MetricPoint
+             .select(MetricPoint.task_id, MetricPoint.metric, MetricPoint.label, MetricPoint.value,
+                     lines.c.min_value, lines.c.max_value)
+             .join(lines, on=(MetricPoint.id == lines.c.last_id))
+             .tuples())
+    summaries = {task_id: {} for task_id in task_ids}
+    for task_id, metric, label, final, min_value, max_value in query.iterator():
+        summaries[task_id][(metric, label)] = (final, min_value, max_value)
+    return summaries
+
+
+def load_metric_lines(task_ids: Iterable[int], metric: str, label: str = '') -> Dict[int, np.ndarray]:
+    """Return one line of a metric for several tasks, as a dict {task_id: array of (epoch, value) rows}"""
+
+    task_ids = list(task_ids)
+    query = (MetricPoint
+             .select(MetricPoint.task_id, MetricPoint.epoch, MetricPoint.value)
+             .where(MetricPoint.task_id.in_(task_ids) & (MetricPoint.metric == metric) & (MetricPoint.label == label))
+             .order_by(MetricPoint.id)
+             .tuples())
+    rows = np.array(list(query.iterator()), dtype=float).reshape(-1, 3)
+    rows = rows[np.argsort(rows[:, 0], kind='stable')]  # Group by task, keeping the order of the points
+    starts = np.searchsorted(rows[:, 0], task_ids, side='left')
+    ends = np.searchsorted(rows[:, 0], task_ids, side='right')
+    return {task_id: rows[start:end, 1:] for task_id, start, end in zip(task_ids, starts, ends)}
+
+
+def list_metrics(task_ids: Iterable[int]) -> List[Tuple[str, str]]:
+    """Return the (metric, label) lines that are stored for at least one of the tasks"""
+
+    query = (MetricPoint
+             .select(MetricPoint.metric, MetricPoint.label)
+             .where(MetricPoint.task_id.in_(list(task_ids)))
+             .distinct()
+             .order_by(MetricPoint.metric, MetricPoint.label)
+             .tuples())
+    return list(query)
+
+
+def load_metric_range(task_id: int, metric: str, label: str, x_start: float, x_end: float) -> np.ndarray:
+    """Return the stored points of one line of a metric, in the epoch range [x_start, x_end], as (epoch, value) rows"""
+
+    query = (MetricPoint
+             .select(MetricPoint.epoch, MetricPoint.value)
+             .where((MetricPoint.task_id == task_id) & (MetricPoint.metric == metric) & (MetricPoint.label == label)
+                    & MetricPoint.epoch.between(x_start, x_end))
+             .order_by(MetricPoint.id)
+             .tuples())
+    return np.array(list(query), dtype=float).reshape(-1, 2)
+
+
+def delete_metrics(task_ids: Iterable[int]):
+    MetricPoint.delete().where(MetricPoint.task_id.in_(list(task_ids))).execute()
@@ -0,0 +1,243 @@
+import os
+import time
+from typing import Dict, Optional
+
+from redis import Redis
+from rq import Queue
+from rq.exceptions import DequeueTimeout, NoSuchJobError
+
+from hypertrainer.htplatform_worker import job_info_key
+
+resource_names = ('num_gpus', 'num_cpus', 'mem_gb')
+wakeup_channel = 'hypertrainer:resources'  # Published when jobs are enqueued, or when resources are released
+
+running_key = 'hypertrainer:running'  # Hash {project: number of jobs that hold resources}
+priority_weight = 1e12  # Score of a waiting job: its sequence number - priority * priority_weight
+
+# The waiting jobs of each project are in the sorted set 'hypertrainer:pending:<queue>:<project>', by priority then in
+# order. The set 'hypertrainer:pending:<queue>' holds the projects that may have waiting jobs.
+
+# Publish a job that has just been enqueued: its requirements, and its place among the waiting jobs of its project.
+# KEYS: job info. ARGV: job id, queue name, project, priority, num_gpus, num_cpus, mem_gb, wakeup channel.
+_enqueue_script = """
+local seq = redis.call('INCR', 'hypertrainer:pending_seq')
+redis.call('HSET', KEYS[1], 'queue', ARGV[2], 'project', ARGV[3], 'priority', ARGV[4], 'seq', seq,
+           'req_num_gpus', ARGV[5], 'req_num_cpus', ARGV[6], 'req_mem_gb', ARGV[7])
+local projects_key = 'hypertrainer:pending:' .. ARGV[2]
+redis.call('ZADD', projects_key .. ':' .. ARGV[3], seq - tonumber(ARGV[4]) * """ + repr(priority_weight) + """, ARGV[1])
+redis.call('SADD', projects_key, ARGV[3])
+redis.call('PUBLISH', ARGV[8], ARGV[2])
+"""
+
+# Claim the waiting job that fits the free resources of the host with the highest priority, atomically. Between jobs
+# of the same priority, the project with the fewest running jobs is chosen (fair share), then the oldest job. Only
+# the first ARGV[4] waiting jobs of each project are considered.
+# KEYS: queue list, host hash.
+# ARGV: job info key prefix, hostname, queue name, max number of jobs scanned per project, dry run (1: do not claim).
+_claim_script = """
+local names = {'num_gpus', 'num_cpus', 'mem_gb'}
+local free = {}
+for _, r in ipairs(names) do
+    local used = tonumber(redis.call('HGET', KEYS[2], 'used_' .. r) or '0')
+    free[r] = tonumber(redis.call('HGET', KEYS[2], r) or '0') - used
+end
+local function fits(info_key)
+    for _, r in ipairs(names) do
+        if tonumber(redis.call('HGET', info_key, 'req_' .. r) or '0') > free[r] then return false end
+    end
+    return true
+end
+local projects_key = 'hypertrainer:pending:' .. ARGV[3]
+while true do
+    local best = nil
+    for _, project in ipairs(redis.call('SMEMBERS', projects_key)) do
+        local pending_key = projects_key .. ':' .. project
+        local pending = redis.call('ZRANGE', pending_key, 0, tonumber(ARGV[4]) - 1, 'WITHSCORES')
+        if #pending == 0 then
+            redis.call('SREM', projects_key, project)
+        end
+        for i = 1, #pending, 2 do
+            local info_key = ARGV[1] .. pending[i]
+            if fits(info_key) then
+                local c = {job_id = pending[i], project = project, pending_key = pending_key, info_key = info_key,
+                           priority = tonumber(redis.call('HGET', info_key, 'priority') or '0'),
+                           running = tonumber(redis.call('HGET', '""" + running_key + """', project) or '0'),
+                           score = tonumber(pending[i + 1])}
+                if best == nil or c.priority > best.priority
+                        or (c.priority == best.priority and (c.running < best.running
+                            or (c.running == best.running and c.score < best.score))) then
+                    best = c
+                end
+                break
+            end
+        end
+    end
+    if best == nil then return false end
+    if ARGV[5] == '1' then return best.job_id end
+    redis.call('ZREM', best.pending_key, best.job_id)
+    if redis.call('LREM', KEYS[1], 1, best.job_id) == 1 then  -- Else it was removed from the queue (e.g. cancelled)
+        for _, r in ipairs(names) do
+            local required = tonumber(redis.call('HGET', best.info_key, 'req_' .. r) or '0')
+            redis.call('HINCRBYFLOAT', KEYS[2], 'used_' .. r, required)
+        end
+        redis.call('HINCRBY', '""" + running_key + """', best.project, 1)
+        redis.call('HSET', best.info_key, 'reserved_on', ARGV[2])
+        return best.job_id
+    end
+end
+"""
+
+# Give back the resources reserved by a job. Does nothing if they were already released.
+# KEYS: host hash, job info key. ARGV: hostname, wakeup channel.
+_release_script = """
+if redis.call('HGET', KEYS[2], 'reserved_on') ~= ARGV[1] then return 0 end
+for _, r in ipairs({'num_gpus', 'num_cpus', 'mem_gb'}) do
+    local required = tonumber(redis.call('HGET', KEYS[2], 'req_' .. r) or '0')
+    redis.call('HINCRBYFLOAT', KEYS[1], 'used_' .. r, -required)
+end
+local project = redis.call('HGET', KEYS[2], 'project')
+if project then redis.call('HINCRBY', '""" + running_key + """', project, -1) end
+redis.call('HDEL', KEYS[2], 'reserved_on')
+redis.call('PUBLISH', ARGV[2], ARGV[1])
+return 1
+"""
+
+# Change the priority of a job, if it is still waiting. KEYS: job info. ARGV: job id, priority.
+_set_priority_script = """
+local queue, project, seq = unpack(redis.call('HMGET', KEYS[1], 'queue', 'project', 'seq'))
+if not queue then return 0 end
+local pending_key = 'hypertrainer:pending:' .. queue .. ':' .. project
+if not redis.call('ZSCORE', pending_key, ARGV[1]) then return 0 end
+redis.call('ZADD', pending_key, tonumber(seq) - tonumber(ARGV[2]) * """ + repr(priority_weight) + """, ARGV[1])
+redis.call('HSET', KEYS[1], 'priority', ARGV[2])
+return 1
+"""
+
+# Forget a job that will not be claimed (e.g. cancelled). KEYS: job info. ARGV: job id.
+_unqueue_script = """
+local queue, project = unpack(redis.call('HMGET', KEYS[1], 'queue', 'project'))
+if queue then redis.call('ZREM', 'hypertrainer:pending:' .. queue .. ':' .. project, ARGV[1]) end
+"""
+
+
+def host_key(hostname: str):
+    """The redis hash where the capacity of a worker machine, and the resources in use, are published"""
+    return f'hypertrainer:host:{hostname}'
+
+
+def job_requirements(config: dict) -> Dict[str, float]:
+    """The resources that a job needs, as declared in its config. The resources that are not declared are not
+    accounted for (as before the jobs could declare them)."""
+    return {r: config.get(r) or 0 for r in resource_names}
+
+
+def get_capacity(num_gpus: Optional[int] = None, num_cpus: Optional[int] = None, mem_gb: Optional[float] = None):
+    """The capacity of this machine. By default: the visible GPUs, all the cores and all the physical memory."""
+
+    if num_gpus is None:
+        cuda_visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES', '')
+        num_gpus = len(cuda_visible_devices.split(',')) if cuda_visible_devices != '' else 0
+    if num_cpus is None:
+        num_cpus = os.cpu_count()
+    if mem_gb is None:
+        mem_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2 ** 30
+    return {'num_gpus': num_gpus, 'num_cpus': num_cpus, 'mem_gb': mem_gb}
+
+
+def advertise_capacity(redis_conn: Redis, hostname: str, capacity: Dict[str, float]):
+    """Publish the capacity of a worker machine. No resource is in use at this point (the worker just started)."""
+
+    redis_conn.hset(host_key(hostname), mapping={**capacity, **{'used_' + r: 0 for r in resource_names}})
+
+
+def publish_job(redis_conn: Redis, queue: Queue, job_id: str, project: str, priority: int,
+                requirements: Dict[str, float]):
+    """Make a job enqueued in the queue claimable (see claim_job). The redis connection can be a pipeline."""
+
+    redis_conn.eval(_enqueue_script, 1, job_info_key(job_id), job_id, queue.name, project, priority,
+                    *[requirements[r] for r in resource_names], wakeup_channel)
+
+
+def set_job_priority(redis_conn: Redis, job_id: str, priority: int) -> bool:
+    """Change the priority of a waiting job. Returns False if the job is not waiting anymore."""
+    return redis_conn.eval(_set_priority_script, 1, job_info_key(job_id), job_id, priority) == 1
+
+
+def unqueue_job(redis_conn: Redis, job_id: str):
+    """Forget a waiting job that was removed from the queue (e.g. cancelled)"""
+    redis_conn.eval(_unqueue_script, 1, job_info_key(job_id), job_id)
+
+
+def claim_job(redis_conn: Redis, queue: Queue, hostname: str, max_scanned: int = 100) -> Optional[str]:
+    """Remove from the queue the waiting job to run next on the host, among those that fit its free resources, and
+    reserve its resources.
+
+    The jobs are taken by priority, then fairly between the projects (the project with the fewest running jobs first),
+    then in order. Returns the job id, or None if no job fits. Only the first `max_scanned` waiting jobs of each
+    project are considered.
+    """
+
+    job_id = redis_conn.eval(_claim_script, 2, queue.key, host_key(hostname), job_info_key(''), hostname, queue.name,
+                             max_scanned, 0)
+    return None if job_id is None else job_id.decode()
+
+
+def peek_job(redis_conn: Redis, queue: Queue, hostname: str, max_scanned: int = 100) -> Optional[str]:
+    """The id of the job that claim_job() would claim, without claiming it (None if no job fits)"""
+
+    job_id = redis_conn.eval(_claim_script, 2, queue.key, host_key(hostname), job_info_key(''), hostname, queue.name,
+                             max_scanned, 1)
+    return None if job_id is None else job_id.decode()
+
+
+def release_job(redis_conn: Redis, hostname: str, job_id: str):
+    """Give back the resources reserved by a job, when it ends"""
+    redis_conn.eval(_release_script, 2, host_key(hostname), job_info_key(job_id), hostname, wakeup_channel)
+
+
+class ResourceQueue(Queue):
+    """An rq queue from which workers only dequeue the jobs that fit the free resources of their machine.
+
+    The jobs that do not fit stay in the queue, for another machine or for later. A smaller job can thus start before a
+    bigger one that was enqueued first. The requirements, project and priority of the jobs are published by HtPlatform
+    when it enqueues them (see publish_job).
+    While no job fits, the worker waits for a message on the wakeup channel.
+    """
+
+    hostname: Optional[str] = None  # Set by worker.py
+    poll_secs = 10  # How often to look again for a job anyway, in case a wakeup message was missed
+    _pubsub = None
+
+    @classmethod
+    def dequeue_any(cls, queues, timeout, connection=None, job_class=None, serializer=None,
+                    death_penalty_class=None):
+        deadline = None if timeout is None else time.time() + timeout
+        if timeout is not None and cls._pubsub is None:
+            cls._pubsub = connection.pubsub(ignore_subscribe_messages=True)
+            cls._pubsub.subscribe(wakeup_channel)  # Before looking at the queue, so that no wakeup is missed
+        while True:
+            for queue in queues:
+                job_id = claim_job(connection, queue, cls.hostname)
+                if job_id is None:
+                    continue
+                try:
+                    job = queue.job_class.fetch(job_id, connection=connection, serializer=serializer)
+                except NoSuchJobError:
+                    release_job(connection, cls.hostname, job_id)  # Deleted meanwhile
+                    continue
+                return job, queue
+            if deadline is None:
+                return None  # Not blocking (burst mode)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise DequeueTimeout(timeout, [q.key for q in queues])
+            cls._wait_for_wakeup(min(remaining, cls.poll_secs))
+
+    @classmethod
+    def _wait_for_wakeup(cls, timeout: float):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if cls._pubsub.get_message(timeout=deadline - time.time()) is not None:
+                break
+        while cls._pubsub.get_message() is not None:
+            pass  # Several wakeups are as good as one
@@ -1,9 +1,11 @@
+import re
+import shlex
 import subprocess
-import tempfile
-from glob import glob
+import uuid
 from pathlib import Path
 
 from hypertrainer.computeplatform import ComputePlatform
+from hypertrainer.logtail import LogCache, decode_complete, log_patterns
 from hypertrainer.utils import TaskStatus, parse_columns
 
 
@@ -24,38 +26,96 @@ class SlurmPlatform(ComputePlatform):
         self.user = server_user.split('@')[0]
         self.submission_template = Path('platform/slurm/slurm_template.sh')
         self.setup_template = Path('platform/slurm/slurm_setup.sh')
+        self.log_cache = LogCache()
 
     def submit(self, task, resume=False):
-        job_remote_dir = self._make_job_path(task)
+        return self.submit_many([task], resume=resume)[0]
+
+    def submit_many(self, tasks, resume=False):
+        """Submit all the tasks in one ssh session.
+
+        The setup script of each task runs in its own login shell ($SHELL), whose last output line (the job id printed
+        by sbatch) is echoed. Thus the output has one line per task, which is empty if the submission failed. The
+        tasks whose submission failed get an empty job id; the others keep theirs.
+        """
+
+        script = ''
+        for t in tasks:
+            # Unique: no line of the setup script can end the heredoc
+            terminator = f'HYPERTRAINER_EOF_{uuid.uuid4().hex}'
+            script += (f"echo \"$(\"${{SHELL:-sh}}\" -s <<'{terminator}' | tail -n 1\n"
+                       f"{self._make_setup_script(t, resume).rstrip()}\n"
+                       f"{terminator}\n"
+                       f")\"\n")
+        completed_process = subprocess.run(['ssh', self.server_user, 'sh -s'], input=script.encode(),
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        lines = completed_process.stdout.decode('utf-8').split('\n')
+        job_ids = []
+        for i in range(len(tasks)):
+            line = lines[i].strip() if i < len(lines) else ''  # The session may have ended early
+            job_ids.append(line if re.fullmatch(r'\d+(;\S+)?', line) else '')  # sbatch --parsable: id[;cluster]
+        if '' in job_ids:
+            print(f'ERROR: Slurm submission failed for {job_ids.count("")} of {len(tasks)} task(s) '
+                  f'(ssh exit code {completed_process.returncode}):', completed_process.stderr.decode('utf-8'))
+        return job_ids
+
+    def _make_setup_script(self, task, resume):
+        self.log_cache.forget(task.id)  # The logs will be rewritten
         if resume:
-            setup_script = self.replace_variables(
-                'cd $HYPERTRAINER_JOB_DIR && sbatch --parsable $HYPERTRAINER_NAME.sh', task)
-        else:
-            task.output_path = job_remote_dir
-            setup_script = self.replace_variables(self.setup_template.read_text(), task,
-                                                  submission=self.submission_template.read_text())
-        completed_process = None
-        try:
-            completed_process = subprocess.run(['ssh', self.server_user],
-                                               input=setup_script.encode(), stdout=subprocess.PIPE,
-                                               stderr=subprocess.PIPE)
-            completed_process.check_returncode()
-        except subprocess.CalledProcessError:
-            print(completed_process.stderr)
-            raise  # FIXME handle error
-        job_id = completed_process.stdout.decode('utf-8').strip()
-        return job_id
+            return self.replace_variables('cd $HYPERTRAINER_JOB_DIR && sbatch --parsable $HYPERTRAINER_NAME.sh', task)
+        task.output_path = self._make_job_path(task)
+        return self.replace_variables(self.setup_template.read_text(), task,
+                                      submission=self.submission_template.read_text())
 
     def fetch_logs(self, task, keys=None):
-        logs = {}
-        with tempfile.TemporaryDirectory() as tmpdir:
-            # Get all .txt, .log files in output path
-            subprocess.run(['scp', self.server_user + ':' + self._make_job_path(task) + '/*.{log,txt}', tmpdir],
-                           stderr=subprocess.DEVNULL)  # Ignore errors (e.g. if *.log doesn't exist)
-            for f in glob(tmpdir + '/*'):
-                p = Path(f)
-                logs[p.stem] = p.read_text()
-        return logs
+        base_cursors = self.log_cache.get_cursors(task.id)
+        script = self._make_tail_script(self._make_job_path(task), base_cursors)
+        completed_process = subprocess.run(['ssh', self.server_user], input=script.encode(),
+                                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if completed_process.returncode == 255:
+            return None  # ssh could not reach the server; the missing logs must not be taken as deleted
+        deltas, cursors = self._parse_tail_output(completed_process.stdout, base_cursors)
+        return self.log_cache.apply(task.id, deltas, cursors, base_cursors)
+
+    @staticmethod
+    def _make_tail_script(job_dir, cursors):
+        """Make a shell script printing the data appended to each log file since `cursors`.
+
+        For each log file, the script prints a header line "inode size start name", followed by the bytes of the file
+        in the range [start, size).
+        """
+
+        cases = ''.join(f"    {shlex.quote(name)}) echo {c['inode']} {c['offset']};;\n" for name, c in cursors.items())
+        return (f"cd {shlex.quote(job_dir)} || exit 0\n"
+                f"for f in {' '.join(log_patterns)}; do\n"
+                f"  [ -f \"$f\" ] || continue\n"
+                f"  name=\"${{f%.*}}\"\n"
+                f"  cursor=$(case \"$name\" in\n{cases}    *) echo -1 0;;\n  esac)\n"
+                f"  set -- $cursor $(stat -c '%i %s' \"$f\")\n"
+                f"  if [ \"$1\" = \"$3\" ] && [ \"$4\" -ge \"$2\" ]; then start=$2; else start=0; fi\n"
+                f"  echo \"$3 $4 $start $name\"\n"
+                f"  tail -c +$((start + 1)) \"$f\" | head -c $(($4 - start))\n"
+                f"done\n")
+
+    @staticmethod
+    def _parse_tail_output(output: bytes, cursors):
+        """Parse the output of the script made by `_make_tail_script()`. Returns a tuple (deltas, cursors)."""
+
+        deltas, new_cursors = {}, {}
+        pos = 0
+        while pos < len(output):
+            header_end = output.index(b'\n', pos)
+            inode, size, start, name = output[pos:header_end].decode('utf-8').split(' ', 3)
+            inode, size, start = int(inode), int(size), int(start)
+            pos = header_end + 1
+            raw = output[pos:pos + size - start]
+            pos += size - start
+            cursor = cursors.get(name)
+            reset = cursor is None or cursor['inode'] != inode or cursor['offset'] != start
+            text, num_bytes = decode_complete(raw)
+            deltas[name] = {'data': text, 'reset': reset}
+            new_cursors[name] = {'offset': start + num_bytes, 'inode': inode, 'size': size}
+        return deltas, new_cursors
 
     def update_tasks(self, tasks):
         job_ids = [t.job_id for t in tasks]
@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class Snapshot:
+    """A value loaded by a SnapshotCache, with the time at which its loading started"""
+
+    __slots__ = ('value', 'time')
+
+    def __init__(self, value, load_time: float):
+        self.value = value
+        self.time = load_time
+
+    @property
+    def age(self) -> float:
+        """Seconds since the snapshot was taken"""
+        return time.time() - self.time
+
+
+class SnapshotCache:
+    """A TTL cache where concurrent loads of the same key are coalesced into a single one (single-flight).
+
+    Thus, the rate of calls to `load` is capped to one per key per `ttl_secs`, however many callers there are. At most
+    `max_entries` snapshots are kept: the least recently used ones are dropped.
+    """
+
+    def __init__(self, load: Callable[[Hashable], Any], ttl_secs: float, max_entries: int = 64):
+        self.ttl_secs = ttl_secs
+        self.max_entries = max_entries
+        self._load_fn = load
+        self._snapshots: Dict[Hashable, Snapshot] = OrderedDict()  # From the least to the most recently used
+        self._in_flight: Dict[Hashable, Future] = {}
+        self._generation = 0  # Incremented by invalidate(), so that loads started before are not cached
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='snapshot')
+
+    def get(self, key: Hashable, max_age_secs: Optional[float] = None) -> Snapshot:
+        """Return a snapshot at most max_age_secs old (by default, ttl_secs).
+
+        If it needs to be loaded and another caller is already loading it, wait for that load instead of starting one.
+        """
+
+        max_age_secs = self.ttl_secs if max_age_secs is None else max_age_secs
+        with self._lock:
+            snapshot = self._get_snapshot(key)
+            if snapshot is not None and snapshot.age <= max_age_secs:
+                return snapshot
+            future, is_leader = self._join_or_start(key)
+        if is_leader:
+            self._load(key, future)
+        return future.result()
+
+    def get_latest(self, key: Hashable) -> Optional[Snapshot]:
+        """Return the latest snapshot without waiting (None if there is none yet). Refresh it in the background if it is
+        older than ttl_secs."""
+
+        with self._lock:
+            snapshot = self._get_snapshot(key)
+            if snapshot is None or snapshot.age > self.ttl_secs:
+                self._refresh_in_background(key)
+            return snapshot
+
+    def refresh(self, key: Hashable) -> Future:
+        """Load a new snapshot in the background, unless a load is already in flight. Returns the future snapshot."""
+
+        with self._lock:
+            return self._refresh_in_background(key)
+
+    def invalidate(self):
+        """Drop all the snapshots, e.g. after a modification. Loads in flight will not be cached, nor joined."""
+
+        with self._lock:
+            self._snapshots.clear()
+            self._in_flight.clear()
+            self._generation += 1
+
+    def _get_snapshot(self, key) -> Optional[Snapshot]:
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None:
+            self._snapshots.move_to_end(key)
+        return snapshot
+
+    def _join_or_start(self, key):
+        future = self._in_flight.get(key)
+        if future is not None:
+            return future, False
+        future = self._in_flight[key] = Future()
+        return future, True
+
+    def _refresh_in_background(self, key) -> Future:
+        future, is_leader = self._join_or_start(key)
+        if is_leader:
+            self._executor.submit(self._load, key, future)
+        return future
+
+    def _load(self, key, future: Future):
+        with self._lock:
+            generation = self._generation
+        start_time = time.time()
+        try:
+            snapshot = Snapshot(self._load_fn(key), start_time)
+        except BaseException as e:
+            with self._lock:
+                self._end_flight(key, future)
+            future.set_exception(e)
+            return
+        with self._lock:
+            if generation == self._generation:
+                self._snapshots[key] = snapshot
+                self._snapshots.move_to_end(key)
+                while len(self._snapshots) > self.max_entries:
+                    self._snapshots.popitem(last=False)
+            self._end_flight(key, future)
+        future.set_result(snapshot)
+
+    def _end_flight(self, key, future: Future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
@@ -1,62 +1,47 @@
-function updatePlatform(platform) {
+function updateRows(data) {
+    for (var task_id in data) {
+        row = $("tr[data-id='" + task_id + "']")
+        row_data = data[task_id]
+        // Stale: the worker did not answer in time
+        row.toggleClass('stale', row_data['stale']);
+        // Status
+        status = row_data['status'];
+        $("td[data-col='status']", row).html(status).removeClass('updating').addClass(status);
+        // Epoch
+        $("td[data-col='epoch']", row).html((row_data['epoch'] + 1) + ' / ' + row_data['total_epochs']).removeClass('updating');
+        // Iteration
+        $("td[data-col='iteration']", row).html(row_data['iter']).removeClass('updating');
+        if (row_data['epoch'] > 0) {
+            // Total time remain
+            $("td[data-col='total_time_remain']", row).html(row_data['total_time_remain']).removeClass('updating');
+            // Epoch time remain
+            $("td[data-col='ep_time_remain']", row).html(row_data['ep_time_remain']).removeClass('updating');
+        } else {
+            // First epoch, cannot compute remaining time
+            $("td[data-col='total_time_remain']", row).empty().removeClass('updating');
+            $("td[data-col='ep_time_remain']", row).empty().removeClass('updating');
+        }
+    }
+}
+
+function updatePlatform(platform, task_ids) {
     $.ajax({
-        url: "/update/" + platform,
+        url: "/update/" + platform + "?ids=" + task_ids,
         cache: false
-        //timeout: 25000
     })
-        .done(function( data ) {
-            if( Object.keys(data).length == 0 ) return;
-            for (var task_id in data) {
-                row = $("tr[data-id='" + task_id + "']")
-                row_data = data[task_id]
-                // Status
-                status = row_data['status'];
-                $("td[data-col='status']", row).html(status).removeClass('updating').addClass(status);
-                // Epoch
-                $("td[data-col='epoch']", row).html((row_data['epoch'] + 1) + ' / ' + row_data['total_epochs']).removeClass('updating');
-                // Iteration
-                $("td[data-col='iteration']", row).html(row_data['iter']).removeClass('updating');
-                if (row_data['epoch'] > 0) {
-                    // Total time remain
-                    $("td[data-col='total_time_remain']", row).html(row_data['total_time_remain']).removeClass('updating');
-                    // Epoch time remain
-                    $("td[data-col='ep_time_remain']", row).html(row_data['ep_time_remain']).removeClass('updating');
-                } else {
-                    // First epoch, cannot compute remaining time
-                    $("td[data-col='total_time_remain']", row).empty().removeClass('updating');
-                    $("td[data-col='ep_time_remain']", row).empty().removeClass('updating');
-                }
-            }
-        })
+        .done(updateRows)
         .fail(function( jqXHR, textStatus ) {
             console.log('Update request has failed: ' + textStatus);
             console.log(jqXHR);
         });
 }
 
-function filterTable() {
-    filter = $("#search-box input").val().toUpperCase();
-    // Loop through all table rows, and hide those who don't match the search query
-    num_results = 0;
-    $("table#tasks tr.task-row").each(function() {
-        show = false;
-        $("td", this).each(function() {
-            if ($(this).text().toUpperCase().indexOf(filter) > -1) {
-                show = true;
-            }
-        });
-        if (show) {
-            $(this).show();
-            num_results += 1;
-        } else {
-            $(this).hide();
-        }
-    });
-    if (num_results == 0) {
-        $("#search-box").addClass('error');
-    } else {
-        $("#search-box").removeClass('error');
-    }
+function searchTasks(text) {
+    // The search is done by the server; keep the sorting and the page size
+    params = new URLSearchParams(window.location.search);
+    params.set('q', text);
+    params.set('page', 1);
+    window.location.search = params.toString();
 }
 
 $( document ).ready(function() {
@@ -89,13 +74,6 @@ $( document ).ready(function() {
             }
         }).modal('show');
     });
-    $('table').tablesort();
-    $('thead th.number').data(
-        'sortBy',
-        function(th, td, tablesort) {
-            return parseFloat(td.text());
-        }
-    );
     $('#checkall').click(function(event) {
         $('.toggle-job').prop('checked', $(this).prop('checked'));
         event.stopPropagation();
@@ -110,6 +88,14 @@ $( document ).ready(function() {
         $('.selected').removeClass('selected');
         $(this).addClass('selected');
     });
+    $('button#compare-tasks').click(function() {
+        task_ids = $('.toggle-job:checked').not('#checkall').map(function() {
+            return $(this).attr('name').split('-')[1];
+        }).get();
+        $('#monitoring').html('<div class="ui active loader"></div>');
+        $('#monitoring').load('/compare?ids=' + task_ids.join(','));
+        $('.selected').removeClass('selected');
+    });
     $('.toggle-job').click(function(event) {
         if ($('.toggle-job:checked').length > 0) {
             $('form#bulk button').removeClass('disabled');
@@ -122,19 +108,41 @@ $( document ).ready(function() {
         $(this).addClass('loading');
     });
     $('td.updating').append('<div class="ui active tiny inline loader"></div>');
-    $("#search-box input").keyup(function() {
-        filterTable();
-        $('.toggle-job').prop('checked', false);
+    var search_timer = null;
+    $("#search-box input").keyup(function(event) {
+        text = $(this).val();
+        clearTimeout(search_timer);
+        if (event.key === 'Enter') {
+            searchTasks(text);
+        } else if (text !== $(this).attr('value')) {
+            search_timer = setTimeout(function() { searchTasks(text); }, 800);
+        }
+    });
+    $("#search-box input").keydown(function(event) {
+        if (event.key === 'Enter') {
+            event.preventDefault();  // Do not submit the bulk form
+        }
     });
 
-    // Update table
-    $.ajax({
-        url: "/enum",
-        cache: false
-    })
-        .done(function( platform_names ) {
-            platform_names.forEach(function(p){
-                updatePlatform(p);
+    // Update table. The server pushes the rows that changed; poll once if the browser has no EventSource.
+    // Only the visible rows are refreshed.
+    visible_ids = $("table#tasks tr.task-row").map(function() {
+        return $(this).attr('data-id');
+    }).get().join(',');
+    if (window.EventSource) {
+        var events = new EventSource("/events?ids=" + visible_ids);
+        events.onmessage = function(event) {
+            updateRows(JSON.parse(event.data));
+        };
+    } else {
+        $.ajax({
+            url: "/enum",
+            cache: false
+        })
+            .done(function( platform_names ) {
+                platform_names.forEach(function(p){
+                    updatePlatform(p, visible_ids);
+                });
             });
-        });
+    }
 });
\ No newline at end of file
@@ -1,19 +1,64 @@
+import hashlib
+import re
+from collections import defaultdict
+from functools import lru_cache
 from pathlib import Path
 from time import time
+from typing import List, Iterable, Optional
 
-import numpy as np
-import pandas as pd
-from peewee import CharField, IntegerField, FloatField, Field, BooleanField, UUIDField
+from peewee import CharField, IntegerField, FloatField, Field, BooleanField, UUIDField, TextField, \
+    ForeignKeyField, chunked
+from playhouse.sqlite_ext import FTS5Model, SearchField, RowIDField
 
 from hypertrainer.computeplatformtype import ComputePlatformType
-from hypertrainer.db import BaseModel, EnumField, YamlField
-from hypertrainer.utils import TaskStatus, get_item_at_path, yaml_to_str, parse_columns, make_path
+from hypertrainer.db import BaseModel, EnumField, YamlField, database
+from hypertrainer.logparser import LogInterpreter
+from hypertrainer.utils import TaskStatus, get_item_at_path, yaml_to_str, make_path, load_yaml, deep_diff, \
+    deep_merge
+
+
+class ConfigBlob(BaseModel):
+    """A config stored once per distinct content, and shared by the tasks referencing it.
+
+    Typically, all the trials of an hpsearch reference the parent config, and only store what they change.
+    """
+
+    hash = CharField(primary_key=True)
+    text = TextField()
+
+    @classmethod
+    def store(cls, config) -> str:
+        """Store the config if it is not already stored, and return its hash"""
+
+        text = yaml_to_str(config)
+        blob_hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        cls.insert(hash=blob_hash, text=text).on_conflict_ignore().execute()
+        return blob_hash
+
+    @classmethod
+    def delete_orphans(cls):
+        """Delete the configs that are not referenced by any task"""
+        cls.delete().where(cls.hash.not_in(
+            Task.select(Task.config_base).where(Task.config_base.is_null(False)))).execute()
+
+
+@lru_cache(maxsize=1000)
+def _get_config_blob_text(blob_hash: str) -> str:
+    return ConfigBlob.get_by_id(blob_hash).text  # Never changes for a given hash
+
+
+@lru_cache(maxsize=1000)
+def _load_config_blob(blob_hash: str):
+    """The parsed config blob, which must not be modified"""
+    return load_yaml(_get_config_blob_text(blob_hash))
 
 
 class Task(BaseModel):
     uuid = UUIDField()
     project_path = CharField()
-    config = YamlField()
+    # The config is stored as the overrides of the shared config_base, or as a whole if config_base is null
+    config_base = ForeignKeyField(ConfigBlob, null=True, lazy_load=False)
+    config_data = YamlField(column_name='config')
     job_id = CharField(default='')
     hostname = CharField(default='')
     platform_type = EnumField(ComputePlatformType, default=ComputePlatformType.LOCAL)
@@ -25,27 +70,143 @@ class Task(BaseModel):
     iter_per_epoch = IntegerField(default=0)
     epoch_duration = FloatField(default=0)
     is_archived = BooleanField(default=False)
+    priority = IntegerField(default=0)  # The tasks with a higher priority start first, on the platforms that queue them
 
     _fields = None
 
+    class Meta:
+        # When changing the schema, also add a migration in db.py
+        indexes = (
+            (('is_archived', 'platform_type', 'project'), False),
+            (('platform_type', 'status'), False),
+            (('project',), False),
+            (('is_archived', 'name'), False),  # For sorting the task table
+            (('is_archived', 'status'), False),
+        )
+
     @classmethod
     def get_fields(cls):
         if cls._fields is None:
             cls._fields = [getattr(cls, x) for x in dir(cls) if isinstance(getattr(cls, x), Field)]
         return cls._fields
 
-    def __init__(self, **kwargs):
+    @classmethod
+    def bulk_save_changes(cls, tasks: Iterable['Task']):
+        """Save the modified fields of the tasks, in one transaction. Does not touch the db if nothing changed."""
+
+        tasks_by_fields = defaultdict(list)
+        for t in tasks:
+            t._pack_config()
+            changed_fields = t.get_changed_fields()
+            if changed_fields:
+                tasks_by_fields[tuple(changed_fields)].append(t)
+        if len(tasks_by_fields) == 0:
+            return
+
+        with database.atomic():
+            for fields, tasks_to_update in tasks_by_fields.items():
+                cls.bulk_update(tasks_to_update, fields)
+        for tasks_to_update in tasks_by_fields.values():
+            for t in tasks_to_update:
+                t._mark_saved()
+
+    @classmethod
+    def bulk_insert(cls, tasks: List['Task'], batch_size=500):
+        """Insert new tasks in one transaction, and set their ids"""
+
+        field_names = [f.name for f in cls._meta.sorted_fields if f is not cls._meta.primary_key]
+        for t in tasks:
+            t._pack_config()
+        with database.atomic():
+            for batch in chunked(tasks, batch_size):
+                cls.insert_many([{name: t.__data__.get(name) for name in field_names} for t in batch]).execute()
+            ids = {}
+            for batch in chunked([t.uuid for t in tasks], batch_size):
+                ids.update(cls.select(cls.uuid, cls.id).where(cls.uuid.in_(batch)).tuples())
+        for t in tasks:
+            t.id = ids[t.uuid]
+            t._mark_saved()
+
+    @staticmethod
+    def expand_config(config_data, config_base: Optional[str], typ='rt'):
+        """Return the whole config, given the raw values of the config_data and config_base fields"""
+
+        if isinstance(config_data, str):
+            config_data = load_yaml(config_data, typ=typ)
+        if config_base is None:
+            return config_data
+        base = load_yaml(_get_config_blob_text(config_base), typ=typ)  # A copy, modified in place
+        return deep_merge(base, config_data, in_place=True)
+
+    def __init__(self, config=None, **kwargs):
         super().__init__(**kwargs)
 
+        # Values of the fields as they are in the db (when loaded from the db), for change tracking
+        self._saved_data = dict(self.__data__)
+
+        self._config = None
+        if config is not None:
+            self.config = config
+
         self.logs = {}
         self.metrics = {}
         self.total_time_remain = None
         self.ep_time_remain = None
         self.cur_phase = None
+        self.is_stale = False  # True if the logs could not be fetched in time
 
         self._script_file = None
         self._output_root = None
 
+    def save(self, *args, **kwargs):
+        self._pack_config()
+        rows = super().save(*args, **kwargs)
+        self._saved_data.update({k: v for k, v in self.__data__.items() if k not in self._dirty})
+        return rows
+
+    def save_changes(self):
+        """Save the modified fields only. Does not touch the db if nothing changed."""
+
+        if self.id is None:
+            self.save()  # Insert
+            return
+        self._pack_config()
+        changed_fields = self.get_changed_fields()
+        if changed_fields:
+            self.save(only=changed_fields)
+        else:
+            self._dirty.clear()
+
+    def get_changed_fields(self) -> List[Field]:
+        """Return the fields that were modified since the task was loaded or saved.
+
+        A field is modified if it was assigned a different value. The config is modified if it was assigned, or
+        marked as dirty after an in-place modification.
+        """
+
+        fields = self._meta.fields
+        return sorted((fields[name] for name in self._dirty
+                       if name == 'config_data' or self.__data__.get(name) != self._saved_data.get(name)),
+                      key=lambda f: f.name)
+
+    def _pack_config(self):
+        """Store the modified config as overrides of config_base, or as a whole if that is not possible"""
+
+        if self._config is None or 'config_data' not in self._dirty:
+            return
+        overrides = None
+        if self.config_base is not None:
+            overrides = deep_diff(self._config, _load_config_blob(self.config_base))
+        if overrides is None:
+            self.config_base = None
+            self.__data__['config_data'] = self._config
+        else:
+            self.__data__['config_data'] = overrides
+
+    def _mark_saved(self):
+        self._dirty.clear()
+        self._saved_data = dict(self.__data__)
+
     @property
     def is_running(self):
         return self.status == TaskStatus.Running
@@ -73,6 +234,17 @@ class Task(BaseModel):
             self._output_root = str(output_root_path)
         return self._output_root
 
+    @property
+    def config(self):
+        if self._config is None:
+            self._config = self.expand_config(self.config_data, self.config_base)
+        return self._config
+
+    @config.setter
+    def config(self, config):
+        self._config = config
+        self._dirty.add('config_data')
+
     @property
     def output_path(self) -> str:
         return self.config['output_path']
@@ -81,7 +253,7 @@ class Task(BaseModel):
     def output_path(self, path: str):
         self.config: dict  # Corrects Pycharm inspection
         self.config['output_path'] = path
-        self.save()
+        self._dirty.add('config_data')  # Modified in place; saved by the caller
 
     @property
     def num_epochs(self):
@@ -91,78 +263,153 @@ class Task(BaseModel):
     def short_uuid(self):
         return str(self.uuid).split('-')[0]
 
-    def post_submit(self):
-        """Called after submit event"""
-        self.save()
-
-    def post_resume(self):
-        """Called after resume event"""
-        self.status = TaskStatus.Unknown
-        self.save()
-
     def post_cancel(self):
         """Called after cancel event"""
-        self.save()
+        self.save_changes()
 
     def interpret_logs(self):
+        """Update the progress and the metrics of the task according to its logs.
+
+        Only the lines that were appended since the last call are parsed (see LogInterpreter).
+        """
+
         logs = self.logs
+        interpreter = LogInterpreter.of_task(self.id)
 
         # Interpret logs
         try:
-            for name, log in logs.items():
-                if name == 'progress':
-                    # Columns = epoch_idx, iter_idx, iter_per_epoch, unix_timestamp
-                    data = parse_columns(log)
-                    if data:
-                        data = data if data[0][0].isdigit() else data[1:]  # Handle presence/absence of header
-                        df = pd.DataFrame(data, columns=['ep_idx', 'phase', 'iter_idx', 'iter_per_epoch', 'timestamp'])
-                        self.cur_phase = df.tail(1).phase.values[0]  # TODO
-                        del df['phase']
-                        df = df.astype(float).astype(int)
-                        # Epochs
-                        self.cur_epoch = int(df.tail(1).ep_idx)
-                        epochs_times = df.groupby('ep_idx').min().timestamp.values
-                        if len(epochs_times) > 1:
-                            durations = epochs_times[1:] - epochs_times[:-1]
-                            self.epoch_duration = np.mean(durations)  # TODO more weight to last epochs?
-                            cur_ep_elapsed = time() - epochs_times[-1]
-                            self.ep_time_remain = self.epoch_duration - cur_ep_elapsed
-                            epochs_remaining = get_item_at_path(self.config, 'training.num_epochs') - self.cur_epoch - 1
-                            self.total_time_remain = self.ep_time_remain + self.epoch_duration * epochs_remaining
-
-                            self.ep_time_remain = max(self.ep_time_remain, 0)
-                            self.total_time_remain = max(self.total_time_remain, 0)
-                        # Iterations
-                        self.cur_iter = int(df.tail(1).iter_idx)
-                        self.iter_per_epoch = int(df.tail(1).iter_per_epoch)
-                        self.save()
-
-                elif name.startswith('metric_'):
-                    data = parse_columns(log)
-                    if data:
-                        data = data if data[0][0].isdigit() else data[1:]  # Handle presence/absence of header
-                        m_name = name.partition('_')[2]  # Example: 'd_j_trump'.partition('_') -> ('d', '_', 'j_trump')
-                        if name.startswith('metric_classwise_'):
-                            m_name = m_name.partition('_')[2]
-                            data_arrays = {}
-                            # Columns: epoch_idx, class_idx, value
-                            df = pd.DataFrame(data, columns=['epoch_idx', 'class_idx', 'value'], dtype=float)
-                            for class_idx, sub_df in df.groupby('class_idx'):
-                                del sub_df['class_idx']
-                                label = class_idx if type(class_idx) is str else str(int(class_idx))
-                                data_arrays[label] = sub_df.values  # convert to numpy
-                            self.metrics[m_name] = data_arrays
-                        else:
-                            # Columns: epoch_idx, value
-                            data_array = np.array(data, dtype=np.float)
-                            self.metrics[m_name] = data_array
+            with interpreter.lock:
+                interpreter.feed(logs)
+                progress = interpreter.progress
+                has_progress = progress is not None and progress.cur_epoch is not None
+                if has_progress:
+                    self.cur_phase = progress.cur_phase  # TODO
+                    # Epochs
+                    self.cur_epoch = progress.cur_epoch
+                    if progress.epoch_duration is not None:
+                        self.epoch_duration = progress.epoch_duration  # TODO more weight to last epochs?
+                        self.ep_time_remain, self.total_time_remain = progress.get_time_remaining(self.num_epochs,
+                                                                                                  time())
+                    # Iterations
+                    self.cur_iter = progress.cur_iter
+                    self.iter_per_epoch = progress.iter_per_epoch
+                self.metrics = interpreter.get_metrics()
+            if has_progress:
+                self.save_changes()
         except Exception as e:
             print('ERROR while interpreting logs:')
             print(e)
 
         # Remove logs that have been interpreted
-        for k in [k for k in logs.keys() if k.startswith('metric_') or k in {'progress'}]:
+        for k in [k for k in logs.keys() if LogInterpreter.is_interpreted(k)]:
             del logs[k]
 
     def dump_config(self):
         return yaml_to_str(self.config)
+
+
+class TaskSearch(FTS5Model):
+    """Full-text index of the tasks, for searching them by name, project and config. The rowid is the task id."""
+
+    rowid = RowIDField()
+    name = SearchField()
+    project = SearchField()
+    config = SearchField()  # The overrides, followed by the shared config
+
+    class Meta:
+        # When changing the schema, also add a migration in db.py
+        database = database
+
+    index_sql = ('INSERT INTO "tasksearch" ("rowid", "name", "project", "config") '
+                 'SELECT t."id", t."name", t."project", t."config" || char(10) || coalesce(b."text", \'\') '
+                 'FROM "task" AS t LEFT JOIN "configblob" AS b ON b."hash" = t."config_base_id"')
+
+    @classmethod
+    def index_tasks(cls, task_ids: Iterable[int], batch_size=500):
+        """Index the tasks, or re-index them after their config changed"""
+
+        with database.atomic():
+            for batch in chunked(task_ids, batch_size):
+                cls.unindex_tasks(batch)
+                database.execute_sql(cls.index_sql + f' WHERE t."id" IN ({", ".join("?" * len(batch))})', batch)
+
+    @classmethod
+    def unindex_tasks(cls, task_ids: Iterable[int]):
+        cls.delete().where(cls.rowid.in_(list(task_ids))).execute()
+
+    @staticmethod
+    def make_query(text: str) -> Optional[str]:
+        """Make a query matching the rows containing all the words of the text, as prefixes (None if no words)"""
+
+        words = re.findall(r'\w+', text)
+        if len(words) == 0:
+            return None
+        return ' '.join(f'"{w}"*' for w in words)
+
+
+@lru_cache(maxsize=100000)
+def _load_summary_config(config_text: str):
+    return load_yaml(config_text, typ='safe')
+
+
+def load_shared_config(config_text: str, config_base: Optional[str]):
+    """Parse a config given the raw values of the config_data and config_base fields, faster than Task.config.
+
+    The loader does not preserve comments, and the parsed configs are cached; the parsed base is shared by all the
+    trials of an hpsearch. Thus the returned config must not be modified.
+    """
+    config = _load_summary_config(config_text)
+    if config_base is not None:
+        config = deep_merge(_load_summary_config(_get_config_blob_text(config_base)), config)
+    return config
+
+
+class TaskSummary:
+    """A lightweight, read-only record of a task, for listing many tasks.
+
+    Loading it does not deserialize the config, which is slow. The config is parsed on first access, with
+    `load_shared_config()`. It must not be modified, since it can be shared by several summaries.
+    """
+
+    __slots__ = ('id', 'uuid', 'name', 'project', 'platform_type', 'hostname', 'status', 'cur_epoch', 'cur_iter',
+                 'iter_per_epoch', 'epoch_duration', 'is_archived', 'priority', '_config_text', '_config_base',
+                 '_config', 'cur_phase', 'ep_time_remain', 'total_time_remain', 'is_stale')
+
+    db_fields = (Task.id, Task.uuid, Task.name, Task.project, Task.platform_type, Task.hostname, Task.status,
+                 Task.cur_epoch, Task.cur_iter, Task.iter_per_epoch, Task.epoch_duration, Task.is_archived,
+                 Task.priority, Task.config_data, Task.config_base)
+
+    def __init__(self, *values):
+        (self.id, self.uuid, self.name, self.project, self.platform_type, self.hostname, self.status,
+         self.cur_epoch, self.cur_iter, self.iter_per_epoch, self.epoch_duration, self.is_archived,
+         self.priority, self._config_text, self._config_base) = values
+        self._config = None
+        self.cur_phase = None
+        self.ep_time_remain = None
+        self.total_time_remain = None
+        self.is_stale = False
+
+    @classmethod
+    def from_query(cls, query) -> List['TaskSummary']:
+        """Make the summaries of the tasks selected by a Task query (e.g. Task.select().where(...))"""
+        return [cls(*row) for row in query.select(*cls.db_fields).tuples().iterator()]
+
+    def update_from_task(self, task: Task):
+        """Copy the state of a task that has just been updated or monitored"""
+        for attr in ('status', 'hostname', 'cur_epoch', 'cur_iter', 'iter_per_epoch', 'epoch_duration',
+                     'cur_phase', 'ep_time_remain', 'total_time_remain', 'is_stale'):
+            setattr(self, attr, getattr(task, attr))
+
+    @property
+    def config(self):
+        if self._config is None:
+            self._config = load_shared_config(self._config_text, self._config_base)
+        return self._config
+
+    @property
+    def num_epochs(self):
+        return get_item_at_path(self.config, 'training.num_epochs', default=-1)
+
+    @property
+    def short_uuid(self):
+        return str(self.uuid).split('-')[0]
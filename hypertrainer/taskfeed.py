@@ -0,0 +1,102 @@
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple, Set, Iterable
+
+
+class Subscription:
+    """The rows that changed since the last `pop()`, for one client. Successive changes of a row are coalesced."""
+
+    def __init__(self, project: Optional[str] = None, task_ids: Optional[Iterable[int]] = None):
+        self.project = project  # None for all projects
+        self.task_ids = None if task_ids is None else set(task_ids)  # None for all tasks
+        self._pending: Dict[int, dict] = {}
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def push(self, rows: Dict[int, dict]):
+        with self._lock:
+            self._pending.update(rows)
+            self._event.set()
+
+    def pop(self, timeout: float) -> Dict[int, dict]:
+        """Wait until some rows changed (or until the timeout), and return them"""
+
+        self._event.wait(timeout)
+        with self._lock:
+            rows, self._pending = self._pending, {}
+            self._event.clear()
+        return rows
+
+
+class TaskFeed:
+    """Refreshes the tasks in one background thread, and pushes the rows that changed to all the subscribers.
+
+    The refresh only runs while there are subscribers, at most once per `interval_secs`, however many they are. Thus
+    the load on the platforms does not depend on the number of clients. Only the tasks that some subscriber asked for
+    are refreshed (e.g. the visible page of the task table).
+    """
+
+    interval_secs = 2
+    keepalive_secs = 15  # Clients should send something at least this often, to detect disconnections
+
+    def __init__(self, get_rows: Callable[[Optional[Set[int]]], Dict[int, Tuple[str, dict]]]):
+        """get_rows(task_ids) refreshes the tasks (None for all), and returns a dict {task_id: (project, row)}"""
+
+        self._get_rows = get_rows
+        self._rows: Dict[int, Tuple[str, dict]] = {}
+        self._subscribers = set()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def subscribe(self, project: Optional[str] = None, task_ids: Optional[Iterable[int]] = None) -> Subscription:
+        """Subscribe to the rows of a project and/or of some tasks (None for all). The rows known so far are pushed
+        right away."""
+
+        subscription = Subscription(project, task_ids)
+        with self._cond:
+            self._push_rows(subscription, self._rows)
+            self._subscribers.add(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='TaskFeed', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._cond:
+            self._subscribers.discard(subscription)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._subscribers) > 0)
+                task_ids = self._wanted_tasks()
+            start_time = time.time()
+            try:
+                rows = self._get_rows(task_ids)
+            except Exception as e:
+                print('ERROR while refreshing the tasks:')
+                print(e)
+            else:
+                with self._cond:
+                    changed = {task_id: r for task_id, r in rows.items() if self._rows.get(task_id) != r}
+                    self._rows = rows
+                    for subscription in self._subscribers:
+                        self._push_rows(subscription, changed)
+            time.sleep(max(0., self.interval_secs - (time.time() - start_time)))
+
+    def _wanted_tasks(self) -> Optional[Set[int]]:
+        task_ids = set()
+        for subscription in self._subscribers:
+            if subscription.task_ids is None:
+                return None
+            task_ids |= subscription.task_ids
+        return task_ids
+
+    @staticmethod
+    def _push_rows(subscription: Subscription, rows: Dict[int, Tuple[str, dict]]):
+        rows = {task_id: row for task_id, (project, row) in rows.items()
+                if (subscription.project is None or project == subscription.project)
+                and (subscription.task_ids is None or task_id in subscription.task_ids)}
+        if len(rows) > 0:
+            subscription.push(rows)
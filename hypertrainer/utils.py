@@ -1,13 +1,18 @@
 import contextlib
 import fcntl
+import json
 import os
+import socket
 import sys
+import tempfile
+import threading
 import time
+import uuid
 from pathlib import Path
 from enum import Enum
 from functools import reduce
 from itertools import chain
-from typing import Iterable, List, Dict
+from typing import Iterable, List, Optional
 from uuid import UUID
 
 from ruamel.yaml import YAML, StringIO
@@ -21,6 +26,7 @@ class TestState:
 yaml = YAML()
 yaml.representer.add_representer(UUID, lambda dumper, uuid: dumper.represent_data(str(uuid)))
 yaml.representer.add_multi_representer(Enum, lambda dumper, enum: dumper.represent_data(str(enum)))
+_thread_local_yaml = threading.local()
 
 hypertrainer_home = Path.home() / 'hypertrainer'
 if not hypertrainer_home.exists():
@@ -45,6 +51,41 @@ def set_item_at_path(obj, path, value, sep='.'):
     leaf_obj[path_tokens[-1]] = value
 
 
+def deep_diff(obj: dict, base: dict) -> Optional[dict]:
+    """Return a nested dict with the items of `obj` that differ from `base` (lists are compared as a whole).
+
+    Returns None if the difference cannot be expressed this way, because `obj` lacks some keys of `base`.
+    """
+    diff = {}
+    for k in base:
+        if k not in obj:
+            return None
+    for k, v in obj.items():
+        if k in base and isinstance(v, dict) and isinstance(base[k], dict):
+            sub_diff = deep_diff(v, base[k])
+            if sub_diff is None:
+                return None
+            if sub_diff:
+                diff[k] = sub_diff
+        elif k not in base or type(v) is not type(base[k]) or v != base[k]:
+            diff[k] = v
+    return diff
+
+
+def deep_merge(base: dict, overrides: dict, in_place=False) -> dict:
+    """The inverse of `deep_diff()`: return `base` updated with the nested items of `overrides`.
+
+    Unless in_place=True, `base` is not modified: only the dicts along the overridden paths are copied.
+    """
+    merged = base if in_place else dict(base)
+    for k, v in overrides.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = deep_merge(merged[k], v, in_place)
+        else:
+            merged[k] = v
+    return merged
+
+
 def parse_columns(data):
     if data.strip() == '':
         return []
@@ -54,6 +95,18 @@ def parse_columns(data):
     return [l.split() for l in data_lines]
 
 
+def load_yaml(text: str, typ='rt'):
+    """Parse yaml text. Unlike the module-level `yaml` instance, this can be used from several threads.
+
+    typ='rt' (round-trip) preserves comments and order; typ='safe' is faster, but does not.
+    """
+
+    loaders = _thread_local_yaml.__dict__
+    if typ not in loaders:
+        loaders[typ] = YAML(typ=typ)
+    return loaders[typ].load(text)
+
+
 def yaml_to_str(obj):
     # with io.StringIO() as stream:
     stream = StringIO()
@@ -201,39 +254,174 @@ class PidFile(object):
         return self.pidfile is not None
 
 
-class GpuLock(PidFile):
-    def __init__(self, gpu_id):
-        self.gpu_id = gpu_id
-        self.path = hypertrainer_home / f'gpu_{gpu_id}.lock'
-        super().__init__(self.path)
+class GpuLease:
+    """GPUs allocated to a job by GpuLockManager. Must be released when the job is done."""
+
+    def __init__(self, manager: 'GpuLockManager', token: str, gpu_ids: List[str]):
+        self.manager = manager
+        self.token = token
+        self.gpu_ids = gpu_ids
+
+    @property
+    def gpu_id(self) -> str:
+        """The value of CUDA_VISIBLE_DEVICES for the job, e.g. '0' or '0,1'"""
+        return ','.join(self.gpu_ids)
+
+    def release(self):
+        self.manager.release(self)
 
 
 class GpuLockManager:
-    def __init__(self):
-        self.locks: Dict[str, GpuLock] = {}
+    """Allocates the visible GPUs (CUDA_VISIBLE_DEVICES) to the jobs of all the worker processes of the machine.
+
+    The state (owner of each GPU, and queue of waiting jobs) is in a json file, modified under an exclusive flock. A job
+    gets all its GPUs at once or none, so that jobs waiting for several GPUs cannot deadlock. The waiting jobs are
+    served by decreasing priority, then in FIFO order; a job never passes one that is waiting before it. When GPUs are
+    released, they are allocated right away, and the waiting jobs are woken up through a unix socket.
+    """
+
+    poll_secs = 10  # Waiting jobs also check periodically, in case the owner of a GPU died without releasing it
+    cancel_poll_secs = 0.2
+
+    def __init__(self, state_path: Optional[Path] = None):
+        self.state_path = hypertrainer_home / 'gpu_locks.json' if state_path is None else state_path
+        self.gpu_ids: List[str] = []
 
         cuda_visible_devices_var = os.environ.get('CUDA_VISIBLE_DEVICES', None)
         if cuda_visible_devices_var not in ('', None):
-            visible_devices = cuda_visible_devices_var.split(',')
-            self.locks = [GpuLock(gpu_id) for gpu_id in visible_devices]
+            self.gpu_ids = cuda_visible_devices_var.split(',')
 
     def num_free_gpus(self) -> int:
-        return sum(1 for lock in self.locks if not lock.is_locked)
+        with self._state() as state:
+            return sum(1 for gpu_id in self.gpu_ids if gpu_id not in state['owners'])
+
+    def acquire_one_gpu(self) -> GpuLease:
+        """Wait for a gpu to be available, acquire it and return the GpuLease
+
+        The GpuLease must be released when the job is done."""
 
-    def acquire_one_gpu(self) -> GpuLock:
-        """Wait for a gpu to be available, acquire it and return the GpuLock
+        return self.acquire(1)
 
-        The GpuLock must be released when the job is done."""
+    def acquire(self, num_gpus: int, priority: int = 0, timeout: Optional[float] = None,
+                cancel_event: Optional[threading.Event] = None) -> GpuLease:
+        """Wait until num_gpus GPUs can be allocated at once, and return the GpuLease. Jobs with a higher priority are
+        served first. Raises TimeoutError after `timeout` seconds, or InterruptedError once cancel_event is set."""
 
-        if len(self.locks) < 1:
-            raise Exception('GpuLockManager: There are no visible GPUs.')
+        if num_gpus > len(self.gpu_ids):
+            raise Exception(f'GpuLockManager: {num_gpus} GPU(s) required, but there are {len(self.gpu_ids)} visible.')
+        token = uuid.uuid4().hex
+        deadline = None if timeout is None else time.time() + timeout
+        sock_path = Path(tempfile.gettempdir()) / f'ht-gpu-{token}.sock'
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(str(sock_path))
+        gpu_ids = None
+        try:
+            with self._state() as state:
+                state['waiters'].append(dict(token=token, pid=os.getpid(), num_gpus=num_gpus, priority=priority,
+                                             ticket=state['next_ticket'], socket=str(sock_path)))
+                state['next_ticket'] += 1
+                woken = self._allocate(state)
+            self._wake(woken)
+            printed = False
+            while True:
+                with self._state() as state:
+                    woken = self._allocate(state)  # In case a GPU owner died
+                    gpu_ids = [gpu_id for gpu_id, owner in state['owners'].items() if owner['token'] == token]
+                self._wake(w for w in woken if w['token'] != token)
+                if len(gpu_ids) > 0 or num_gpus == 0:
+                    return GpuLease(self, token, sorted(gpu_ids, key=self.gpu_ids.index))
+                if not printed:
+                    print('GpuLockManager: waiting for a GPU...')
+                    printed = True
+                wait_secs = self.poll_secs if deadline is None else min(self.poll_secs, deadline - time.time())
+                if wait_secs <= 0:
+                    raise TimeoutError(f'GpuLockManager: could not acquire {num_gpus} GPU(s) in time.')
+                if cancel_event is not None:
+                    if cancel_event.is_set():
+                        raise InterruptedError('GpuLockManager: cancelled while waiting for a GPU.')
+                    wait_secs = min(wait_secs, self.cancel_poll_secs)
+                sock.settimeout(wait_secs)
+                try:
+                    sock.recv(1)
+                except socket.timeout:
+                    pass
+        finally:
+            sock.close()
+            sock_path.unlink()
+            if not gpu_ids:
+                self._release_token(token)  # Leave the queue; GPUs allocated in the meantime go to the next jobs
+
+    def release(self, lease: GpuLease):
+        self._release_token(lease.token)
+
+    def _release_token(self, token: str):
+        with self._state() as state:
+            state['owners'] = {gpu_id: o for gpu_id, o in state['owners'].items() if o['token'] != token}
+            state['waiters'] = [w for w in state['waiters'] if w['token'] != token]
+            woken = self._allocate(state)
+        self._wake(woken)
+
+    def _allocate(self, state) -> List[dict]:
+        """Allocate the free GPUs to the waiting jobs, in order. Returns the jobs that got their GPUs."""
+
+        # Forget the processes that died
+        state['owners'] = {gpu_id: o for gpu_id, o in state['owners'].items() if _pid_exists(o['pid'])}
+        state['waiters'] = [w for w in state['waiters'] if _pid_exists(w['pid'])]
+
+        free_gpus = [gpu_id for gpu_id in self.gpu_ids if gpu_id not in state['owners']]
+        granted = []
+        for waiter in sorted(state['waiters'], key=lambda w: (-w['priority'], w['ticket'])):
+            if waiter['num_gpus'] > len(free_gpus):
+                break  # The next jobs wait for this one
+            for gpu_id in free_gpus[:waiter['num_gpus']]:
+                state['owners'][gpu_id] = dict(token=waiter['token'], pid=waiter['pid'])
+            free_gpus = free_gpus[waiter['num_gpus']:]
+            granted.append(waiter)
+        state['waiters'] = [w for w in state['waiters'] if w not in granted]
+        return granted
 
-        while True:
-            for gpu_lock in self.locks:
-                if gpu_lock.try_acquire():
-                    return gpu_lock
-            print('GpuLockManager: waiting for a GPU...')
-            time.sleep(2)
+    @staticmethod
+    def _wake(waiters: Iterable[dict]):
+        for waiter in waiters:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                try:
+                    sock.sendto(b'1', waiter['socket'])
+                except OSError:
+                    pass  # Not waiting anymore
+
+    @contextlib.contextmanager
+    def _state(self):
+        """Lock the state, and yield it as a dict, which is written back on exit"""
+
+        # The lock is on a separate file, since the state file is replaced by each write
+        lock_path = self.state_path.with_name(self.state_path.name + '.lock')
+        with lock_path.open('a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                text = self.state_path.read_text()
+            except FileNotFoundError:
+                text = ''
+            try:
+                state = json.loads(text) if text else dict(owners={}, waiters=[], next_ticket=0)
+            except ValueError as e:
+                print('WARNING: GpuLockManager: invalid state file, the GPUs are considered free:', e)
+                state = dict(owners={}, waiters=[], next_ticket=0)
+            yield state
+            # Written atomically: a crash while writing leaves the previous state
+            tmp_path = self.state_path.with_name(self.state_path.name + '.tmp')
+            tmp_path.write_text(json.dumps(state))
+            os.replace(tmp_path, self.state_path)
+            # The flock is released when the lock file is closed
+
+
+def _pid_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Exists, but belongs to another user
+    return True
 
 
 def get_config_file() -> Path:
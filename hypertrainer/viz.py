@@ -1,12 +1,41 @@
 import itertools
+from typing import Optional
 
+import numpy as np
+from bokeh.models import ColumnDataSource, CustomJS
 from bokeh.plotting import figure
 from bokeh.embed import components
 from bokeh.palettes import Category10
 
+from hypertrainer.downsample import lttb
 
-def generate_plots(metrics_data):
-    # metrics_data is a dict: {string: numpy_array}
+default_max_points = 2000  # Per line. Bokeh becomes slow with many more points, and they would not be visible anyway
+
+# Fetches the points of the visible range at full resolution (up to max_points), after a zoom or pan
+_zoom_callback_code = """
+    const start = x_range.start, end = x_range.end;
+    clearTimeout(source.ht_zoom_timer);
+    source.ht_zoom_timer = setTimeout(function() {
+        if (start === source.ht_zoom_start && end === source.ht_zoom_end) {
+            return;
+        }
+        source.ht_zoom_start = start;
+        source.ht_zoom_end = end;
+        const params = new URLSearchParams({metric: metric, label: label, x_start: start, x_end: end,
+                                            max_points: max_points});
+        fetch(url + '?' + params).then(response => response.json()).then(data => {
+            source.data = {x: data.x, y: data.y};
+        });
+    }, 200);
+"""
+
+
+def generate_plots(metrics_data, max_points: int = default_max_points, zoom_url: Optional[str] = None):
+    """Make the bokeh plots of the metrics, with each line downsampled to max_points.
+
+    metrics_data is a dict: {string: numpy_array} or {string: {label: numpy_array}}. If zoom_url is given, the plots
+    fetch the points of the visible range from it after a zoom (see dashboard.metric_points).
+    """
 
     # select the tools we want
     TOOLS = "pan,wheel_zoom,box_zoom,reset,save"
@@ -16,11 +45,50 @@ def generate_plots(metrics_data):
         p = figure(title=name.capitalize(), tools=TOOLS, plot_width=500, plot_height=300)
         if type(data) is dict:
             colors = itertools.cycle(Category10[10])
-            for label, sub_data in data.items():
-                p.line(x=sub_data[:, 0], y=sub_data[:, 1], legend=label, color=next(colors))
+            lines = [(label, sub_data, next(colors)) for label, sub_data in data.items()]
         else:
-            p.line(x=data[:, 0], y=data[:, 1])
+            lines = [('', data, None)]
+        for label, line_data, color in lines:
+            sampled = lttb(line_data, max_points)
+            source = ColumnDataSource(data={'x': sampled[:, 0], 'y': sampled[:, 1]})
+            kwargs = {} if color is None else dict(legend=label, color=color)
+            p.line(x='x', y='y', source=source, **kwargs)
+            if zoom_url is not None and len(line_data) > max_points:
+                callback = CustomJS(args=dict(source=source, x_range=p.x_range, url=zoom_url, metric=name,
+                                              label=label, max_points=max_points),
+                                    code=_zoom_callback_code)
+                p.x_range.js_on_change('start', callback)
+                p.x_range.js_on_change('end', callback)
         plots[name] = p
 
     script, div = components(plots)
     return script, div
+
+
+def generate_comparison_plot(title: str, lines: dict, stats: dict, max_points: int = 20 * default_max_points):
+    """Make a bokeh plot overlaying the lines of several tasks with their per-epoch statistics.
+
+    lines and stats are returned by `ExperimentManager.compare_metric()`. The lines are downsampled so that the plot
+    has about max_points points in total.
+    """
+
+    TOOLS = "pan,wheel_zoom,box_zoom,reset,save"
+    p = figure(title=title, tools=TOOLS, plot_width=900, plot_height=450)
+
+    # The lines of the tasks, in a single glyph
+    points_per_line = max(default_max_points // 40, max_points // max(len(lines), 1))
+    sampled_lines = [lttb(data, points_per_line) for data in lines.values() if len(data) > 0]
+    p.multi_line(xs=[data[:, 0] for data in sampled_lines], ys=[data[:, 1] for data in sampled_lines],
+                 color='gray', alpha=0.3)
+
+    # The statistics, decimated if there are many epochs
+    epochs = stats['epochs']
+    idx = np.unique(np.linspace(0, len(epochs) - 1, min(len(epochs), default_max_points)).astype(int))
+    q_lo, q_mid, q_hi = (stats['quantiles'][q][idx] for q in sorted(stats['quantiles']))
+    p.varea(x=epochs[idx], y1=stats['min'][idx], y2=stats['max'][idx], color=Category10[10][0], alpha=0.1,
+            legend='min - max')
+    p.varea(x=epochs[idx], y1=q_lo, y2=q_hi, color=Category10[10][0], alpha=0.25, legend='quartiles')
+    p.line(x=epochs[idx], y=q_mid, color=Category10[10][0], line_dash='dashed', legend='median')
+    p.line(x=epochs[idx], y=stats['mean'][idx], color=Category10[10][1], line_width=2, legend='mean')
+
+    return components(p)
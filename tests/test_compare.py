@@ -0,0 +1,52 @@
+import numpy as np
+
+from hypertrainer.compare import align_on_epochs, compare_lines
+
+
+def test_align_on_epochs():
+    epochs, values = align_on_epochs({1: np.array([[0, 1.0], [1, 2.0]]), 2: np.array([[1, 3.0], [2, 4.0]])})
+    assert epochs.tolist() == [0, 1, 2]
+    assert np.array_equal(values, [[1, 2, np.nan], [np.nan, 3, 4]], equal_nan=True)
+
+
+def test_compare_lines():
+    lines = {
+        1: np.array([[0, 1.0], [1, 0.5], [2, 0.7]]),
+        2: np.array([[0, 2.0], [1, 1.5]]),  # Shorter
+        3: np.array([[0, 3.0], [1, 0.1], [2, 0.2]]),
+        4: np.empty((0, 2)),  # No values yet
+    }
+    stats = compare_lines(lines, mode='min')
+    assert stats['epochs'].tolist() == [0, 1, 2]
+    assert stats['count'].tolist() == [3, 3, 2]
+    assert np.allclose(stats['mean'], [2, 0.7, 0.45])
+    assert stats['min'].tolist() == [1, 0.1, 0.2]
+    assert stats['max'].tolist() == [3, 1.5, 0.7]
+    assert np.allclose(stats['quantiles'][0.5], [2, 0.5, 0.45])
+    assert stats['final'] == {1: 0.7, 2: 1.5, 3: 0.2}
+    assert stats['best'] == {1: 0.5, 2: 1.5, 3: 0.1}
+    assert stats['best_epoch'] == {1: 1, 2: 1, 3: 1}
+
+    stats = compare_lines(lines, mode='max')
+    assert stats['best'] == {1: 1.0, 2: 2.0, 3: 3.0}
+
+    assert compare_lines({4: np.empty((0, 2))})['final'] == {}
+
+
+def test_align_on_epochs_duplicates_and_bins():
+    # The last value logged at an epoch is kept
+    epochs, values = align_on_epochs({1: np.array([[0, 1.0], [1, 2.0], [1, 5.0], [0, 6.0]])})
+    assert epochs.tolist() == [0, 1]
+    assert values.tolist() == [[6, 5]]
+
+    # Too many epochs: the lines are binned
+    lines = {1: np.stack([np.arange(100), np.ones(100)], axis=1), 2: np.array([[10.5, 3.0], [20.5, 5.0]])}
+    epochs, values = align_on_epochs(lines, max_epochs=10)
+    assert values.shape == (2, 10) and np.allclose(epochs, np.arange(10) * 9.9 + 4.95)
+    assert np.all(values[0] == 1)
+    assert np.array_equal(values[1], [np.nan, 3, 5] + [np.nan] * 7, equal_nan=True)
+
+    # The final and best values are computed on all the points
+    stats = compare_lines({1: np.array([[e, 10 - e % 7] for e in range(50)], dtype=float)}, max_epochs=5)
+    assert len(stats['epochs']) == 5
+    assert (stats['final'], stats['best'], stats['best_epoch']) == ({1: 10.0}, {1: 4.0}, {1: 6.0})
@@ -0,0 +1,20 @@
+import numpy as np
+
+from hypertrainer.downsample import lttb
+
+
+def test_lttb():
+    x = np.arange(10000, dtype=float)
+    y = np.sin(x / 500) + (x == 7777) * 5  # With a spike
+    data = np.stack([x, y], axis=1)
+
+    sampled = lttb(data, 100)
+    assert sampled.shape == (100, 2)
+    assert np.array_equal(sampled[[0, -1]], data[[0, -1]])
+    assert np.all(np.diff(sampled[:, 0]) > 0)
+    assert 7777 in sampled[:, 0]  # The spike is kept
+    assert np.max(np.abs(sampled[:, 1] - np.interp(sampled[:, 0], x, y))) == 0  # Only original points
+
+    short = data[:50]
+    assert np.array_equal(lttb(short, 100), short)  # Fewer points than num_out: unchanged
+
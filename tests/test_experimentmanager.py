@@ -1,18 +1,26 @@
 import os
+import sys
+import threading
 from pathlib import Path
 from time import sleep
 
 import pytest
+from rq import Queue
 
 # Trick for initializing a test database
 from hypertrainer.utils import TaskStatus, yaml, deep_assert_equal, TestState
 
 TestState.test_mode = True
 
-from hypertrainer.experimentmanager import experiment_manager
+from hypertrainer.experimentmanager import experiment_manager, ExperimentManager
 from hypertrainer.computeplatformtype import ComputePlatformType
 from hypertrainer.htplatform import HtPlatform
-from hypertrainer.task import Task
+from hypertrainer.htplatform_worker import job_info_key, ping
+from hypertrainer.resources import ResourceQueue, advertise_capacity, claim_job, release_job, job_requirements, \
+    host_key, publish_job, set_job_priority, running_key
+from hypertrainer.task import Task, ConfigBlob
+from hypertrainer.metricstore import MetricPoint, load_metrics, load_metric_range, load_metric_summaries
+from hypertrainer import db, htplatform_worker
 
 scripts_path = Path(__file__).parent / 'scripts'
 
@@ -31,9 +39,315 @@ def test_export_yaml():
 
     experiment_manager.export_yaml(str(tmpfile))
 
+    exported = yaml.load(tmpfile)
+    assert len(exported) == Task.select().count()
+    assert 'hpsearch' in exported[-1]['config']
     # TODO perform more checks
 
 
+@pytest.mark.parametrize('file_format', ['csv', 'parquet'])
+def test_export_table(tmp_path, monkeypatch, file_format):
+    if file_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    pandas = pytest.importorskip('pandas')
+
+    tasks = experiment_manager.create_tasks(
+        config_file=str(scripts_path / 'test_hp.yaml'),
+        platform='local')
+    (Path(tasks[0].output_path) / 'metric_loss.txt').write_text('0 1.0\n1 0.5\n2 0.7\n')
+    experiment_manager.monitor_many(tasks)  # The export reads the metric store, without monitoring the tasks
+
+    filepath = tmp_path / f'export.{file_format}'
+    experiment_manager.export_batch_size = 2  # Several batches
+    monkeypatch.setattr(experiment_manager, 'monitor_many', None)  # The platforms must not be contacted
+    try:
+        getattr(experiment_manager, f'export_{file_format}')(str(filepath))
+    finally:
+        experiment_manager.export_batch_size = ExperimentManager.export_batch_size
+    df = getattr(pandas, f'read_{file_format}')(filepath).set_index('id')
+
+    assert len(df) == Task.select().count()
+    for t in tasks:
+        assert df.loc[t.id, 'config.training.dummy_param_lin'] == pytest.approx(t.config['training']['dummy_param_lin'])
+        assert df.loc[t.id, 'name'] == t.name
+    assert df['config.training.dummy_param_lin'].dtype == float
+    assert tuple(df.loc[tasks[0].id, ['metric.loss.final', 'metric.loss.min', 'metric.loss.max']]) == (0.7, 0.5, 1.0)
+
+
+def test_changed_fields():
+    task = experiment_manager.create_tasks(
+        config_file=str(scripts_path / 'test_simple.yaml'),
+        platform='local')[0]
+    task = Task.get(Task.id == task.id)
+    assert task.get_changed_fields() == []
+
+    # Assigning the same value is not a change
+    task.name = task.name
+    assert task.get_changed_fields() == []
+
+    task.cur_epoch = 3
+    task.hostname = 'somehost'
+    assert task.get_changed_fields() == [Task.cur_epoch, Task.hostname]
+
+    Task.bulk_save_changes([task])
+    assert task.get_changed_fields() == []
+    task_from_db = Task.get(Task.id == task.id)
+    assert (task_from_db.cur_epoch, task_from_db.hostname) == (3, 'somehost')
+
+
+def test_task_summaries():
+    tasks = experiment_manager.create_tasks(
+        config_file=str(scripts_path / 'test_hp.yaml'),
+        platform='local')
+    task_ids = [t.id for t in tasks]
+
+    summaries = experiment_manager.get_task_summaries(platform=ComputePlatformType.LOCAL)
+    summaries = {s.id: s for s in summaries if s.id in task_ids}
+    assert set(summaries.keys()) == set(task_ids)
+    for t in tasks:
+        s = summaries[t.id]
+        assert (s.name, s.short_uuid, s.platform_type) == (t.name, t.short_uuid, t.platform_type)
+        assert s.config['training']['dummy_param_lin'] == t.config['training']['dummy_param_lin']
+
+
+def test_task_snapshot():
+    snapshot = experiment_manager.get_task_snapshot(ComputePlatformType.LOCAL)
+    assert experiment_manager.get_task_snapshot(ComputePlatformType.LOCAL) is snapshot  # Cached
+    assert snapshot.age < experiment_manager.snapshot_ttl_secs
+
+    # Creating tasks invalidates the snapshots
+    tasks = experiment_manager.create_tasks(
+        config_file=str(scripts_path / 'test_hp.yaml'),
+        platform='local')
+    snapshot = experiment_manager.get_task_snapshot(ComputePlatformType.LOCAL)
+    assert {t.id for t in tasks} <= {s.id for s in snapshot.value}
+
+
+def test_task_page():
+    tasks = experiment_manager.create_tasks(
+        config_file=str(scripts_path / 'test_hp.yaml'),
+        platform='local', project='pagetest')
+    task_ids = [t.id for t in tasks]
+    assert len(tasks) > 2
+
+    page, total = experiment_manager.get_task_page(proj='pagetest', page=1, page_size=2)
+    assert total == len(tasks)
+    assert [s.id for s in page] == sorted(task_ids, reverse=True)[:2]
+    page, _ = experiment_manager.get_task_page(proj='pagetest', page=2, page_size=2, sort='name', descending=False)
+    assert [s.name for s in page] == sorted(t.name for t in tasks)[2:4]
+
+    # Search by name, project and config
+    name = tasks[1].name
+    page, total = experiment_manager.get_task_page(proj='pagetest', search=name)
+    assert tasks[1].id in [s.id for s in page] and total < len(tasks)
+    assert experiment_manager.get_task_page(search='pagete')[1] == len(tasks)
+    assert experiment_manager.get_task_page(proj='pagetest', search='dummy_param_lin')[1] == len(tasks)
+    assert experiment_manager.get_task_page(proj='pagetest', search='"no such thing')[1] == 0
+
+    # Deleted tasks are removed from the index
+    experiment_manager.archive_tasks_by_id(task_ids)
+    experiment_manager.delete_tasks_by_id(task_ids)
+    assert experiment_manager.get_task_page(search='pagetest', archived=True)[1] == 0
+
+
+def test_create_tasks_bulk():
+    tasks = experiment_manager.create_tasks(
+        config_file=str(scripts_path / 'test_hp.yaml'),
+        platform='local')
+    assert len(tasks) > 1
+
+    # The tasks were inserted and their submission saved
+    tasks_from_db = {t.id: t for t in Task.select().where(Task.id.in_([t.id for t in tasks]))}
+    assert len(tasks_from_db) == len(tasks)
+    for t in tasks:
+        t_db = tasks_from_db[t.id]
+        assert (t_db.uuid, t_db.name, t_db.job_id) == (t.uuid, t.name, t.job_id)
+        assert t.job_id != ''
+        assert t_db.output_path == t.output_path
+        assert t.get_changed_fields() == []
+
+
+def test_shared_config():
+    tasks = experiment_manager.create_tasks(
+        config_file=str(scripts_path / 'test_hp.yaml'),
+        platform='local')
+
+    # The trials share the parent config, and only store what differs from it
+    assert len({t.config_base for t in tasks}) == 1
+    assert ConfigBlob.get_by_id(tasks[0].config_base).text.count('dummy_param_lin') == 2  # Value and hpsearch param
+    for t in tasks:
+        t_db = Task.get_by_id(t.id)
+        raw = Task.select(Task.config_data).where(Task.id == t.id).tuples().get()[0]
+        assert 'script' not in raw and 'output_path' in raw
+        deep_assert_equal(t_db.config, t.config, exclude_keys=[])
+        assert t_db.config['hpsearch']['is_child']
+
+    # A modification that cannot be stored as overrides: the whole config is stored
+    t = Task.get_by_id(tasks[0].id)
+    del t.config['training']['dummy_param_lin']
+    t.config = t.config
+    t.save_changes()
+    t_db = Task.get_by_id(t.id)
+    assert t_db.config_base is None
+    assert 'dummy_param_lin' not in t_db.config['training']
+
+
+def test_metric_store():
+    task = experiment_manager.create_tasks(
+        config_file=str(scripts_path / 'test_simple.yaml'),
+        platform='local')[0]
+    metric_file = Path(task.output_path) / 'metric_loss.txt'
+    metric_file.write_text('0 1.0\n1 0.5\n')
+    experiment_manager.monitor_many([task])
+    with metric_file.open('a') as f:
+        f.write('2 0.7\n')
+    experiment_manager.monitor_many([task])
+
+    # The points were appended to the store, and can be read without the logs
+    metrics = load_metrics([task.id])[task.id]
+    assert metrics['loss'].tolist() == [[0, 1.0], [1, 0.5], [2, 0.7]]
+    assert load_metric_range(task.id, 'loss', '', 1, 2).tolist() == [[1, 0.5], [2, 0.7]]
+    assert load_metric_summaries([task.id])[task.id] == {('loss', ''): (0.7, 0.5, 1.0)}  # (final, min, max)
+
+    metric_file.write_text('0 0.9\n')  # Rewritten: the previous points are discarded
+    experiment_manager.monitor_many([task])
+    assert load_metrics([task.id])[task.id]['loss'].tolist() == [[0, 0.9]]
+
+    # Concurrent monitoring of the same task writes each point once
+    with metric_file.open('a') as f:
+        f.writelines(f'{i} {i / 100}\n' for i in range(1, 200))
+    threads = [threading.Thread(target=experiment_manager.monitor, args=(Task.get(Task.id == task.id),))
+               for _ in range(8)]
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # Interleave the threads as much as possible
+    try:
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert load_metrics([task.id])[task.id]['loss'][:, 0].tolist() == list(range(200))
+
+
+
+def test_metric_store_failed_fetch(monkeypatch):
+    task = experiment_manager.create_tasks(
+        config_file=str(scripts_path / 'test_simple.yaml'),
+        platform='local')[0]
+    metric_file = Path(task.output_path) / 'metric_loss.txt'
+    metric_file.write_text('0 1.0\n1 0.5\n')
+    experiment_manager.monitor_many([task])
+    stored = list(MetricPoint.select().where(MetricPoint.task_id == task.id).tuples())
+
+    # A failed fetch between two fetches: the stored points are not rewritten, only the new one is appended
+    platform = experiment_manager.platform_instances[ComputePlatformType.LOCAL]
+    def fetch_logs_many(tasks):
+        raise TimeoutError
+
+    with monkeypatch.context() as m:
+        m.setattr(platform, 'fetch_logs_many', fetch_logs_many)
+        experiment_manager.monitor_many([task])
+    assert task.is_stale
+    with metric_file.open('a') as f:
+        f.write('2 0.7\n')
+    experiment_manager.monitor_many([Task.get_by_id(task.id)])
+    points = list(MetricPoint.select().where(MetricPoint.task_id == task.id).tuples())
+    assert points[:2] == stored and len(points) == 3
+
+def test_monitor_many_joins_in_flight(monkeypatch):
+    t1, t2 = experiment_manager.create_tasks(
+        config_file=str(scripts_path / 'test_hp.yaml'),
+        platform='local')[:2]
+    platform = experiment_manager.platform_instances[ComputePlatformType.LOCAL]
+    fetch_logs_many = platform.fetch_logs_many
+    requested = []
+    release = threading.Event()
+
+    def slow_fetch_logs_many(tasks):
+        requested.append([t.id for t in tasks])
+        release.wait()
+        return fetch_logs_many(tasks)
+
+    monkeypatch.setattr(platform, 'fetch_logs_many', slow_fetch_logs_many)
+    first = threading.Thread(target=experiment_manager.monitor_many, args=([t1],))
+    first.start()
+    while not requested:
+        sleep(0.01)
+    threading.Timer(0.2, release.set).start()
+    experiment_manager.monitor_many([t1, t2])
+    first.join()
+
+    # The request in flight for t1 was joined, and t2 was fetched after it
+    assert requested == [[t1.id], [t2.id]]
+    assert not t1.is_stale and not t2.is_stale
+    assert 'out' in t1.logs and 'out' in t2.logs
+
+
+def test_monitor_many_stale(monkeypatch):
+    t1, t2 = experiment_manager.get_tasks_by_id([t.id for t in experiment_manager.create_tasks(
+        config_file=str(scripts_path / 'test_hp.yaml'),
+        platform='local')[:2]])
+    platform = experiment_manager.platform_instances[ComputePlatformType.LOCAL]
+
+    # The worker of t1 did not answer in time
+    monkeypatch.setattr(platform, 'fetch_logs_many', lambda tasks: {t1.id: None, t2.id: {'out': 'ok'}})
+    experiment_manager.monitor_many([t1, t2])
+    assert t1.is_stale and t1.logs == {}
+    assert not t2.is_stale and t2.logs == {'out': 'ok'}
+
+    def fetch_logs_many(tasks):
+        raise TimeoutError
+
+    monkeypatch.setattr(platform, 'fetch_logs_many', fetch_logs_many)
+    experiment_manager.monitor_many([t2])
+    assert t2.is_stale
+
+
+def test_compare_metric(monkeypatch):
+    tasks = experiment_manager.create_tasks(
+        config_file=str(scripts_path / 'test_hp.yaml'),
+        platform='local')
+    for i, t in enumerate(tasks):
+        (Path(t.output_path) / 'metric_loss.txt').write_text(f'0 {i + 1.0}\n1 {i + 0.5}\n')
+    experiment_manager.monitor_many(tasks)
+
+    monkeypatch.setattr(experiment_manager, 'monitor_many', None)  # Read from the metric store only
+    lines, stats = experiment_manager.compare_metric([t.id for t in tasks], 'loss')
+    assert set(lines.keys()) == {t.id for t in tasks}
+    assert stats['epochs'].tolist() == [0, 1]
+    assert stats['min'].tolist() == [1.0, 0.5]
+    assert stats['best'] == {t.id: i + 0.5 for i, t in enumerate(tasks)}
+
+
+def test_migrate_db(tmp_path):
+    # Schema of a db created before versioning was introduced (version 0)
+    old_db = db.SqliteDatabase(str(tmp_path / 'old.sqlite'), pragmas=db.pragmas)
+    old_db.execute_sql(
+        'CREATE TABLE "task" ("id" INTEGER NOT NULL PRIMARY KEY, "uuid" TEXT NOT NULL, "project_path" VARCHAR(255) '
+        'NOT NULL, "config" NOT NULL, "job_id" VARCHAR(255) NOT NULL, "hostname" VARCHAR(255) NOT NULL, '
+        '"platform_type" NOT NULL, "name" VARCHAR(255) NOT NULL, "project" VARCHAR(255) NOT NULL, '
+        '"status" NOT NULL, "cur_epoch" INTEGER NOT NULL, "cur_iter" INTEGER NOT NULL, '
+        '"iter_per_epoch" INTEGER NOT NULL, "epoch_duration" REAL NOT NULL, "is_archived" INTEGER NOT NULL)')
+    assert old_db.user_version == 0
+
+    db.migrate_db(old_db)
+
+    # The upgraded db must be the same as a new one
+    assert old_db.user_version == db.database.user_version == len(db.migrations)
+    assert set(old_db.get_tables()) - {'sqlite_stat1'} == set(db.database.get_tables())
+    for table in db.database.get_tables():
+        new_columns = {(c.name, c.data_type, c.null) for c in db.database.get_columns(table)}
+        assert {(c.name, c.data_type, c.null) for c in old_db.get_columns(table)} == new_columns
+        new_indexes = {i.name: i.columns for i in db.database.get_indexes(table)}
+        assert {i.name: i.columns for i in old_db.get_indexes(table)} == new_indexes
+    assert len(db.database.get_indexes('task')) > 0
+
+    db.migrate_db(old_db)  # Nothing to do
+    assert old_db.user_version == len(db.migrations)
+    old_db.close()
+
+
 class TestLocal:
     def test_output_path(self):
         tasks = experiment_manager.create_tasks(
@@ -323,6 +637,54 @@ class TestRq:
 
         wait_true(check_cancelled)
 
+    def test_claim_job(self, ht_platform):
+        redis_conn = ht_platform.redis_conn
+        queue = Queue(name='test_resources', connection=redis_conn)
+        hostname = 'test_resources_host'
+        jobs = [('test_a', 0, {'num_gpus': 2}),
+                ('test_a', 0, {'num_cpus': 3, 'mem_gb': 4}),
+                ('test_b', 0, {'num_gpus': 1, 'mem_gb': 6}),
+                ('test_b', 0, {'num_cpus': 0.5}),
+                ('test_b', 0, {'num_cpus': 0.5}),
+                ('test_a', 0, {'num_cpus': 0.5})]
+        job_ids = []
+        for project, priority, requirements in jobs:
+            job = queue.enqueue(ping, 'hi')
+            publish_job(redis_conn, queue, job.id, project, priority, job_requirements(requirements))
+            job_ids.append(job.id)
+        try:
+            advertise_capacity(redis_conn, hostname, {'num_gpus': 1, 'num_cpus': 4, 'mem_gb': 8})
+
+            # The first job needs more GPUs than there are: it is skipped
+            assert claim_job(redis_conn, queue, hostname) == job_ids[1]
+            # Project test_b has fewer running jobs; not enough memory left for its first job
+            assert claim_job(redis_conn, queue, hostname) == job_ids[3]
+            # Both projects have one running job: the oldest job is taken
+            assert claim_job(redis_conn, queue, hostname) == job_ids[4]
+            assert claim_job(redis_conn, queue, hostname) is None  # No cpu left
+            for job_id in job_ids[1], job_ids[3], job_ids[4]:
+                release_job(redis_conn, hostname, job_id)
+            release_job(redis_conn, hostname, job_ids[1])  # Released once only
+
+            # A higher priority goes first
+            assert set_job_priority(redis_conn, job_ids[5], 1)
+            assert not set_job_priority(redis_conn, job_ids[1], 1)  # Not waiting anymore
+            assert claim_job(redis_conn, queue, hostname) == job_ids[5]
+            ResourceQueue.hostname = hostname
+            job, _ = ResourceQueue.dequeue_any([queue], None, connection=redis_conn)
+            assert job.id == job_ids[2]
+            assert float(redis_conn.hget(host_key(hostname), 'used_mem_gb')) == 6
+            assert queue.job_ids == [job_ids[0]]
+
+            # A job removed from the queue is not claimed
+            queue.remove(job_ids[0])
+            release_job(redis_conn, hostname, job_ids[2])
+            assert claim_job(redis_conn, queue, hostname) is None
+        finally:
+            queue.delete(delete_jobs=True)
+            redis_conn.delete(host_key(hostname), *[job_info_key(j) for j in job_ids])
+            redis_conn.hdel(running_key, 'test_a', 'test_b')
+
     def test_acquire_one_gpu(self, monkeypatch, ht_platform_same_thread):
         monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '0,1')
 
@@ -338,6 +700,14 @@ class TestRq:
 
         assert t1.logs['out'].strip() == 'gpu_id=0'
 
+        # The jobs supervised in this process share a supervisor
+        supervisors = dict(htplatform_worker._inline_supervisors)
+        t2_id = experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_gpu_1.yaml'),
+            platform='ht')[0].id
+        wait_task_finished(t2_id, interval_secs=1, tries=3)
+        assert len(supervisors) == 1 and htplatform_worker._inline_supervisors == supervisors
+
 
 def wait_true(fn, interval_secs=0.4, tries=6):
     for i in range(tries):
@@ -53,3 +53,65 @@ def test_no_gpu(monkeypatch):
 
     with pytest.raises(Exception):
         GpuLockManager().acquire_one_gpu()
+
+
+def acquire_gpus(state_path, name, num_gpus, priority, hold_secs, q):
+    lease = GpuLockManager(state_path).acquire(num_gpus, priority=priority)
+    q.put((name, lease.gpu_id, time.time()))
+    time.sleep(hold_secs)
+    lease.release()
+
+
+def test_acquire_many_gpus(monkeypatch, tmp_path):
+    monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '0,1,2')
+    state_path = tmp_path / 'gpu_locks.json'
+    manager = GpuLockManager(state_path)
+    lease = manager.acquire(2)
+    assert lease.gpu_id == '0,1'
+    assert manager.num_free_gpus() == 1
+
+    # Waiting jobs are served by priority, then in order; 'big' blocks 'small' even though a GPU is free
+    q = mp.Queue()
+    processes = []
+    for name, num_gpus, priority in [('big', 3, 0), ('small', 1, 0), ('urgent', 2, 1)]:
+        processes.append(mp.Process(target=acquire_gpus, args=(state_path, name, num_gpus, priority, 0.2, q)))
+        processes[-1].start()
+        time.sleep(0.2)
+    assert q.empty()
+
+    release_time = time.time()
+    lease.release()
+    results = [q.get(timeout=5) for _ in range(3)]
+    assert [(name, gpu_id) for name, gpu_id, _ in results] == [('urgent', '0,1'), ('big', '0,1,2'), ('small', '0')]
+    assert results[0][2] - release_time < 1  # Woken up right away, not by polling
+    for p in processes:
+        p.join()
+    assert manager.num_free_gpus() == 3
+
+    with pytest.raises(Exception):
+        manager.acquire(4)
+    with pytest.raises(TimeoutError):
+        lease = manager.acquire(3)
+        try:
+            manager.acquire(1, timeout=0.2)
+        finally:
+            lease.release()
+    assert manager.num_free_gpus() == 3
+
+
+def test_dead_owner(monkeypatch, tmp_path):
+    monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '0')
+    state_path = tmp_path / 'gpu_locks.json'
+    p = mp.Process(target=GpuLockManager(state_path).acquire, args=(1,))
+    p.start()
+    p.join()  # Exits without releasing
+    assert GpuLockManager(state_path).acquire(1, timeout=1).gpu_id == '0'
+
+
+def test_invalid_state(monkeypatch, tmp_path, capsys):
+    monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '0')
+    state_path = tmp_path / 'gpu_locks.json'
+    state_path.write_text('{"owners": {"0": {"tok')  # Truncated by a crash
+    assert GpuLockManager(state_path).acquire(1, timeout=1).gpu_id == '0'
+    assert 'WARNING' in capsys.readouterr().out
+    assert GpuLockManager(state_path).num_free_gpus() == 0  # The state file was rewritten
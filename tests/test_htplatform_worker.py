@@ -0,0 +1,140 @@
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import pytest
+
+from hypertrainer import htplatform_worker
+from hypertrainer.htplatform_worker import get_jobs_info, _insert_job, _set_job_status, _delete_job
+from hypertrainer.utils import TaskStatus
+
+
+@pytest.fixture(autouse=True)
+def local_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(htplatform_worker, 'local_db', tmp_path / 'worker_db.sqlite')
+
+
+def test_job_status():
+    _insert_job('a', 123, TaskStatus.Unknown.value)
+    with pytest.raises(Exception):
+        _insert_job('a', 456, TaskStatus.Unknown.value)
+
+    assert _set_job_status('a', TaskStatus.Running.value, unless=TaskStatus.Cancelled.value)
+    assert get_jobs_info() == {'a': {'pid': 123, 'status': 'Running'}}
+
+    assert _set_job_status('a', TaskStatus.Cancelled.value)
+    assert not _set_job_status('a', TaskStatus.Running.value, unless=TaskStatus.Cancelled.value)
+    assert get_jobs_info()['a']['status'] == 'Cancelled'
+
+    _delete_job('a')
+    assert get_jobs_info() == {}
+    assert not _set_job_status('a', TaskStatus.Cancelled.value)
+
+
+def insert_jobs(db_path, prefix):
+    htplatform_worker.local_db = db_path
+    for i in range(50):
+        _insert_job(f'{prefix}{i}', i, TaskStatus.Unknown.value)
+        _set_job_status(f'{prefix}{i}', TaskStatus.Running.value)
+
+
+def test_concurrent_writers():
+    processes = [mp.Process(target=insert_jobs, args=(htplatform_worker.local_db, p)) for p in 'abcd']
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    jobs_info = get_jobs_info()
+    assert len(jobs_info) == 200  # No lost update
+    assert all(info['status'] == 'Running' for info in jobs_info.values())
+
+
+class FakeRedis:
+    """Records the published job info"""
+
+    def __init__(self):
+        self.info = {}
+
+    def hset(self, key, mapping):
+        self.info.setdefault(key, {}).update(mapping)
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+    def eval(self, script, num_keys, *args):
+        return 0  # Nothing reserved to release
+
+
+@pytest.mark.parametrize('preload', [None, ['json']])
+def test_supervisor(tmp_path, preload):
+    from hypertrainer.jobsupervisor import Supervisor
+    from hypertrainer.htplatform_worker import job_info_key
+
+    script = tmp_path / 'script.py'
+    script.write_text('import sys, time\ntime.sleep(float(sys.argv[1]))\n')
+
+    def job_spec(job_id, duration):
+        return dict(job_id=job_id, script_file=str(script), config_file=str(duration), output_path=str(tmp_path),
+                    stdout_path=str(tmp_path / f'{job_id}.out'), stderr_path=str(tmp_path / f'{job_id}.err'),
+                    python_env_command=[sys.executable])
+
+    redis_conn = FakeRedis()
+    supervisor = Supervisor(redis_conn, 'somehost', preload)
+    short_job = supervisor.launch(job_spec('short', 0.1))
+    long_job = supervisor.launch(job_spec('long', 60))
+
+    assert short_job.done_event.wait(timeout=10)
+    assert get_jobs_info()['short']['status'] == 'Finished'
+    assert redis_conn.info[job_info_key('short')]['status'] == 'Finished'
+    assert redis_conn.info[job_info_key('short')]['hostname'] == 'somehost'
+
+    # Cancellation kills the job right away
+    for _ in range(50):
+        if get_jobs_info()['long']['status'] == 'Running':
+            break
+        time.sleep(0.1)
+    assert get_jobs_info()['long']['status'] == 'Running'
+    _set_job_status('long', TaskStatus.Cancelled.value)
+    start = time.time()
+    assert supervisor.cancel('long')
+    assert long_job.done_event.wait(timeout=10)
+    assert time.time() - start < 2
+    assert get_jobs_info()['long']['status'] == 'Cancelled'
+    assert not supervisor.cancel('long')
+
+
+def test_fork_server(tmp_path):
+    from hypertrainer.forkserver import ForkServer
+
+    script = tmp_path / 'script.py'
+    script.write_text('import atexit, os, sys, threading, time\n'
+                      'print(os.getcwd(), os.environ["CUDA_VISIBLE_DEVICES"], sys.argv[1], "json" in sys.modules)\n'
+                      'print("oops", file=sys.stderr)\n'
+                      'atexit.register(print, "atexit ran")\n'
+                      'threading.Thread(target=lambda: (time.sleep(0.2), print("thread done"))).start()\n'
+                      'sys.exit(3)\n')
+    cwd = tmp_path / 'cwd'
+    cwd.mkdir()
+
+    fork_server = ForkServer([sys.executable], tmp_path, preload=['json'])
+    try:
+        for i in range(2):  # The second job is forked from the same server
+            env = dict(os.environ, CUDA_VISIBLE_DEVICES=str(i))
+            process = fork_server.spawn([str(script), 'arg'], cwd=str(cwd), env=env,
+                                        stdout_path=str(tmp_path / 'out.txt'), stderr_path=str(tmp_path / 'err.txt'))
+            assert process.wait() == 3
+            # Finalized like a new interpreter: the non-daemon threads are waited for, then the atexit functions run
+            assert (tmp_path / 'out.txt').read_text() == f'{cwd} {i} arg True\nthread done\natexit ran\n'
+            assert (tmp_path / 'err.txt').read_text() == 'oops\n'
+        server_pid = fork_server.process.pid
+        assert process.poll() == 3
+        assert fork_server.process.pid == server_pid
+    finally:
+        fork_server.stop()
+    fork_server.process.wait()
+    assert not os.path.exists(fork_server.socket_path)
@@ -0,0 +1,80 @@
+import numpy as np
+
+from hypertrainer.logparser import LogInterpreter, LineReader
+
+
+def tsv_lines(*rows):
+    return ''.join('\t'.join(map(str, r)) + '\n' for r in rows)
+
+
+def test_line_reader():
+    reader = LineReader()
+    assert reader.read('a\nb') == (['a'], False)
+    assert reader.read('a\nb\nc\n') == (['b', 'c'], False)
+    assert reader.read('a\nb\nc\n') == ([], False)
+    assert reader.read('x\n') == (['x'], True)  # Truncated
+
+
+def test_progress_incremental():
+    interpreter = LogInterpreter()
+    log = tsv_lines(('ep_idx', 'phase', 'iter_idx', 'iter_per_epoch', 'timestamp'),
+                    (0, 'trn', 0, 2, 100.5),
+                    (0, 'trn', 1, 2, 105.0))
+    interpreter.feed({'progress': log})
+    progress = interpreter.progress
+    assert (progress.cur_epoch, progress.cur_iter, progress.iter_per_epoch) == (0, 1, 2)
+    assert progress.epoch_duration is None
+
+    log += tsv_lines((1, 'trn', 0, 2, 110), (1, 'val', 1, 2, 115), (2, 'trn', 0, 2, 130))
+    interpreter.feed({'progress': log})
+    assert (progress.cur_phase, progress.cur_epoch, progress.cur_iter) == ('trn', 2, 0)
+    assert progress.epoch_duration == 15  # mean(110 - 100, 130 - 110)
+    ep_time_remain, total_time_remain = progress.get_time_remaining(num_epochs=4, now=135)
+    assert ep_time_remain == 10
+    assert total_time_remain == 25
+
+
+def test_metrics_incremental():
+    interpreter = LogInterpreter()
+    loss = tsv_lines((0, 0.5))
+    classwise = tsv_lines((0, 0, 0.1), (0, 1, 0.2))
+    interpreter.feed({'metric_loss': loss, 'metric_classwise_iou': classwise, 'out': ''})
+    interpreter.feed({'metric_loss': loss + tsv_lines((1, 0.25)),
+                      'metric_classwise_iou': classwise + tsv_lines((1, 0, 0.3))})
+
+    metrics = interpreter.get_metrics()
+    assert np.array_equal(metrics['loss'], [[0, 0.5], [1, 0.25]])
+    assert np.array_equal(metrics['iou']['0'], [[0, 0.1], [1, 0.3]])
+    assert np.array_equal(metrics['iou']['1'], [[0, 0.2]])
+
+
+def test_pop_new_points():
+    interpreter = LogInterpreter()
+    loss = tsv_lines((0, 0.5))
+    classwise = tsv_lines((0, 0, 0.1))
+    interpreter.feed({'metric_loss': loss, 'metric_classwise_iou': classwise, 'progress': ''})
+    restarted, points = interpreter.pop_new_points()
+    assert restarted == {'loss', 'iou'}
+    assert sorted(points) == [('iou', '0', 0, 0.1), ('loss', '', 0, 0.5)]
+
+    interpreter.feed({'metric_loss': loss + tsv_lines((1, 0.25)), 'metric_classwise_iou': classwise})
+    assert interpreter.pop_new_points() == (set(), [('loss', '', 1, 0.25)])
+    assert interpreter.pop_new_points() == (set(), [])
+
+    interpreter.feed({'metric_loss': tsv_lines((0, 0.4)), 'metric_classwise_iou': classwise})  # Rewritten
+    assert interpreter.pop_new_points() == ({'loss'}, [('loss', '', 0, 0.4)])
+
+
+def test_failed_fetch():
+    interpreter = LogInterpreter()
+    loss = tsv_lines(*[(i, 1 / (i + 1)) for i in range(5)])
+    interpreter.feed({'metric_loss': loss})
+    interpreter.pop_new_points()
+
+    interpreter.feed(None)  # The logs could not be fetched: the state is kept
+    interpreter.feed({'metric_loss': loss + tsv_lines((5, 0.1))})
+    assert interpreter.pop_new_points() == (set(), [('loss', '', 5, 0.1)])
+
+    interpreter.feed({})  # The log was deleted
+    interpreter.feed({'metric_loss': tsv_lines((0, 0.3))})
+    assert interpreter.pop_new_points() == ({'loss'}, [('loss', '', 0, 0.3)])
@@ -0,0 +1,71 @@
+from hypertrainer.logtail import LogCache, tail_logs
+
+
+def fetch(cache, output_path):
+    base_cursors = cache.get_cursors('task')
+    deltas, cursors = tail_logs(output_path, base_cursors)
+    return deltas, cache.apply('task', deltas, cursors, base_cursors)
+
+
+def test_tail_appended(tmp_path):
+    log_file = tmp_path / 'out.txt'
+    log_file.write_text('line 1\n')
+    cache = LogCache()
+
+    deltas, logs = fetch(cache, tmp_path)
+    assert deltas['out'] == {'data': 'line 1\n', 'reset': True}
+    assert logs == {'out': 'line 1\n'}
+
+    with log_file.open('a') as f:
+        f.write('line 2\n')
+    deltas, logs = fetch(cache, tmp_path)
+    assert deltas['out'] == {'data': 'line 2\n', 'reset': False}
+    assert logs == {'out': 'line 1\nline 2\n'}
+
+    # Nothing new
+    deltas, logs = fetch(cache, tmp_path)
+    assert deltas['out']['data'] == ''
+    assert logs == {'out': 'line 1\nline 2\n'}
+
+
+def test_tail_truncated_and_deleted(tmp_path):
+    log_file = tmp_path / 'metric_loss.log'
+    log_file.write_text('0 1.0\n1 0.5\n')
+    cache = LogCache()
+    fetch(cache, tmp_path)
+
+    log_file.write_text('0 2.0\n')  # Truncated, e.g. when the task is resumed
+    deltas, logs = fetch(cache, tmp_path)
+    assert deltas['metric_loss']['reset']
+    assert logs == {'metric_loss': '0 2.0\n'}
+
+    log_file.unlink()
+    _, logs = fetch(cache, tmp_path)
+    assert logs == {}
+
+
+def test_tail_incomplete_character(tmp_path):
+    log_file = tmp_path / 'out.txt'
+    encoded = 'é'.encode('utf-8')
+    log_file.write_bytes(b'a' + encoded[:1])
+    cache = LogCache()
+
+    _, logs = fetch(cache, tmp_path)
+    assert logs == {'out': 'a'}
+
+    with log_file.open('ab') as f:
+        f.write(encoded[1:])
+    _, logs = fetch(cache, tmp_path)
+    assert logs == {'out': 'aé'}
+
+
+def test_concurrent_fetch_discarded(tmp_path):
+    log_file = tmp_path / 'out.txt'
+    log_file.write_text('line 1\n')
+    cache = LogCache()
+    base_cursors = cache.get_cursors('task')
+    late_deltas, late_cursors = tail_logs(tmp_path, base_cursors)
+
+    fetch(cache, tmp_path)
+    logs = cache.apply('task', late_deltas, late_cursors, base_cursors)  # Must not duplicate the line
+    assert logs == {'out': 'line 1\n'}
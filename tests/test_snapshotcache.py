@@ -0,0 +1,63 @@
+import threading
+import time
+
+from hypertrainer.snapshotcache import SnapshotCache
+
+
+def test_single_flight():
+    num_loads = 0
+    release = threading.Event()
+
+    def load(key):
+        nonlocal num_loads
+        num_loads += 1
+        release.wait(timeout=5)
+        return key, num_loads
+
+    cache = SnapshotCache(load, ttl_secs=60)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('a'))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    release.set()
+    for t in threads:
+        t.join()
+
+    # The concurrent callers shared one load
+    assert num_loads == 1
+    assert all(s is results[0] for s in results)
+    assert results[0].value == ('a', 1)
+
+    # Cached until too old
+    assert cache.get('a') is results[0]
+    assert cache.get('a', max_age_secs=0).value == ('a', 2)
+
+    cache.invalidate()
+    assert cache.get('a').value == ('a', 3)
+
+
+def test_background_refresh():
+    loaded = threading.Event()
+
+    def load(key):
+        loaded.set()
+        return key
+
+    cache = SnapshotCache(load, ttl_secs=60)
+    assert cache.get_latest('a') is None  # Not loaded yet, but the load started
+    assert loaded.wait(timeout=5)
+    assert cache.refresh('a').result(timeout=5).value == 'a'
+    snapshot = cache.get_latest('a')
+    assert snapshot.value == 'a' and snapshot.age < 60
+
+
+def test_eviction():
+    cache = SnapshotCache(lambda key: key, ttl_secs=60, max_entries=2)
+    a = cache.get('a')
+    cache.get('b')
+    assert cache.get('a') is a  # Now the most recently used
+    cache.get('c')  # Evicts 'b'
+    assert cache.get_latest('a') is a
+    assert cache.get_latest('c').value == 'c'
+    assert cache.get_latest('b') is None
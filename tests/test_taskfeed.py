@@ -0,0 +1,52 @@
+import threading
+
+from hypertrainer.taskfeed import TaskFeed
+
+
+def test_task_feed():
+    rows = {1: ('a', {'epoch': 0}), 2: ('b', {'epoch': 0})}
+    num_refreshes = 0
+    refreshed = threading.Semaphore(0)
+    refreshed_ids = []
+
+    def get_rows(task_ids):
+        nonlocal num_refreshes
+        num_refreshes += 1
+        refreshed_ids.append(task_ids)
+        refreshed.release()
+        return {i: r for i, r in rows.items() if task_ids is None or i in task_ids}
+
+    feed = TaskFeed(get_rows)
+    feed.interval_secs = 0.01
+
+    sub_all = feed.subscribe()
+    sub_a = feed.subscribe(project='a')
+    assert sub_all.pop(timeout=2) == {1: {'epoch': 0}, 2: {'epoch': 0}}
+    assert sub_a.pop(timeout=2) == {1: {'epoch': 0}}
+
+    # Only the rows that changed are pushed
+    rows[2] = ('b', {'epoch': 1})
+    assert sub_all.pop(timeout=2) == {2: {'epoch': 1}}
+    assert sub_a.pop(timeout=0.1) == {}
+
+    # A new subscriber gets the rows known so far
+    sub_b = feed.subscribe(project='b')
+    assert sub_b.pop(timeout=0) == {2: {'epoch': 1}}
+
+    # Only the tasks that the subscribers asked for are refreshed
+    for s in (sub_all, sub_a, sub_b):
+        feed.unsubscribe(s)
+    sub_ids = feed.subscribe(task_ids=[2])
+    assert sub_ids.pop(timeout=0) == {2: {'epoch': 1}}
+    rows[1] = ('a', {'epoch': 5})
+    rows[2] = ('b', {'epoch': 2})
+    assert sub_ids.pop(timeout=2) == {2: {'epoch': 2}}
+    assert refreshed_ids[-1] == {2}
+
+    # Without subscribers, the tasks are not refreshed anymore
+    feed.unsubscribe(sub_ids)
+    while refreshed.acquire(timeout=0.1):
+        pass
+    n = num_refreshes
+    assert not refreshed.acquire(timeout=0.1)
+    assert num_refreshes == n
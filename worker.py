@@ -1,59 +1,154 @@
 #!/usr/bin/env python
 import argparse
 import socket
+import time
+import uuid
 from multiprocessing import Process
-from typing import List
+from typing import Dict, List, Optional
 
 from redis import Redis
 from rq import Connection, Worker
 from rq.worker import StopRequested
 
-
-# Preload libraries
-# TODO import library_that_you_want_preloaded
+from hypertrainer import htplatform_worker, jobsupervisor
+from hypertrainer.resources import ResourceQueue, advertise_capacity, get_capacity, peek_job
 from hypertrainer.utils import config_context
 
 
 class WorkerContext:
-    def __init__(self, hostname, num_workers=1):
+    """Runs the worker processes of a machine: the job supervisor, the worker of the machine's own queue, and the
+    workers of the global jobs queue.
+
+    If max_workers is set, the pool of jobs workers is scaled between num_workers and max_workers, on how fast the jobs
+    are claimed: a worker is added when a job that fits the free resources of the machine is still waiting a scale
+    interval after it was seen, and an idle worker is stopped when no such job has waited for scale_down_delay_secs.
+    The state of the workers says little about the load, since they are only busy while handing a job over to the
+    supervisor (unless there is no supervisor, in which case they are busy while the job runs).
+    """
+
+    scale_interval_secs = 5
+
+    def __init__(self, hostname, num_workers=1, num_cpus=None, mem_gb=None, preload=None, max_workers=None,
+                 scale_down_delay_secs=300):
         self.hostname = hostname if hostname is not None else socket.gethostname()
         with config_context() as config:
-            redis_port = config['ht_platform']['redis_port']
+            self.redis_port = redis_port = config['ht_platform']['redis_port']
             self.redis_conn = Redis(port=redis_port)
         self.conn = Connection(self.redis_conn)
 
         self.worker_processes: List[Process] = []
+        self.job_workers: Dict[str, Process] = {}  # The workers of the jobs queue, by rq worker name
+        self.stopping_workers: List[Process] = []
+        self.last_waiting_job: Optional[str] = None  # Seen by the previous scale()
+        self.no_backlog_since: Optional[float] = None  # Since when no job that fits the machine is waiting
         self.num_workers = num_workers
+        self.max_workers = max_workers  # None: the pool is not scaled
+        self.scale_down_delay_secs = scale_down_delay_secs
+        self.preload = preload  # Modules preloaded by the fork servers, or None to start each job in a new interpreter
+        self.capacity = get_capacity(num_cpus=num_cpus, mem_gb=mem_gb)
+        self.jobs_queue = ResourceQueue('jobs', connection=self.redis_conn)
 
         print('Redis port:', redis_port)
 
     def __enter__(self):
         self.conn.__enter__()
 
-        self.worker_processes.append(Process(target=work, args=(self.hostname,)))  # Worker specific queue
-        self.worker_processes += [Process(target=work, args=('jobs',)) for _ in range(self.num_workers)]
+        # The jobs are only claimed if they fit the free resources of the machine
+        advertise_capacity(self.redis_conn, self.hostname, self.capacity)
+        print('Capacity:', self.capacity)
+
+        # Launches the jobs, and tracks them until they end
+        self.worker_processes.append(Process(target=supervise, args=(self.redis_port, self.hostname, self.preload)))
+        # Worker specific queue
+        self.worker_processes.append(Process(target=work, args=(self.hostname, self.hostname)))
 
         for w in self.worker_processes:
             w.start()
+        for _ in range(self.num_workers):
+            self._add_job_worker()
 
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.conn.__exit__(exc_type, exc_val, exc_tb)
 
-        for w in self.worker_processes:
+        for w in self.worker_processes + list(self.job_workers.values()) + self.stopping_workers:
             w.terminate()
 
     def wait(self):
-        for w in self.worker_processes:
-            w.join()
-
-
-def work(queue_name):
+        if self.max_workers is None:
+            for w in self.worker_processes + list(self.job_workers.values()):
+                w.join()
+            return
+        print(f'Scaling the jobs workers between {self.num_workers} and {self.max_workers}')
+        while all(w.is_alive() for w in self.worker_processes):
+            self.scale()
+            time.sleep(self.scale_interval_secs)
+
+    def scale(self):
+        """Add or stop one jobs worker, if needed"""
+
+        self.stopping_workers = [w for w in self.stopping_workers if w.is_alive()]
+        for name, w in list(self.job_workers.items()):
+            if not w.is_alive():
+                print('WARNING: Worker', name, 'exited with code', w.exitcode)
+                self._forget_job_worker(name)
+        while len(self.job_workers) < self.num_workers:
+            self._add_job_worker()
+
+        now = time.time()
+        waiting_job = peek_job(self.redis_conn, self.jobs_queue, self.hostname)
+        if waiting_job is None:
+            self.no_backlog_since = self.no_backlog_since or now
+        else:
+            self.no_backlog_since = None
+
+        if waiting_job is not None and waiting_job == self.last_waiting_job:
+            if len(self.job_workers) < self.max_workers:
+                self._add_job_worker()  # The jobs are not claimed as fast as they come, and the machine has room
+        elif self.no_backlog_since is not None and now - self.no_backlog_since > self.scale_down_delay_secs \
+                and len(self.job_workers) > self.num_workers:
+            name = self._find_idle_job_worker()
+            if name is not None:
+                print('Stopping idle worker', name)
+                self.job_workers[name].terminate()  # Warm shutdown: a job that was just dequeued is not lost
+                self.stopping_workers.append(self.job_workers[name])
+                self._forget_job_worker(name)
+                self.no_backlog_since = now  # Stop the next one after another delay
+        self.last_waiting_job = waiting_job
+
+    def _find_idle_job_worker(self) -> Optional[str]:
+        """The name of a jobs worker that is not handling a job, if any"""
+
+        pipeline = self.redis_conn.pipeline(transaction=False)
+        names = list(self.job_workers.keys())
+        for name in names:
+            pipeline.hget(Worker.redis_worker_namespace_prefix + name, 'state')
+        for name, state in zip(names, pipeline.execute()):
+            if state != b'busy':
+                return name
+        return None
+
+    def _add_job_worker(self):
+        name = f'{self.hostname}.jobs.{uuid.uuid4().hex[:8]}'
+        w = Process(target=work, args=('jobs', self.hostname, name))
+        w.start()
+        self.job_workers[name] = w
+
+    def _forget_job_worker(self, name):
+        del self.job_workers[name]
+
+
+def work(queue_name, hostname, name=None):
     # NOTE: Executed in a separate process. This affects print and logging.
 
+    htplatform_worker.worker_hostname = hostname  # Published along with the jobs info
     print('Working on queue', queue_name)
-    w = Worker([queue_name])
+    if queue_name == 'jobs':
+        ResourceQueue.hostname = hostname
+        w = Worker([queue_name], name=name, queue_class=ResourceQueue)
+    else:
+        w = Worker([queue_name])
     try:
         w.work()
     except StopRequested:
@@ -61,6 +156,11 @@ def work(queue_name):
         pass
 
 
+def supervise(redis_port, hostname, preload):
+    # NOTE: Executed in a separate process
+    jobsupervisor.supervise(Redis(port=redis_port), hostname, preload)
+
+
 def start_worker(**kwargs):
     with WorkerContext(**kwargs) as c:
         c.wait()
@@ -69,7 +169,19 @@ def start_worker(**kwargs):
 if __name__ == '__main__':
     ap = argparse.ArgumentParser()
     ap.add_argument('--hostname', type=str)
-    ap.add_argument('--workers', type=int, default=1)
+    ap.add_argument('--workers', type=int, default=1, help='Number of workers of the jobs queue (the minimum, with '
+                                                           '--max-workers)')
+    ap.add_argument('--max-workers', type=int, help='Scale the number of workers of the jobs queue up to this')
+    ap.add_argument('--scale-down-delay', type=float, default=300,
+                    help='Seconds without waiting jobs after which a worker is stopped, with --max-workers')
+    ap.add_argument('--cpus', type=int, help='Number of cores available to the jobs (default: all)')
+    ap.add_argument('--mem-gb', type=float, help='Memory available to the jobs (default: all the physical memory)')
+    ap.add_argument('--fork-jobs', action='store_true',
+                    help='Fork the jobs from a warm interpreter of their python env, instead of starting a new one')
+    ap.add_argument('--preload', nargs='*', default=[], metavar='MODULE',
+                    help='Modules imported once by the warm interpreters (with --fork-jobs), e.g. torch numpy')
     args = ap.parse_args()
 
-    start_worker(hostname=args.hostname, num_workers=args.workers)
+    start_worker(hostname=args.hostname, num_workers=args.workers, num_cpus=args.cpus, mem_gb=args.mem_gb,
+                 preload=args.preload if args.fork_jobs else None, max_workers=args.max_workers,
+                 scale_down_delay_secs=args.scale_down_delay)